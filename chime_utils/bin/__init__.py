@@ -5,3 +5,4 @@ from .lhotse_prep import *  # noqa F403
 from .org_tools import *  # noqa F403
 from .scoring import *  # noqa F403
 from .speechbrain_prep import *  # noqa F403
+from .text_norm import *  # noqa F403
@@ -5,10 +5,13 @@ import click
 from chime_utils.bin.base import cli
 from chime_utils.dgen import (
     data_check,
+    export_shards,
     gen_chime6,
+    gen_dasr,
     gen_dipco,
     gen_mixer6,
     gen_notsofar1,
+    repack_multichannel,
 )
 
 logging.basicConfig(
@@ -60,7 +63,66 @@ def dgen():
     default=False,
     help="Organizers-only, create checksum.",
 )
-def checksum_data(data_folder, check_eval, checksum_json, forgive_missing, create):
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=8,
+    show_default=True,
+    help="Number of files hashed in parallel.",
+)
+@click.option(
+    "--full-check",
+    is_flag=True,
+    default=False,
+    help=(
+        "Hash every file again, by default files unchanged since the last "
+        "check (same size, mtime and inode) are not read again."
+    ),
+)
+@click.option(
+    "--manifest-version",
+    type=click.Choice(["1", "2"]),
+    default="1",
+    show_default=True,
+    help=(
+        "With --create, 1 for the legacy MD5 file or 2 to store also the "
+        "size and the digest of each chunk of the files, so that wrong files "
+        "are found faster and the corrupted byte range is reported."
+    ),
+)
+@click.option(
+    "--algo",
+    type=click.Choice(["md5", "blake2b", "sha256"]),
+    default="md5",
+    show_default=True,
+    help=(
+        "Hashing algorithm, the official check uses md5. With any other one "
+        "the data is checked against the sidecar checksum file in DATA_FOLDER, "
+        "made with --create-sidecar, e.g. for quicker routine checks."
+    ),
+)
+@click.option(
+    "--create-sidecar",
+    is_flag=True,
+    default=False,
+    help=(
+        "Check the data with md5 and, if it is correct, write the sidecar "
+        "checksum file for --algo."
+    ),
+)
+def checksum_data(
+    data_folder,
+    check_eval,
+    checksum_json,
+    forgive_missing,
+    create,
+    jobs,
+    full_check,
+    manifest_version,
+    algo,
+    create_sidecar,
+):
     """
     This function can be used if the data has been generated correctly.
     It computes MD5 hash for each file and checks if it is consistent with what
@@ -68,7 +130,18 @@ def checksum_data(data_folder, check_eval, checksum_json, forgive_missing, creat
     DATA_FOLDER: Path to the DASR dataset root (with chime6, dipco and mixer6
     as subfolders)
     """
-    data_check(data_folder, check_eval, checksum_json, forgive_missing, create)
+    data_check(
+        data_folder,
+        check_eval,
+        checksum_json,
+        forgive_missing,
+        create,
+        jobs,
+        full_check,
+        int(manifest_version),
+        algo=algo,
+        create_sidecar=create_sidecar,
+    )
 
 
 @dgen.command(name="dasr")
@@ -98,33 +171,84 @@ def checksum_data(data_folder, check_eval, checksum_json, forgive_missing, creat
         "dev and eval and the text normalization used."
     ),
 )
-def gen_all_dasr(dasr_dir, download_dir, mixer6_dir, part, challenge="chime8"):
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of sessions generated in parallel.",
+)
+@click.option(
+    "--io-jobs",
+    type=int,
+    default=2,
+    show_default=True,
+    help="Maximum number of downloads running at once.",
+)
+@click.option(
+    "--cpu-jobs",
+    type=int,
+    default=2,
+    show_default=True,
+    help="Maximum number of corpus parts generated at once.",
+)
+@click.option(
+    "--state-file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help=(
+        "JSON file where completed steps are recorded to resume an "
+        "interrupted run, by default .dgen_dasr_state.json in DASR_DIR."
+    ),
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help=(
+        "Regenerate every corpus part but only the sessions whose annotations, "
+        "audio or generation settings changed since the last run."
+    ),
+)
+def gen_all_dasr(
+    dasr_dir,
+    download_dir,
+    mixer6_dir,
+    part,
+    challenge="chime8",
+    jobs=1,
+    io_jobs=2,
+    cpu_jobs=2,
+    state_file=None,
+    incremental=False,
+):
     """
     This script downloads and prepares all DASR data for the four core scenarios:
     CHiME-6, DiPCo, Mixer 6 Speech and NOTSOFAR1.
     Note that Mixer 6 must be obtained through LDC while the other datasets can
     be downloaded automatically.
+    Downloads run alongside the generation of the other corpora and each
+    completed step is recorded, so that running the same command again after
+    an interruption resumes where it stopped.
     Refer to https://www.chimechallenge.org/current/task1/data for further details. # noqa E501
 
     DOWNLOAD_DIR: Pathlike, where the original core datasets will be downloaded.\n
     DASR_DIR: Pathlike, where the final prepared DASR data will be stored.\n
     MIXER6_DIR: Pathlike, path to Mixer 6 Speech root folder.
     """
-    for c_part in part.split(","):
-        if c_part == "public_eval":
-            # only prep notsofar1 here
-            continue
-        # prep chime6
-        gen_chime6(dasr_dir, download_dir, True, c_part, challenge)
-        if c_part in ["dev", "eval"]:
-            gen_dipco(dasr_dir, download_dir, True, c_part, challenge)
-        if c_part.startswith("train"):
-            for c_part in ["train_call", "train_intv"]:
-                gen_mixer6(dasr_dir, mixer6_dir, c_part, challenge)
-        else:
-            # dev or eval
-            gen_mixer6(dasr_dir, mixer6_dir, c_part, challenge)
-        # notsofar1 here
+    gen_dasr(
+        dasr_dir,
+        download_dir,
+        mixer6_dir,
+        part,
+        challenge,
+        jobs,
+        io_jobs,
+        cpu_jobs,
+        state_file,
+        incremental,
+    )
 
 
 @dgen.command(name="chime6")
@@ -162,7 +286,24 @@ def gen_all_dasr(dasr_dir, download_dir, mixer6_dir, part, challenge="chime8"):
         "dev and eval and the text normalization used."
     ),
 )
-def chime6(corpus_dir, output_dir, download, part, challenge):
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of sessions generated in parallel.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help=(
+        "Only regenerate the sessions whose annotations, audio or generation "
+        "settings changed since the last run in OUTPUT_DIR."
+    ),
+)
+def chime6(corpus_dir, output_dir, download, part, challenge, jobs, incremental):
     """
     This script prepares the CHiME-6 dataset in a suitable manner as used in
     CHiME-6, CHiME-7 DASR and CHiME-8 DASR challenges.
@@ -171,7 +312,7 @@ def chime6(corpus_dir, output_dir, download, part, challenge):
         exist it will be downloaded to this folder.\n
     OUTPUT_DIR: Path to where the final prepared dataset will be stored.
     """
-    gen_chime6(output_dir, corpus_dir, download, part, challenge)
+    gen_chime6(output_dir, corpus_dir, download, part, challenge, jobs, incremental)
 
 
 @dgen.command(name="dipco")
@@ -187,6 +328,21 @@ def chime6(corpus_dir, output_dir, download, part, challenge):
         " downloaded)."
     ),
 )
+@click.option(
+    "--stream-download",
+    is_flag=True,
+    default=False,
+    help=(
+        "With --download, extract DiPCo while it is downloaded instead of "
+        "reading the whole archive again afterwards."
+    ),
+)
+@click.option(
+    "--keep-archive/--no-keep-archive",
+    default=True,
+    show_default=True,
+    help="With --stream-download, whether to keep a copy of DiPCo.tgz.",
+)
 @click.option(
     "--part",
     "-p",
@@ -210,7 +366,34 @@ def chime6(corpus_dir, output_dir, download, part, challenge):
         " and eval and the text normalization used."
     ),
 )
-def dipco(corpus_dir, output_dir, download, part, challenge):
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of sessions generated in parallel.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help=(
+        "Only regenerate the sessions whose annotations, audio or generation "
+        "settings changed since the last run in OUTPUT_DIR."
+    ),
+)
+def dipco(
+    corpus_dir,
+    output_dir,
+    download,
+    stream_download,
+    keep_archive,
+    part,
+    challenge,
+    jobs,
+    incremental,
+):
     """
     This script prepares the DiPCo dataset in a suitable manner as used in
     CHiME-7 DASR and CHiME-8 DASR challenges.
@@ -218,7 +401,17 @@ def dipco(corpus_dir, output_dir, download, part, challenge):
         exist it will be downloaded to this folder.\n
     OUTPUT_DIR: Path to where the final prepared dataset will be stored.
     """
-    gen_dipco(output_dir, corpus_dir, download, part, challenge)
+    gen_dipco(
+        output_dir,
+        corpus_dir,
+        download,
+        part,
+        challenge,
+        jobs,
+        incremental,
+        stream_download,
+        keep_archive,
+    )
 
 
 @dgen.command(name="mixer6")
@@ -247,7 +440,24 @@ def dipco(corpus_dir, output_dir, download, part, challenge):
         "and eval and the text normalization used."
     ),
 )
-def mixer6(corpus_dir, output_dir, part, challenge):
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of sessions generated in parallel.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help=(
+        "Only regenerate the sessions whose annotations, audio or generation "
+        "settings changed since the last run in OUTPUT_DIR."
+    ),
+)
+def mixer6(corpus_dir, output_dir, part, challenge, jobs, incremental):
     """
     This script prepares the Mixer 6 Speech dataset in a suitable manner as used in
     CHiME-7 DASR and CHiME-8 DASR challenges.\n
@@ -255,7 +465,7 @@ def mixer6(corpus_dir, output_dir, part, challenge):
         obtained through LDC, please refer to https://www.chimechallenge.org/current/task1/data\n
     OUTPUT_DIR: Path to where the final prepared dataset will be stored.
     """
-    gen_mixer6(output_dir, corpus_dir, part, challenge)
+    gen_mixer6(output_dir, corpus_dir, part, challenge, jobs, incremental)
 
 
 @dgen.command(name="notsofar1")
@@ -281,7 +491,164 @@ def mixer6(corpus_dir, output_dir, part, challenge):
         "You can choose multiple by using commas e.g. 'train,dev,eval'."
     ),
 )
-def notsofar1(corpus_dir, output_dir, download, part):
+@click.option(
+    "--word-timing",
+    is_flag=True,
+    default=False,
+    help=(
+        "Whether to keep word-level timings in the scoring transcriptions, "
+        "normalized word by word."
+    ),
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of sessions generated in parallel.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help=(
+        "Only regenerate the sessions whose annotations, audio or generation "
+        "settings changed since the last run in OUTPUT_DIR."
+    ),
+)
+def notsofar1(corpus_dir, output_dir, download, part, word_timing, jobs, incremental):
     parts = part.split(",")
     for p in parts:
-        gen_notsofar1(output_dir, corpus_dir, download, p)
+        gen_notsofar1(
+            output_dir,
+            corpus_dir,
+            download,
+            p,
+            word_timing=word_timing,
+            jobs=jobs,
+            incremental=incremental,
+        )
+
+
+@dgen.command(name="repack")
+@click.argument("data-dir", type=click.Path(exists=True))
+@click.argument("output-dir", type=click.Path(exists=False))
+@click.option(
+    "--part",
+    "-p",
+    type=str,
+    default=None,
+    help=(
+        "Which parts of the generated data to repack, e.g. 'train,dev', "
+        "by default all of them."
+    ),
+)
+@click.option(
+    "--per",
+    type=click.Choice(["array", "session"]),
+    default="array",
+    show_default=True,
+    help=(
+        "One multichannel file per array (<session>_U01) or per session "
+        "with all its arrays (<session>_mdm)."
+    ),
+)
+@click.option(
+    "--format",
+    "audio_format",
+    type=click.Choice(["flac", "wav"]),
+    default=None,
+    help=(
+        "Format of the multichannel files, by default flac with --per array "
+        "and wav with --per session (FLAC supports at most 8 channels)."
+    ),
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of sessions repacked in parallel.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help=(
+        "Only repack the sessions whose audio or device files changed "
+        "since the last run in OUTPUT_DIR."
+    ),
+)
+def repack(data_dir, output_dir, part, per, audio_format, jobs, incremental):
+    """
+    Repacks the array channels of generated data (one mono file each)
+    into interleaved multichannel files, with matching device JSONs,
+    so that reading a multi-channel segment opens a single file.
+    The other audio files, transcriptions and UEMs are linked.
+
+    DATA_DIR: Path to a corpus generated by dgen, e.g. ./chime8_dasr/chime6.\n
+    OUTPUT_DIR: Path to where the repacked corpus will be stored.
+    """
+    repack_multichannel(
+        data_dir, output_dir, part, per, audio_format, jobs, incremental
+    )
+
+
+@dgen.command(name="shards")
+@click.argument("data-dir", type=click.Path(exists=True))
+@click.argument("output-dir", type=click.Path(exists=False))
+@click.option(
+    "--part",
+    "-p",
+    type=str,
+    default=None,
+    help=(
+        "Which parts of the generated data to export, e.g. 'train,dev', "
+        "by default all of them."
+    ),
+)
+@click.option(
+    "--device",
+    type=str,
+    default="ihm",
+    show_default=True,
+    help=(
+        "Audio the segments are cut from, 'ihm' for the close-talk microphone "
+        "of each speaker or a device name, e.g. 'U01.CH1' (or 'U01' for data "
+        "repacked with 'chime-utils dgen repack')."
+    ),
+)
+@click.option(
+    "--shard-size",
+    type=int,
+    default=512,
+    show_default=True,
+    help="Target size of each tar shard in MB.",
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Seed used to shuffle the segments across the shards.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of sessions cut (and shards written) in parallel.",
+)
+def shards(data_dir, output_dir, part, device, shard_size, seed, jobs):
+    """
+    Exports every annotated segment of generated data as a FLAC file with a
+    JSON sidecar (session, speaker, times, raw and normalized transcription),
+    shuffled and written in sequential tar shards for streaming training.
+
+    DATA_DIR: Path to a corpus generated by dgen, e.g. ./chime8_dasr/chime6.\n
+    OUTPUT_DIR: Path to where the shards will be stored, one folder per part.
+    """
+    export_shards(data_dir, output_dir, part, device, shard_size << 20, seed, jobs)
@@ -14,6 +14,7 @@ from chime_utils.dprep.lhotse import (
     prepare_notsofar1,
 )
 from chime_utils.text_norm import get_txt_norm
+from chime_utils.text_norm.cache import DEFAULT_CACHE_SIZE
 
 logging.basicConfig(
     format=(
@@ -379,7 +380,7 @@ def text_normalize(input_dir, output_dir, txt_norm="chime8", regex="*.jsonl.gz")
     INPU_DIR: Path to the manifests parent dir.\n
     OUTPUT_DIR: Path to the output directory where the text normalized lhotse manifests will be stored.
     """
-    txt_normalizer = get_txt_norm(txt_norm)
+    txt_normalizer = get_txt_norm(txt_norm, DEFAULT_CACHE_SIZE)
     os.makedirs(output_dir, exist_ok=True)
 
     def convert_single(input_sup, output_sup, normalizer):
@@ -0,0 +1,66 @@
+import logging
+
+import click
+
+from chime_utils.bin.base import cli
+from chime_utils.text_norm import available_normalizers
+from chime_utils.text_norm.files import FORMATS, guess_format, normalize_file
+
+logging.basicConfig(
+    format=(
+        "%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s"
+    ),
+    datefmt="%Y-%m-%d:%H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+
+@cli.command(name="text-norm")
+@click.argument("input-file", type=click.File("r", encoding="utf-8"))
+@click.argument("output-file", type=click.File("w", encoding="utf-8", lazy=True))
+@click.option(
+    "--txt-norm",
+    type=click.Choice(available_normalizers()),
+    default="chime8",
+    show_default=True,
+    help="Which text normalization you want to apply.",
+)
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(FORMATS),
+    default=None,
+    help=(
+        "Format of the input (and output) file, "
+        "by default guessed from the input file extension."
+    ),
+)
+@click.option(
+    "--workers",
+    "-j",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of worker processes used for normalization.",
+)
+@click.option(
+    "--chunksize",
+    type=int,
+    default=1024,
+    show_default=True,
+    help="Number of transcripts sent at once to each worker.",
+)
+def text_norm(input_file, output_file, txt_norm, fmt, workers, chunksize):
+    """
+    Applies text normalization to CHiME-style JSON, JSONL, CTM or STM files,
+    e.g. system hypotheses before scoring.
+    The input is streamed to the output, so large files are fine.\n
+    INPUT_FILE: Path to the file to normalize, '-' for standard input.\n
+    OUTPUT_FILE: Path to the output file, '-' for standard output.
+    """
+    if fmt is None:
+        if input_file.name == "<stdin>":
+            raise click.UsageError("--format is required when reading from stdin.")
+        fmt = guess_format(input_file.name)
+    normalize_file(input_file, output_file, fmt, txt_norm, workers, chunksize)
@@ -1,5 +1,8 @@
 from chime_utils.dgen.chime6 import gen_chime6
+from chime_utils.dgen.dasr import gen_dasr
 from chime_utils.dgen.dipco import gen_dipco
 from chime_utils.dgen.mixer6 import gen_mixer6
 from chime_utils.dgen.notsofar1 import gen_notsofar1
+from chime_utils.dgen.repack import repack_multichannel
+from chime_utils.dgen.shards import export_shards
 from chime_utils.dgen.utils import data_check
@@ -0,0 +1,127 @@
+"""
+Index of audio file headers (number of frames, sampling rate, number of
+channels and subtype) shared by the data generation and preparation scripts.
+Each entry is keyed by the real path of the file and is only trusted while
+the file size and mtime did not change, so the headers are read once
+and queried afterwards without opening the audio files again.
+The index is stored in `.audio_index.json` next to the generated data,
+the symbolic links created by dgen point to the original files, so
+dprep recipes run on the generated data reuse the same entries.
+New entries are merged into the stored index when saving, so that
+generations running concurrently in the same folder keep each other's.
+"""
+
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, NamedTuple
+
+import soundfile as sf
+
+from chime_utils.dgen.utils import atomic_open, file_lock
+
+logger = logging.getLogger(__name__)
+
+
+class AudioInfo(NamedTuple):
+    frames: int
+    samplerate: int
+    channels: int
+    subtype: str
+
+    @property
+    def duration(self) -> float:
+        return self.frames / self.samplerate
+
+
+class AudioIndex:
+    """
+    :param directory: Pathlike, where the index is stored, if None it is
+        kept in memory only.
+    :param jobs: int, number of headers read in parallel.
+    """
+
+    FILENAME = ".audio_index.json"
+
+    def __init__(self, directory=None, jobs=8):
+        self.path = (
+            None if directory is None else os.path.join(directory, self.FILENAME)
+        )
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.entries = self._load()
+        self.updated = set()
+        self.dirty = False
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning(f"Ignoring corrupted audio index {self.path}.")
+            return {}
+
+    def _lookup(self, path):
+        # returns the real path, its stat key and the entry if still valid
+        real_path = os.path.realpath(path)
+        stat = os.stat(real_path)
+        key = [stat.st_size, stat.st_mtime_ns]
+        with self.lock:
+            entry = self.entries.get(real_path)
+        if entry is not None and entry["stat"] == key:
+            return real_path, key, AudioInfo(*entry["info"])
+        return real_path, key, None
+
+    def get(self, path) -> AudioInfo:
+        """
+        Header information of the audio file `path`, read if not indexed yet.
+        """
+        real_path, key, info = self._lookup(path)
+        if info is None:
+            c_info = sf.info(real_path)
+            info = AudioInfo(
+                int(c_info.frames),
+                int(c_info.samplerate),
+                int(c_info.channels),
+                c_info.subtype,
+            )
+            with self.lock:
+                self.entries[real_path] = {"stat": key, "info": list(info)}
+                self.updated.add(real_path)
+                self.dirty = True
+        return info
+
+    def info(self, paths: Iterable) -> List[AudioInfo]:
+        """
+        Header information of all `paths` (in order), missing ones are
+        read in parallel.
+        """
+        paths = [str(x) for x in paths]
+        if self.jobs <= 1 or len(paths) <= 1:
+            return [self.get(x) for x in paths]
+        with ThreadPoolExecutor(min(self.jobs, len(paths))) as executor:
+            return list(executor.map(self.get, paths))
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        with self.lock:
+            try:
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+                with file_lock(self.path):
+                    # entries added meanwhile by other generations are kept
+                    entries = self._load()
+                    entries.update({k: self.entries[k] for k in self.updated})
+                    with atomic_open(self.path) as f:
+                        json.dump(entries, f, sort_keys=True)
+                self.entries = entries
+                self.updated = set()
+                self.dirty = False
+            except OSError as e:
+                # e.g. read-only data, the index is only an optimization
+                logger.warning(f"Could not write the audio index {self.path}: {e}")
@@ -5,29 +5,354 @@ This module contains functions to download data from Azure blob storage to the l
 from: https://github.com/microsoft/NOTSOFAR1-Challenge/blob/main/utils/azure_storage.py
 LICENSE: https://github.com/microsoft/NOTSOFAR1-Challenge/blob/main/LICENSE
 """
+import base64
+import http.client
 import logging
 import os
 import shutil
-import subprocess
-import tempfile
+import threading
 import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Literal, Optional, Union
+from typing import Dict, Iterator, List, Literal, NamedTuple, Optional, Tuple, Union
+
+import tqdm
+
+from chime_utils.dgen.checksum import hash_file
 
 NOTSOFAR_STORAGE_ACCOUNT_URL = "https://notsofarsa.blob.core.windows.net"
+# REST API version sent with every request
+AZURE_STORAGE_API_VERSION = "2021-08-06"
+DEFAULT_MAX_CONNECTIONS = 8
+DEFAULT_PART_SIZE = 32 << 20
 
 _LOG = logging.getLogger("azure_storage")
 
 
+class Blob(NamedTuple):
+    name: str
+    size: int
+    md5: Optional[str] = None  # base64 Content-MD5, if set for the blob
+
+
+class BlobClient:
+    """
+    Minimal client for the public containers of an Azure storage account,
+    using the Blob service REST API (List Blobs and ranged Get Blob) with
+    one persistent connection per thread, so at most as many connections
+    as threads using it, until close() is called.
+
+    Args:
+        account_url: URL of the storage account
+        container_name: Azure container name
+        timeout: socket timeout in seconds
+    """
+
+    def __init__(self, account_url: str, container_name: str, timeout: float = 60):
+        url = urllib.parse.urlparse(account_url)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.base_path = url.path.rstrip("/") + "/" + container_name
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = set()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if getattr(self._local, "connection", None) is None:
+            cls = (
+                http.client.HTTPSConnection
+                if self.scheme == "https"
+                else http.client.HTTPConnection
+            )
+            self._local.connection = cls(self.netloc, timeout=self.timeout)
+            with self._lock:
+                self._connections.add(self._local.connection)
+        return self._local.connection
+
+    def _close(self):
+        if getattr(self._local, "connection", None) is not None:
+            self._local.connection.close()
+            with self._lock:
+                self._connections.discard(self._local.connection)
+            self._local.connection = None
+
+    def close(self):
+        """
+        Closes the connections of all the threads, e.g. once the workers
+        using the client are done.
+        """
+        with self._lock:
+            connections, self._connections = self._connections, set()
+        for x in connections:
+            x.close()
+
+    def request(self, path: str, headers: Optional[Dict[str, str]] = None):
+        """
+        GET `path` (relative to the container), the response must be read
+        completely before the next request of the same thread.
+        """
+        headers = {"x-ms-version": AZURE_STORAGE_API_VERSION, **(headers or {})}
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request("GET", self.base_path + path, headers=headers)
+                response = connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                # the server may have closed the kept-alive connection
+                self._close()
+                if attempt == 1:
+                    raise
+                continue
+            if response.status >= 400:
+                response.read()
+                raise http.client.HTTPException(
+                    f"GET {self.base_path + path}: {response.status} {response.reason}"
+                )
+            return response
+
+    def list_blobs(self, prefix: str = "") -> Iterator[Blob]:
+        marker = None
+        while True:
+            query = {"restype": "container", "comp": "list", "prefix": prefix}
+            if marker:
+                query["marker"] = marker
+            response = self.request("?" + urllib.parse.urlencode(query))
+            root = ET.fromstring(response.read())
+            for blob in root.iter("Blob"):
+                yield Blob(
+                    blob.findtext("Name"),
+                    int(blob.findtext("Properties/Content-Length")),
+                    blob.findtext("Properties/Content-MD5") or None,
+                )
+            marker = root.findtext("NextMarker")
+            if not marker:
+                return
+
+    def download_range(
+        self,
+        name: str,
+        start: int,
+        end: int,
+        f,
+        progress=None,
+        size: Optional[int] = None,
+    ):
+        """
+        Writes bytes [start, end) of blob `name` at the same offset in the
+        file object `f`. With `size`, the Content-Range of the response must
+        also give it as the size of the blob (e.g. not changed since listed).
+        """
+        response = self.request(
+            "/" + urllib.parse.quote(name), {"Range": f"bytes={start}-{end - 1}"}
+        )
+        if response.status == 206:
+            c_range, _, c_size = response.getheader("Content-Range", "").partition("/")
+            if c_range != f"bytes {start}-{end - 1}" or (
+                size is not None and c_size != str(size)
+            ):
+                response.close()
+                self._close()
+                raise http.client.HTTPException(
+                    f"{name}: got Content-Range {c_range}/{c_size} for "
+                    f"bytes {start}-{end - 1}/{size}."
+                )
+        elif start > 0 or response.length != end or size not in [None, end]:
+            response.close()
+            self._close()
+            raise http.client.HTTPException(f"{name}: range requests not supported.")
+        f.seek(start)
+        received = 0
+        try:
+            while True:
+                chunk = response.read(1 << 20)
+                if not chunk:
+                    break
+                f.write(chunk)
+                received += len(chunk)
+                if progress is not None:
+                    progress(len(chunk))
+        except (http.client.HTTPException, ConnectionError):
+            self._close()
+            raise
+        if received != end - start:
+            self._close()
+            raise http.client.IncompleteRead(b"", end - start - received)
+
+
+def _parts(size: int, part_size: int) -> List[Tuple[int, int]]:
+    return [(x, min(x + part_size, size)) for x in range(0, size, part_size)]
+
+
+class _FileDownload:
+    """
+    Download of one blob into `<destination>.part`, renamed to `destination`
+    once all its parts are written (and their Content-MD5 verified if the
+    blob has one).
+    Completed parts are recorded (as start-end byte ranges) in
+    `<destination>.part.done`, so that an interrupted download resumes with
+    the missing ones only, or from scratch if they were not parts of the
+    same size.
+    """
+
+    def __init__(self, blob: Blob, destination: str, part_size: int):
+        self.blob = blob
+        self.destination = destination
+        self.staging = destination + ".part"
+        self.journal = destination + ".part.done"
+        self.lock = threading.Lock()
+        parts = _parts(blob.size, part_size)
+        done = None
+        if os.path.exists(self.staging) and os.path.exists(self.journal):
+            with open(self.journal, "r") as f:
+                try:
+                    done = {tuple(map(int, x.split("-"))) for x in f.read().split()}
+                except ValueError:
+                    pass
+            if done is None or not done <= set(parts):
+                _LOG.warning(f"{blob.name}: parts of another size, restarting.")
+                done = None
+        if done is None:
+            done = set()
+            Path(destination).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.staging, "wb") as f:
+                f.truncate(blob.size)
+            with open(self.journal, "w"):
+                pass
+        self.todo = [x for x in parts if x not in done]
+        self.remaining = len(self.todo)
+
+    def part_done(self, start: int, end: int):
+        with self.lock:
+            with open(self.journal, "a") as f:
+                f.write(f"{start}-{end}\n")
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+        self.finish()
+
+    def finish(self):
+        if self.blob.md5 is not None:
+            md5 = base64.b64encode(bytes.fromhex(hash_file(self.staging))).decode()
+            if md5 != self.blob.md5:
+                # downloaded again from scratch next time
+                os.remove(self.staging)
+                os.remove(self.journal)
+                raise RuntimeError(
+                    f"{self.blob.name}: got Content-MD5 {md5} "
+                    f"instead of {self.blob.md5}."
+                )
+        os.replace(self.staging, self.destination)
+        os.remove(self.journal)
+
+
+def _finish(download: _FileDownload, part: Optional[Tuple[int, int]] = None) -> bool:
+    # records `part` if any, False if the file is not valid
+    try:
+        if part is None:
+            download.finish()
+        else:
+            download.part_done(*part)
+    except (RuntimeError, OSError) as e:
+        _LOG.error(str(e))
+        return False
+    return True
+
+
+def download_blobs(
+    client: BlobClient,
+    prefix: str,
+    output_dir: str,
+    max_connections: int = DEFAULT_MAX_CONNECTIONS,
+    part_size: int = DEFAULT_PART_SIZE,
+    retries: int = 3,
+) -> bool:
+    """
+    Downloads all blobs under `prefix` in `output_dir` (keeping their path
+    relative to `prefix`), in parts of `part_size` bytes fetched by
+    `max_connections` threads.
+    Files already there with the right size are skipped, interrupted
+    downloads resume from their completed parts.
+
+    Returns:
+        True if every file was downloaded.
+    """
+    downloads = []
+    failed = False
+    for blob in client.list_blobs(prefix):
+        relpath = blob.name[len(prefix) :].lstrip("/")
+        if blob.name.endswith("/") or len(relpath) == 0:
+            continue  # directory placeholders
+        if any(x in ["", ".", ".."] for x in relpath.split("/")):
+            raise ValueError(f"Unsafe blob name {blob.name}.")
+        destination = os.path.join(output_dir, *relpath.split("/"))
+        if (
+            os.path.exists(destination)
+            and os.path.getsize(destination) == blob.size
+            and not os.path.exists(destination + ".part")
+        ):
+            continue
+        download = _FileDownload(blob, destination, part_size)
+        if download.remaining == 0:
+            # empty, or all parts written before an interruption
+            failed |= not _finish(download)
+        else:
+            downloads.append(download)
+    tasks = [(d, part) for d in downloads for part in d.todo]
+    _LOG.info(f"{len(downloads)} files to download under `{prefix}`.")
+
+    lock = threading.Lock()
+    with tqdm.tqdm(
+        total=sum(end - start for _, (start, end) in tasks),
+        unit="B",
+        unit_scale=True,
+    ) as pbar:
+
+        def progress(n):
+            with lock:
+                pbar.update(n)
+
+        def download(task):
+            d, (start, end) = task
+            for attempt in range(retries):
+                try:
+                    with open(d.staging, "r+b") as f:
+                        client.download_range(
+                            d.blob.name, start, end, f, progress, d.blob.size
+                        )
+                    break
+                except (http.client.HTTPException, OSError) as e:
+                    _LOG.warning(f"{d.blob.name} bytes {start}-{end} failed: {e!r}")
+                    if attempt == retries - 1:
+                        return False
+                    time.sleep(2**attempt)
+            return _finish(d, (start, end))
+
+        try:
+            with ThreadPoolExecutor(max_connections) as executor:
+                results = list(executor.map(download, tasks))
+        finally:
+            client.close()
+    return not failed and all(results)
+
+
 def download_blob_container_dir(
     azure_source_dir: str,
     destination_dir: str,
     container_name: str,
     keep_structure: bool = False,
     overwrite: bool = False,
+    account_url: str = NOTSOFAR_STORAGE_ACCOUNT_URL,
+    max_connections: int = DEFAULT_MAX_CONNECTIONS,
+    part_size: int = DEFAULT_PART_SIZE,
 ) -> Optional[str]:
     """
-    Download a directory from the container to the given output directory
+    Download a directory from the container to the given output directory.
+    Files are downloaded directly in the output directory (staged next to
+    their final path and renamed once complete), so running it again after
+    an interruption only downloads what is missing.
     Args:
         azure_source_dir: Azure blob directory to download from
         destination_dir: path to destination directory to download to
@@ -35,58 +360,48 @@ def download_blob_container_dir(
         keep_structure: whether to keep the Azure directory structure in the destination directory
         overwrite: whether to override the output file if it already exists
                    (warning!: if true, will delete the entire destination_dir if it exists)
+        account_url: URL of the storage account
+        max_connections: number of parallel connections
+        part_size: size in bytes of the ranges downloaded in parallel
     Returns:
         a string indicates the output directory path, or None if the download failed
     """
     local_output_dir = destination_dir
     if keep_structure:
         local_output_dir = (
-            os.path.join(destination_dir, azure_source_dir)
+            os.path.join(destination_dir, azure_source_dir.strip("/"))
             .replace("\\", os.sep)
             .replace("/", os.sep)
         )
 
-    if os.path.exists(destination_dir) and not overwrite:
-        _LOG.info(f"{destination_dir} already exists, skipping download")
-        return local_output_dir
+    if os.path.exists(destination_dir) and overwrite:
+        _LOG.debug(f"Deleting existing destination dir: {destination_dir}")
+        shutil.rmtree(destination_dir)
 
     _LOG.info(
         f"downloading `{azure_source_dir}` from container `{container_name}` to `{local_output_dir}`"
     )
-    with tempfile.TemporaryDirectory() as temp_dir:
-        _LOG.info(f"downloading to temp dir first: {temp_dir}")
-        os.makedirs(temp_dir, exist_ok=True)
-        command = (
-            f"az storage copy --recursive --only-show-errors "
-            f"--destination {temp_dir} "
-            f"--source {NOTSOFAR_STORAGE_ACCOUNT_URL}/{container_name} "
+    prefix = azure_source_dir.strip("/")
+    if prefix:
+        prefix += "/"
+    start_time = time.time()
+    try:
+        client = BlobClient(account_url, container_name)
+        completed = download_blobs(
+            client, prefix, local_output_dir, max_connections, part_size
         )
-
-        if azure_source_dir:
-            command += f'--include-path {azure_source_dir.rstrip("/")}'
-        try:
-            start_time = time.time()
-            _LOG.debug(f"command: {command}")
-            subprocess.run(command, shell=True, check=True)
-            _LOG.info(
-                f"download completed successfully, time: {time.time() - start_time:.0f} seconds"
-            )
-        except subprocess.CalledProcessError as e:
-            _LOG.error(
-                f"failed to download `{azure_source_dir}` from `{container_name}` to `{local_output_dir}`: {e}"
-            )
-            return None
-
-        if os.path.exists(destination_dir) and overwrite:
-            _LOG.debug(f"Deleting existing destination dir: {destination_dir}")
-            shutil.rmtree(destination_dir)
-
-        temp_output_dir = (
-            os.path.join(temp_dir, container_name, azure_source_dir)
-            .replace("\\", os.sep)
-            .replace("/", os.sep)
+    except (http.client.HTTPException, OSError, ET.ParseError) as e:
+        _LOG.error(f"failed to list `{azure_source_dir}` in `{container_name}`: {e}")
+        return None
+    if not completed:
+        _LOG.error(
+            f"failed to download `{azure_source_dir}` from `{container_name}` to "
+            f"`{local_output_dir}`, run it again to resume"
         )
-        shutil.move(temp_output_dir, local_output_dir)
+        return None
+    _LOG.info(
+        f"download completed successfully, time: {time.time() - start_time:.0f} seconds"
+    )
     return local_output_dir
 
 
@@ -0,0 +1,445 @@
+"""
+File hashing for the integrity check of the generated data (`data_check`).
+The tree is listed with a single os.scandir walk and files are hashed by a
+bounded pool of threads with large reads (hashlib releases the GIL while
+hashing), with a progress bar in bytes.
+Digests can be kept in a DigestCache, so that checking the tree again only
+hashes the files that changed since.
+
+Two manifest formats are supported: the legacy one, a JSON dict mapping
+each relative path to its MD5, and version 2:
+
+    {
+        "version": 2,
+        "algo": "md5",
+        "chunk_size": 67108864,
+        "files": {
+            "<relative path>": {
+                "size": <bytes>,
+                "digest": "<whole file digest>",
+                "chunks": ["<digest of each chunk_size bytes>", ...]
+            }
+        }
+    }
+
+where "chunks" is only present for files larger than one chunk.
+With version 2 a file with the wrong size fails without being read and
+the verification of a larger file stops at its first corrupted chunk.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import tqdm
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOBS = 8
+BUFFER_SIZE = 8 << 20
+MANIFEST_VERSION = 2
+DEFAULT_CHUNK_SIZE = 64 << 20
+
+
+class TreeFile(NamedTuple):
+    relpath: str
+    path: str
+    size: int
+    mtime_ns: int
+    inode: int
+
+
+def scan_tree(root, extensions: Iterable[str]) -> List[TreeFile]:
+    """
+    Lists the files in `root` (recursively) with one of `extensions`,
+    sorted by relative path. Hidden files and folders are ignored,
+    symbolic links are followed, except to folders already listed
+    (e.g. link cycles).
+    """
+    extensions = tuple(extensions)
+    out = []
+    stat = os.stat(root)
+    visited = {(stat.st_dev, stat.st_ino)}
+    stack = [(str(root), "")]
+    while len(stack) > 0:
+        directory, reldir = stack.pop()
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                relpath = os.path.join(reldir, entry.name)
+                if entry.is_dir():
+                    stat = entry.stat()
+                    if (stat.st_dev, stat.st_ino) not in visited:
+                        visited.add((stat.st_dev, stat.st_ino))
+                        stack.append((entry.path, relpath))
+                elif entry.name.endswith(extensions) and entry.is_file():
+                    stat = entry.stat()
+                    out.append(
+                        TreeFile(
+                            relpath,
+                            entry.path,
+                            stat.st_size,
+                            stat.st_mtime_ns,
+                            stat.st_ino,
+                        )
+                    )
+    return sorted(out)
+
+
+class ManifestEntry(NamedTuple):
+    digest: str
+    size: Optional[int] = None  # not in legacy manifests
+    chunks: Optional[List[str]] = None  # only for files larger than one chunk
+
+
+class Manifest(NamedTuple):
+    entries: Dict[str, ManifestEntry]
+    algo: str = "md5"
+    chunk_size: Optional[int] = None
+    version: int = 1
+
+
+def load_manifest(path) -> Manifest:
+    """
+    Reads a legacy (relative path -> MD5) or version 2 manifest.
+    """
+    with open(path, "r") as f:
+        content = json.load(f)
+    if "version" not in content:
+        return Manifest({k: ManifestEntry(v) for k, v in content.items()})
+    if content["version"] != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported checksum manifest version in {path}.")
+    entries = {
+        k: ManifestEntry(v["digest"], v["size"], v.get("chunks"))
+        for k, v in content["files"].items()
+    }
+    return Manifest(entries, content["algo"], content["chunk_size"], MANIFEST_VERSION)
+
+
+def save_manifest(manifest: Manifest, path):
+    if manifest.version == 1:
+        content = {k: v.digest for k, v in manifest.entries.items()}
+    else:
+        files = {}
+        for k, v in manifest.entries.items():
+            files[k] = {"size": v.size, "digest": v.digest}
+            if v.chunks is not None:
+                files[k]["chunks"] = v.chunks
+        content = {
+            "version": manifest.version,
+            "algo": manifest.algo,
+            "chunk_size": manifest.chunk_size,
+            "files": files,
+        }
+    with open(path, "w") as f:
+        json.dump(content, f, indent=4)
+
+
+class _ChunkedHash:
+    # digest of a whole file and of each of its chunks of chunk_size bytes
+    def __init__(self, algo: str, chunk_size: Optional[int] = None):
+        self.algo = algo
+        self.chunk_size = chunk_size
+        self.h = hashlib.new(algo)
+        self.chunks = []
+        self.c_h = hashlib.new(algo) if chunk_size is not None else None
+        self.c_left = chunk_size
+
+    def update(self, data: memoryview):
+        self.h.update(data)
+        while self.c_h is not None and len(data) > 0:
+            n = min(len(data), self.c_left)
+            self.c_h.update(data[:n])
+            self.c_left -= n
+            data = data[n:]
+            if self.c_left == 0:
+                self.chunks.append(self.c_h.hexdigest())
+                self.c_h, self.c_left = hashlib.new(self.algo), self.chunk_size
+
+    def finish(self) -> str:
+        if self.c_h is not None and self.c_left != self.chunk_size:
+            self.chunks.append(self.c_h.hexdigest())
+            self.c_h = None
+        return self.h.hexdigest()
+
+
+def _hash_chunks(
+    path,
+    algo: str,
+    chunk_size: Optional[int] = None,
+    expected: Optional[List[str]] = None,
+    buffer_size: int = BUFFER_SIZE,
+    progress=None,
+    others: Optional[Dict[str, Optional[int]]] = None,
+):
+    """
+    Hashes the file at `path` and, with `chunk_size`, each chunk of it too.
+    If the digest of a chunk is not the `expected` one, reading stops there.
+    The file is hashed in the same read with each of the `others`
+    algorithms too, mapped to their own chunk size (or None).
+
+    :return: (digest, chunk digests, index of the first bad chunk, dict
+        mapping each of `others` to its (digest, chunk digests)), digest is
+        None (and the dict empty) if reading stopped early.
+    """
+    main = _ChunkedHash(algo, chunk_size)
+    hashers = [main] + [_ChunkedHash(k, v) for k, v in (others or {}).items()]
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(
+                view if chunk_size is None else view[: min(buffer_size, main.c_left)]
+            )
+            if not n:
+                break
+            for x in hashers:
+                x.update(view[:n])
+            if progress is not None:
+                progress(n)
+            if expected is not None and len(main.chunks) > 0:
+                i = len(main.chunks) - 1
+                if i >= len(expected) or main.chunks[i] != expected[i]:
+                    return None, main.chunks, i, {}
+    digests = [x.finish() for x in hashers]
+    if chunk_size is not None and expected is not None:
+        i = len(main.chunks) - 1
+        if i >= 0 and (i >= len(expected) or main.chunks[i] != expected[i]):
+            return None, main.chunks, i, {}
+    return (
+        digests[0],
+        main.chunks,
+        None,
+        {x.algo: (digest, x.chunks) for x, digest in zip(hashers[1:], digests[1:])},
+    )
+
+
+def hash_file(path, algo: str = "md5", buffer_size: int = BUFFER_SIZE, progress=None):
+    """
+    :param path: Pathlike, file to hash.
+    :param algo: str, any algorithm supported by hashlib.new.
+    :param buffer_size: int, size of each read.
+    :param progress: Callable, called with the number of bytes of each read.
+    :return: the hex digest of the file content.
+    """
+    return _hash_chunks(path, algo, buffer_size=buffer_size, progress=progress)[0]
+
+
+def _map_with_progress(fn, files: List[TreeFile], jobs: int, desc=None) -> list:
+    # fn(file, progress), the progress bar counts the bytes read
+    lock = threading.Lock()
+    with tqdm.tqdm(
+        total=sum(x.size for x in files), unit="B", unit_scale=True, desc=desc
+    ) as pbar:
+
+        def progress(n):
+            with lock:
+                pbar.update(n)
+
+        if jobs <= 1:
+            return [fn(x, progress) for x in files]
+        with ThreadPoolExecutor(jobs) as executor:
+            return list(executor.map(lambda x: fn(x, progress), files))
+
+
+class DigestCache:
+    """
+    Digests computed by previous checks, keyed by the relative path of each
+    file and trusted only while its size, mtime and inode did not change
+    (for symbolic links those of the file they point to).
+    Stored as JSON in `path`, with a section for each hashing algorithm.
+
+    :param path: Pathlike, JSON file of the cache, created if missing.
+    :param algo: str, hashing algorithm of the stored digests.
+    """
+
+    FILENAME = ".dgen_checksum_cache.json"
+
+    def __init__(self, path, algo: str = "md5"):
+        self.path = str(path)
+        self.algo = algo
+        self.entries = self._load().get(algo, {})
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning(f"Ignoring corrupted checksum cache {self.path}.")
+            return {}
+
+    @staticmethod
+    def _key(x: TreeFile):
+        return [x.size, x.mtime_ns, x.inode]
+
+    def get(self, x: TreeFile) -> Optional[str]:
+        entry = self.entries.get(x.relpath)
+        if entry is not None and entry["stat"] == self._key(x):
+            return entry["digest"]
+        return None
+
+    def update(self, files: List[TreeFile], digests: Dict[str, str]):
+        for x in files:
+            if x.relpath in digests:
+                self.entries[x.relpath] = {
+                    "stat": self._key(x),
+                    "digest": digests[x.relpath],
+                }
+
+    def save(self):
+        # keep the sections of the other algorithms
+        content = self._load()
+        content[self.algo] = self.entries
+        tmp = f"{self.path}.tmp{os.getpid()}"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(content, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            # e.g. read-only data, checks will just hash everything again
+            logger.warning(f"Could not write the checksum cache {self.path}: {e}")
+
+
+def hash_files(
+    files: List[TreeFile],
+    algo: str = "md5",
+    jobs: int = DEFAULT_JOBS,
+    buffer_size: int = BUFFER_SIZE,
+    desc: Optional[str] = None,
+    cache: Optional[DigestCache] = None,
+) -> Dict[str, str]:
+    """
+    Hashes `files` with `jobs` threads.
+    With a `cache`, files that did not change are not read and
+    the new digests are added to it (call cache.save to store them).
+
+    :return: dict mapping the relative path of each file to its hex digest.
+    """
+    cached = {}
+    if cache is not None:
+        for x in files:
+            digest = cache.get(x)
+            if digest is not None:
+                cached[x.relpath] = digest
+        if len(cached) > 0:
+            logger.info(f"{len(cached)} unchanged files found in the checksum cache.")
+        files_to_hash = [x for x in files if x.relpath not in cached]
+    else:
+        files_to_hash = files
+    digests = _map_with_progress(
+        lambda x, progress: hash_file(x.path, algo, buffer_size, progress),
+        files_to_hash,
+        jobs,
+        desc,
+    )
+    digests = {x.relpath: digest for x, digest in zip(files_to_hash, digests)}
+    if cache is not None:
+        cache.update(files_to_hash, digests)
+    digests.update(cached)
+    return {x.relpath: digests[x.relpath] for x in files}
+
+
+def _manifest_entry(x: TreeFile, digest: str, chunks: List[str]) -> ManifestEntry:
+    return ManifestEntry(digest, x.size, chunks if len(chunks) > 1 else None)
+
+
+def create_manifest(
+    files: List[TreeFile],
+    algo: str = "md5",
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    jobs: int = DEFAULT_JOBS,
+) -> Manifest:
+    """
+    Version 2 manifest of `files`, with their size and chunk digests.
+    """
+
+    def entry(x, progress):
+        digest, chunks, _, _ = _hash_chunks(
+            x.path, algo, chunk_size, buffer_size=BUFFER_SIZE, progress=progress
+        )
+        return _manifest_entry(x, digest, chunks)
+
+    entries = _map_with_progress(entry, files, jobs)
+    return Manifest(
+        {x.relpath: e for x, e in zip(files, entries)},
+        algo,
+        chunk_size,
+        MANIFEST_VERSION,
+    )
+
+
+def verify_files(
+    files: List[TreeFile],
+    manifest: Manifest,
+    jobs: int = DEFAULT_JOBS,
+    cache: Optional[DigestCache] = None,
+    sidecar: Optional[Manifest] = None,
+) -> Dict[str, str]:
+    """
+    Checks `files` against `manifest` (all of them must be in it).
+    Files whose size differs from the manifest one are not read, files with
+    chunk digests are read until their first corrupted chunk.
+    With a `sidecar` manifest (e.g. empty) of another algorithm, every file
+    is read and, if correct, added to it as hashed in the same read.
+
+    :return: dict mapping the relative path of each wrong file to a
+        description of the problem.
+    """
+    errors = {}
+    to_hash = []
+    cached = 0
+    for x in files:
+        entry = manifest.entries[x.relpath]
+        if entry.size is not None and x.size != entry.size:
+            errors[x.relpath] = f"size is {x.size} bytes instead of {entry.size}"
+            continue
+        digest = None if cache is None or sidecar is not None else cache.get(x)
+        if digest is not None:
+            cached += 1
+            if digest == entry.digest:
+                continue
+            if entry.chunks is None:
+                errors[x.relpath] = f"{manifest.algo} checksum is not the same"
+                continue
+            # read it again to locate the corruption
+        to_hash.append(x)
+    if cached > 0:
+        logger.info(f"{cached} unchanged files found in the checksum cache.")
+
+    def verify(x, progress):
+        entry = manifest.entries[x.relpath]
+        chunk_size = manifest.chunk_size if entry.chunks is not None else None
+        others = None if sidecar is None else {sidecar.algo: sidecar.chunk_size}
+        return _hash_chunks(
+            x.path,
+            manifest.algo,
+            chunk_size,
+            entry.chunks,
+            progress=progress,
+            others=others,
+        )
+
+    for x, (digest, _, bad_chunk, others) in zip(
+        to_hash, _map_with_progress(verify, to_hash, jobs)
+    ):
+        if bad_chunk is not None:
+            start = bad_chunk * manifest.chunk_size
+            end = min(start + manifest.chunk_size, x.size)
+            errors[
+                x.relpath
+            ] = f"{manifest.algo} checksum is not the same for bytes {start}-{end}"
+            continue
+        if cache is not None:
+            cache.update([x], {x.relpath: digest})
+        if digest != manifest.entries[x.relpath].digest:
+            errors[x.relpath] = f"{manifest.algo} checksum is not the same"
+        elif sidecar is not None:
+            sidecar.entries[x.relpath] = _manifest_entry(x, *others[sidecar.algo])
+    return dict(sorted(errors.items()))
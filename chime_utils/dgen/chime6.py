@@ -1,13 +1,31 @@
 import glob
 import json
+import logging
 import os
 from copy import deepcopy
 from pathlib import Path
 
-import soundfile as sf
 from lhotse.recipes.chime6 import TimeFormatConverter
 
+from chime_utils.dgen.audio_index import AudioIndex
+from chime_utils.dgen.utils import (
+    SessionCache,
+    atomic_open,
+    atomic_symlink,
+    map_sessions,
+)
 from chime_utils.text_norm import get_txt_norm
+from chime_utils.text_norm.cache import DEFAULT_CACHE_SIZE
+from chime_utils.text_norm.disk_cache import normalizer_version
+
+logging.basicConfig(
+    format=(
+        "%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d]" " %(message)s"
+    ),
+    datefmt="%Y-%m-%d:%H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
 
 CORPUS_URL = ""  # FIXME openslr
 CHiME6_FS = 16000
@@ -36,7 +54,13 @@ chime7_map = {
 
 
 def gen_chime6(
-    output_dir, corpus_dir, download=False, dset_part="train,dev", challenge="chime8"
+    output_dir,
+    corpus_dir,
+    download=False,
+    dset_part="train,dev",
+    challenge="chime8",
+    jobs=1,
+    incremental=False,
 ):
     """
     :param output_dir: Pathlike, path to output directory where the prepared data is saved.
@@ -52,9 +76,19 @@ def gen_chime6(
         Choose between 'chime7' and 'chime8'.
         This option controls the partitioning between train,
         dev and eval and the text normalization used.
+    :param jobs: int, number of sessions generated in parallel.
+    :param incremental: bool, whether to regenerate only the sessions whose
+        inputs changed since the last run in output_dir (see SessionCache).
     """
-    scoring_txt_normalization = get_txt_norm(challenge)
+    scoring_txt_normalization = get_txt_norm(challenge, DEFAULT_CACHE_SIZE)
     corpus_dir = Path(corpus_dir).resolve()  # allow for relative path
+    sessions = SessionCache(
+        output_dir,
+        incremental,
+        static=[challenge, normalizer_version(scoring_txt_normalization)],
+        static_files=[__file__],
+    )
+    audio_index = AudioIndex(output_dir)
 
     if download:
         raise NotImplementedError  # FIXME when openslr is ready
@@ -97,111 +131,151 @@ def gen_chime6(
         )
 
     all_uem = {k: [] for k in splits}
-    for split in splits:
-        json_dir = os.path.join(corpus_dir, "transcriptions", split)
-        ann_json = glob.glob(os.path.join(json_dir, "*.json"))
-        assert len(ann_json) > 0, (
-            "CHiME-6 JSON annotation was not found in {}, please check if "
-            "CHiME-6 data was downloaded correctly and the CHiME-6 main dir "
-            "path is set correctly".format(json_dir)
-        )
-        # we also create audio files symlinks here
-        audio_files = glob.glob(os.path.join(corpus_dir, "audio", split, "*.wav"))
-        sess2audio = {}
-        for x in audio_files:
-            session_name = Path(x).stem.split("_")[0]
-            if session_name not in sess2audio:
-                sess2audio[session_name] = [x]
-            else:
-                sess2audio[session_name].append(x)
-
-        # create device files
-        for c_sess in sess2audio.keys():
-            c_sess_audio_f = sess2audio[c_sess]
-            devices_json = {}
-            for audio in c_sess_audio_f:
-                c_device = Path(audio).stem.lstrip(c_sess + "_")
-                if c_device.startswith("P"):
-                    # close talk device
-                    d_type = {
-                        "is_close_talk": True,
-                        "speaker": c_device,
-                        "num_channels": 2,
-                        "device_type": "binaural_mic",
-                    }
-                else:
-                    # array device
-                    channel = c_device.split(".")[-1]
-                    d_type = {
-                        "is_close_talk": False,
-                        "speaker": None,
-                        "num_channels": 1,
-                        "device_type": f"kinect_array_{channel}_mic",
-                    }
-                devices_json[c_device] = d_type
-
-            devices_json = dict(sorted(devices_json.items(), key=lambda x: x[0]))
-            with open(
-                os.path.join(output_dir, "devices", split, c_sess + ".json"), "w"
-            ) as f:
-                json.dump(devices_json, f, indent=4)
-
-        # for each json file
-        for j_file in ann_json:
-            with open(j_file, "r") as f:
-                annotation = json.load(f)
-            sess_name = Path(j_file).stem
-
-            annotation, scoring_annotation = normalize_chime6(
-                annotation, scoring_txt_normalization
+    try:
+        for split in splits:
+            json_dir = os.path.join(corpus_dir, "transcriptions", split)
+            ann_json = glob.glob(os.path.join(json_dir, "*.json"))
+            assert len(ann_json) > 0, (
+                "CHiME-6 JSON annotation was not found in {}, please check if "
+                "CHiME-6 data was downloaded correctly and the CHiME-6 main dir "
+                "path is set correctly".format(json_dir)
             )
+            # we also create audio files symlinks here
+            audio_files = glob.glob(os.path.join(corpus_dir, "audio", split, "*.wav"))
+            sess2audio = {}
+            for x in audio_files:
+                session_name = Path(x).stem.split("_")[0]
+                if session_name not in sess2audio:
+                    sess2audio[session_name] = [x]
+                else:
+                    sess2audio[session_name].append(x)
 
-            if challenge == "chime7":
-                tsplit = split  # find destination split
-                for k in ["train", "dev", "eval"]:
-                    if sess_name in chime7_map[k].keys():
-                        tsplit = k
-            else:
-                tsplit = split
-
-            # create symlinks too
-            [
-                os.symlink(
-                    x,
-                    os.path.join(output_dir, "audio", tsplit, Path(x).stem) + ".wav",
-                )
-                for x in sess2audio[sess_name]
-            ]
-
-            with open(
-                os.path.join(output_dir, "transcriptions", tsplit, sess_name + ".json"),
-                "w",
-            ) as f:
-                json.dump(annotation, f, indent=4)
-            # retain original annotation but dump also the scoring one
-            with open(
-                os.path.join(
-                    output_dir,
-                    "transcriptions_scoring",
-                    tsplit,
-                    sess_name + ".json",
+            # create device files
+            def write_devices(c_sess):
+                c_sess_audio_f = sess2audio[c_sess]
+                devices_json = {}
+                for audio in c_sess_audio_f:
+                    c_device = Path(audio).stem.lstrip(c_sess + "_")
+                    if c_device.startswith("P"):
+                        # close talk device
+                        d_type = {
+                            "is_close_talk": True,
+                            "speaker": c_device,
+                            "num_channels": 2,
+                            "device_type": "binaural_mic",
+                        }
+                    else:
+                        # array device
+                        channel = c_device.split(".")[-1]
+                        d_type = {
+                            "is_close_talk": False,
+                            "speaker": None,
+                            "num_channels": 1,
+                            "device_type": f"kinect_array_{channel}_mic",
+                        }
+                    devices_json[c_device] = d_type
+
+                devices_json = dict(sorted(devices_json.items(), key=lambda x: x[0]))
+                with atomic_open(
+                    os.path.join(output_dir, "devices", split, c_sess + ".json")
+                ) as f:
+                    json.dump(devices_json, f, indent=4)
+
+            map_sessions(
+                lambda c_sess: sessions.run(
+                    f"devices/{split}/{c_sess}",
+                    lambda: write_devices(c_sess),
+                    audio=sess2audio[c_sess],
+                    outputs=[
+                        os.path.join(output_dir, "devices", split, c_sess + ".json")
+                    ],
                 ),
-                "w",
-            ) as f:
-                json.dump(scoring_annotation, f, indent=4)
-
-            first = sorted([float(x["start_time"]) for x in annotation])[0]
-            end = max([sf.SoundFile(x).frames for x in sess2audio[sess_name]])
-            c_uem = "{} 1 {} {}\n".format(
-                sess_name,
-                "{:.3f}".format(float(first)),
-                "{:.3f}".format(end / CHiME6_FS),
+                list(sess2audio.keys()),
+                jobs,
             )
-            all_uem[tsplit].append(c_uem)
+
+            # for each json file
+            def gen_session(j_file, sess_name, tsplit):
+                with open(j_file, "r") as f:
+                    annotation = json.load(f)
+
+                annotation, scoring_annotation = normalize_chime6(
+                    annotation, scoring_txt_normalization
+                )
+
+                # create symlinks too
+                [
+                    atomic_symlink(
+                        x,
+                        os.path.join(output_dir, "audio", tsplit, Path(x).stem)
+                        + ".wav",
+                    )
+                    for x in sess2audio[sess_name]
+                ]
+
+                with atomic_open(
+                    os.path.join(
+                        output_dir, "transcriptions", tsplit, sess_name + ".json"
+                    )
+                ) as f:
+                    json.dump(annotation, f, indent=4)
+                # retain original annotation but dump also the scoring one
+                with atomic_open(
+                    os.path.join(
+                        output_dir,
+                        "transcriptions_scoring",
+                        tsplit,
+                        sess_name + ".json",
+                    )
+                ) as f:
+                    json.dump(scoring_annotation, f, indent=4)
+
+                first = sorted([float(x["start_time"]) for x in annotation])[0]
+                end = max(x.frames for x in audio_index.info(sess2audio[sess_name]))
+                c_uem = "{} 1 {} {}\n".format(
+                    sess_name,
+                    "{:.3f}".format(float(first)),
+                    "{:.3f}".format(end / CHiME6_FS),
+                )
+                return tsplit, c_uem
+
+            def gen_session_if_changed(j_file):
+                sess_name = Path(j_file).stem
+                if challenge == "chime7":
+                    tsplit = split  # find destination split
+                    for k in ["train", "dev", "eval"]:
+                        if sess_name in chime7_map[k].keys():
+                            tsplit = k
+                else:
+                    tsplit = split
+                return sessions.run(
+                    f"{split}/{sess_name}",
+                    lambda: gen_session(j_file, sess_name, tsplit),
+                    annotations=[j_file],
+                    audio=sess2audio[sess_name],
+                    extra=[split],
+                    outputs=[
+                        os.path.join(output_dir, x, tsplit, sess_name + ".json")
+                        for x in ["transcriptions", "transcriptions_scoring"]
+                    ]
+                    + [
+                        os.path.join(output_dir, "audio", tsplit, Path(x).stem) + ".wav"
+                        for x in sess2audio[sess_name]
+                    ],
+                )
+
+            for tsplit, c_uem in map_sessions(gen_session_if_changed, ann_json, jobs):
+                all_uem[tsplit].append(c_uem)
+    finally:
+        sessions.save()
+        audio_index.save()
 
     for k in all_uem.keys():
         c_uem = all_uem[k]
         if len(c_uem) > 0:
             c_uem = sorted(c_uem)
-            with open(os.path.join(output_dir, "uem", k, "all.uem"), "w") as f:
+            with atomic_open(os.path.join(output_dir, "uem", k, "all.uem")) as f:
                 f.writelines(c_uem)
+    logger.info(
+        "CHiME-6 text normalization cache: " f"{scoring_txt_normalization.cache_info()}"
+    )
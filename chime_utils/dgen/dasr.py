@@ -0,0 +1,332 @@
+"""
+Generation of all the CHiME-8 DASR data (CHiME-6, DiPCo, Mixer 6 Speech
+and NOTSOFAR1) as a graph of tasks.
+Downloads and generation steps run concurrently, as soon as the steps they
+depend on are done, with separate bounds on the number of I/O-heavy
+(downloads) and CPU-heavy (generation) tasks running at once.
+Each started and completed task is recorded in a JSON state file, so that
+an interrupted run resumes where it stopped.
+"""
+
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from chime_utils.dgen.chime6 import gen_chime6
+from chime_utils.dgen.dipco import download_dipco, gen_dipco
+from chime_utils.dgen.mixer6 import gen_mixer6
+from chime_utils.dgen.notsofar1 import (
+    NOTSOFAR1_SUBSETS,
+    download_notsofar1,
+    gen_notsofar1,
+)
+
+logging.basicConfig(
+    format=(
+        "%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d]" " %(message)s"
+    ),
+    datefmt="%Y-%m-%d:%H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+STATE_FILE = ".dgen_dasr_state.json"
+
+
+class Task(NamedTuple):
+    """
+    :param name: str, unique name, used as key in the state file.
+    :param kind: str, 'io' or 'cpu', which concurrency bound applies.
+    :param fn: Callable, takes the results of `deps` (in order)
+        and returns a JSON serializable result.
+    :param deps: list of task names that must be completed before this one.
+    :param outputs: list of directories written by the task, removed before
+        running it again if it was started but not completed by a previous
+        run recorded in the same state file.
+    """
+
+    name: str
+    kind: str
+    fn: Callable
+    deps: List[str] = []
+    outputs: List[str] = []
+
+
+class TaskState:
+    """
+    Names of the started tasks and results of the completed ones,
+    stored in a JSON file.
+    The file is replaced atomically after each started or completed task.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.completed: Dict[str, object] = {}
+        self.started: List[str] = []
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                state = json.load(f)
+            self.completed = state["completed"]
+            self.started = state.get("started", [])
+
+    def start(self, name: str):
+        if name not in self.started:
+            self.started.append(name)
+        self._save()
+
+    def done(self, name: str, result):
+        self.completed[name] = result
+        if name in self.started:
+            self.started.remove(name)
+        self._save()
+
+    def _save(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(
+                {"completed": self.completed, "started": self.started}, f, indent=4
+            )
+        os.replace(tmp, self.path)
+
+
+def run_tasks(
+    tasks: List[Task],
+    state: TaskState,
+    io_jobs: int = 2,
+    cpu_jobs: int = 2,
+):
+    """
+    Runs `tasks` respecting their dependencies, at most `io_jobs` I/O and
+    `cpu_jobs` CPU tasks at once. Tasks already completed in `state` are
+    skipped, the outputs of the ones started but not completed are removed
+    before running them again, the others write over their outputs in place.
+    If a task fails, the tasks depending on it are not run,
+    the others are completed and the first error is raised at the end.
+    """
+    by_name = {t.name: t for t in tasks}
+    for t in tasks:
+        for d in t.deps:
+            if d not in by_name:
+                raise ValueError(f"Task {t.name} depends on unknown task {d}.")
+    pending = [t for t in tasks if t.name not in state.completed]
+    for t in tasks:
+        if t.name in state.completed:
+            logger.info(f"Skipping {t.name}, already done in a previous run.")
+    executors = {
+        "io": ThreadPoolExecutor(io_jobs),
+        "cpu": ThreadPoolExecutor(cpu_jobs),
+    }
+    running = {}
+    failed = {}
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            for t in list(pending):
+                if any(d in failed for d in t.deps):
+                    pending.remove(t)
+                    failed[t.name] = None
+                    logger.error(f"Skipping {t.name}, a task it depends on failed.")
+                elif all(d in state.completed for d in t.deps):
+                    pending.remove(t)
+                    for out in t.outputs:
+                        if t.name in state.started and os.path.exists(out):
+                            # left by an interrupted run
+                            logger.warning(f"Removing incomplete output {out}.")
+                            shutil.rmtree(out)
+                    state.start(t.name)
+                    args = [state.completed[d] for d in t.deps]
+                    logger.info(f"Starting {t.name}.")
+                    running[executors[t.kind].submit(t.fn, *args)] = t
+            if len(running) == 0:
+                break
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                t = running.pop(future)
+                if future.exception() is not None:
+                    logger.error(f"{t.name} failed: {future.exception()!r}")
+                    failed[t.name] = future.exception()
+                else:
+                    logger.info(f"Done {t.name}.")
+                    state.done(t.name, future.result())
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+    errors = [e for e in failed.values() if e is not None]
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def _split_dirs(output_dir: str, split: str, incremental: bool = False) -> List[str]:
+    # everything generated for a split of a corpus, incremental
+    # generation can reuse what an interrupted run left
+    if incremental:
+        return []
+    subdirs = ["audio", "transcriptions", "transcriptions_scoring", "devices", "uem"]
+    return [os.path.join(output_dir, x, split) for x in subdirs]
+
+
+def dasr_tasks(
+    dasr_dir: str,
+    download_dir: str,
+    mixer6_dir: str,
+    parts: List[str],
+    challenge: str = "chime8",
+    jobs: int = 1,
+    incremental: bool = False,
+) -> List[Task]:
+    """
+    Builds the tasks generating all DASR data in dasr_dir/<corpus>,
+    corpora that can be downloaded are downloaded in download_dir/<corpus>.
+    With incremental, the outputs of interrupted tasks are kept and only
+    their unfinished sessions are generated again.
+    """
+    tasks = []
+    chime6_dir = os.path.join(download_dir, "chime6")
+    dipco_dir = os.path.join(download_dir, "dipco")
+    notsofar1_dir = os.path.join(download_dir, "notsofar1")
+
+    def chime6_fn(part):
+        out = os.path.join(dasr_dir, "chime6")
+        # automatic download is not available yet, gen_chime6 tells so
+        download = not os.path.exists(chime6_dir)
+        return lambda: gen_chime6(
+            out, chime6_dir, download, part, challenge, jobs, incremental
+        )
+
+    def dipco_fn(part):
+        out = os.path.join(dasr_dir, "dipco")
+        return lambda corpus: gen_dipco(
+            out, corpus, False, part, challenge, jobs, incremental
+        )
+
+    def mixer6_fn(part):
+        out = os.path.join(dasr_dir, "mixer6")
+        return lambda: gen_mixer6(out, mixer6_dir, part, challenge, jobs, incremental)
+
+    def notsofar1_download_fn(part):
+        return lambda: download_notsofar1(notsofar1_dir, part)
+
+    def notsofar1_fn(part):
+        out = os.path.join(dasr_dir, "notsofar1")
+        # the meetings are found in the downloaded subset folder
+        return lambda _: gen_notsofar1(
+            out,
+            notsofar1_dir,
+            False,
+            part,
+            challenge,
+            jobs=jobs,
+            incremental=incremental,
+        )
+
+    def download_dipco_fn():
+        # extracted in a subfolder
+        return os.path.join(download_dipco(dipco_dir), "Dipco")
+
+    for part in parts:
+        if part != "public_eval":
+            tasks.append(
+                Task(
+                    f"chime6:{part}",
+                    "cpu",
+                    chime6_fn(part),
+                    outputs=_split_dirs(
+                        os.path.join(dasr_dir, "chime6"), part, incremental
+                    ),
+                )
+            )
+            mixer6_parts = ["train_call", "train_intv"] if part == "train" else [part]
+            for c_part in mixer6_parts:
+                tasks.append(
+                    Task(
+                        f"mixer6:{c_part}",
+                        "cpu",
+                        mixer6_fn(c_part),
+                        outputs=_split_dirs(
+                            os.path.join(dasr_dir, "mixer6"), c_part, incremental
+                        ),
+                    )
+                )
+        if part in ["dev", "eval"]:
+            if not any(t.name == "dipco:download" for t in tasks):
+                tasks.append(Task("dipco:download", "io", download_dipco_fn))
+            tasks.append(
+                Task(
+                    f"dipco:{part}",
+                    "cpu",
+                    dipco_fn(part),
+                    deps=["dipco:download"],
+                    outputs=_split_dirs(
+                        os.path.join(dasr_dir, "dipco"), part, incremental
+                    ),
+                )
+            )
+        if part in NOTSOFAR1_SUBSETS:
+            tasks.append(
+                Task(f"notsofar1:download:{part}", "io", notsofar1_download_fn(part))
+            )
+            tasks.append(
+                Task(
+                    f"notsofar1:{part}",
+                    "cpu",
+                    notsofar1_fn(part),
+                    deps=[f"notsofar1:download:{part}"],
+                    outputs=_split_dirs(
+                        os.path.join(dasr_dir, "notsofar1"), part, incremental
+                    ),
+                )
+            )
+        else:
+            logger.warning(f"NOTSOFAR1 {part} part is not available, skipping it.")
+    return tasks
+
+
+def gen_dasr(
+    dasr_dir,
+    download_dir,
+    mixer6_dir,
+    dset_part="train,dev",
+    challenge="chime8",
+    jobs=1,
+    io_jobs=2,
+    cpu_jobs=2,
+    state_file: Optional[str] = None,
+    incremental: bool = False,
+):
+    """
+    :param dasr_dir: Pathlike, where the final prepared DASR data is stored,
+        one subfolder for each corpus.
+    :param download_dir: Pathlike, where the core datasets are downloaded.
+    :param mixer6_dir: Pathlike, path to Mixer 6 Speech root folder.
+    :param dset_part: str, which parts to generate, e.g. 'train,dev'.
+    :param challenge: str, controls the partitioning and text normalization.
+    :param jobs: int, number of sessions generated in parallel
+        within each generation task.
+    :param io_jobs: int, maximum number of downloads running at once.
+    :param cpu_jobs: int, maximum number of generation tasks running at once.
+    :param state_file: Pathlike, JSON file where completed tasks are recorded,
+        by default in dasr_dir.
+    :param incremental: bool, whether to regenerate every part but only the
+        sessions whose inputs changed since the last run, in this case
+        only the completed downloads in the state file are skipped.
+    """
+    if state_file is None:
+        state_file = os.path.join(dasr_dir, STATE_FILE)
+    tasks = dasr_tasks(
+        dasr_dir,
+        download_dir,
+        mixer6_dir,
+        dset_part.split(","),
+        challenge,
+        jobs,
+        incremental,
+    )
+    state = TaskState(state_file)
+    if incremental:
+        # downloads are skipped anyway, generation tasks check every session
+        state.completed = {k: v for k, v in state.completed.items() if ":download" in k}
+    run_tasks(tasks, state, io_jobs, cpu_jobs)
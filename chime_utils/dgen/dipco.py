@@ -9,11 +9,21 @@ from datetime import datetime as dt
 from pathlib import Path
 from typing import Optional
 
-import soundfile as sf
 from lhotse.utils import Pathlike, resumable_download, safe_extract
 
-from chime_utils.dgen.utils import get_mappings
+from chime_utils.dgen.audio_index import AudioIndex
+from chime_utils.dgen.download import stream_download_extract
+from chime_utils.dgen.utils import (
+    SessionCache,
+    atomic_open,
+    atomic_symlink,
+    get_mappings,
+    get_mappings_file,
+    map_sessions,
+)
 from chime_utils.text_norm import get_txt_norm
+from chime_utils.text_norm.cache import DEFAULT_CACHE_SIZE
+from chime_utils.text_norm.disk_cache import normalizer_version
 
 logging.basicConfig(
     format=(
@@ -31,17 +41,30 @@ DIPCO_FS = 16000
 def download_dipco(
     target_dir: Pathlike,
     force_download: Optional[bool] = False,
+    stream: Optional[bool] = False,
+    keep_archive: Optional[bool] = True,
 ) -> Path:
     """
     Download and untar DiPCo dataset.
     :param target_dir: Pathlike, the path of the dir to storage the dataset.
     :param force_download: Bool, if True,
         download the tars no matter if the tars exist.
+    :param stream: Bool, if True, extract the archive while it is downloaded
+        instead of reading it again afterwards (see stream_download_extract),
+        an interrupted download resumes from what was already extracted.
+    :param keep_archive: Bool, with stream, whether to keep DiPCo.tgz too.
     :return: the path to downloaded and extracted directory with data.
     """
     target_dir = Path(target_dir)
     target_dir.mkdir(parents=True, exist_ok=True)
     tar_path = os.path.join(target_dir, "DiPCo.tgz")
+    if stream:
+        return stream_download_extract(
+            CORPUS_URL,
+            target_dir,
+            archive_path=tar_path if keep_archive else None,
+            force_download=force_download,
+        )
     resumable_download(CORPUS_URL, filename=tar_path, force_download=force_download)
     with tarfile.open(tar_path) as tar:
         safe_extract(tar, path=target_dir)
@@ -50,7 +73,15 @@ def download_dipco(
 
 
 def gen_dipco(
-    output_dir, corpus_dir, download=False, dset_part="dev", challenge="chime8"
+    output_dir,
+    corpus_dir,
+    download=False,
+    dset_part="dev",
+    challenge="chime8",
+    jobs=1,
+    incremental=False,
+    stream_download=False,
+    keep_archive=True,
 ):
     """
     :param output_dir: Pathlike,
@@ -65,19 +96,32 @@ def gen_dipco(
     :param challenge: str, choose between chime7 and chime8, it controls the
         choice of the text normalization and possibly how sessions are split
         between dev and eval.
+    :param jobs: int, number of sessions generated in parallel.
+    :param incremental: bool, whether to regenerate only the sessions whose
+        inputs changed since the last run in output_dir (see SessionCache).
+    :param stream_download: bool, whether to extract DiPCo while it is
+        downloaded (see download_dipco).
+    :param keep_archive: bool, with stream_download, whether to keep DiPCo.tgz.
     """
     corpus_dir = Path(corpus_dir).resolve()  # allow for relative path
     mapping = get_mappings(challenge)
     spk_map = mapping["spk_map"]["dipco"]
     sess_map = mapping["sessions_map"]["dipco"]
-    text_normalization = get_txt_norm(challenge)
+    text_normalization = get_txt_norm(challenge, DEFAULT_CACHE_SIZE)
 
     if download:
-        download_dipco(corpus_dir)
+        download_dipco(corpus_dir, stream=stream_download, keep_archive=keep_archive)
         # need this because it will be extracted in a subfolder
         corpus_dir = os.path.join(corpus_dir, "Dipco")
 
     Path(output_dir).mkdir(parents=True, exist_ok=True)
+    sessions = SessionCache(
+        output_dir,
+        incremental,
+        static=[challenge, normalizer_version(text_normalization)],
+        static_files=[__file__, get_mappings_file(challenge)],
+    )
+    audio_index = AudioIndex(output_dir)
 
     def normalize_dipco(annotation, txt_normalizer, split):
         annotation_scoring = []
@@ -152,9 +196,15 @@ def gen_dipco(
             else:
                 sess2audio[session_name].append(x)
 
+        def link_name(sess_name, x):
+            # audio file name in the output, with the new session and speaker
+            device = "_".join(Path(x).stem.split("_")[1:])
+            if device.startswith("P"):
+                device = spk_map[device.split("_")[0]]
+            return sess_map[sess_name] + "_" + device
+
         # for each json file
-        to_uem = []
-        for j_file in ann_json:
+        def gen_session(j_file):
             with open(j_file, "r") as f:
                 annotation = json.load(f)
             sess_name = Path(j_file).stem
@@ -172,13 +222,9 @@ def gen_dipco(
             # create symlinks too but swap names for the sessions too
             devices_info = {}
             for x in sess2audio[sess_name]:
-                filename = new_sess_name + "_" + "_".join(Path(x).stem.split("_")[1:])
-                if filename.split("_")[1].startswith("P"):
-                    speaker_id = filename.split("_")[1]
-                    filename = filename.split("_")[0] + "_{}".format(
-                        spk_map[speaker_id]
-                    )
-
+                filename = link_name(sess_name, x)
+                speaker_id = Path(x).stem.split("_")[1]
+                if speaker_id.startswith("P"):
                     devices_info[filename] = {
                         "is_close_talk": True,
                         "speaker": spk_map[speaker_id],
@@ -193,54 +239,79 @@ def gen_dipco(
                         "num_channels": 1,
                         "device_type": f"circular_array_{channel}_mic",
                     }
-                os.symlink(
+                atomic_symlink(
                     x,
                     os.path.join(output_dir, "audio", split, filename + ".wav"),
                 )
 
             devices_info = dict(sorted(devices_info.items(), key=lambda x: x[0]))
 
-            with open(
+            with atomic_open(
                 os.path.join(
                     output_dir, "devices", split, sess_map[sess_name] + ".json"
-                ),
-                "w",
+                )
             ) as f:
                 json.dump(devices_info, f, indent=4)
 
-            with open(
+            with atomic_open(
                 os.path.join(
                     output_dir,
                     "transcriptions",
                     split,
                     new_sess_name + ".json",
-                ),
-                "w",
+                )
             ) as f:
                 json.dump(annotation, f, indent=4)
-            with open(
+            with atomic_open(
                 os.path.join(
                     output_dir,
                     "transcriptions_scoring",
                     split,
                     new_sess_name + ".json",
-                ),
-                "w",
+                )
             ) as f:
                 json.dump(scoring_annotation, f, indent=4)
 
             uem_start = 0
-            uem_end = max([sf.SoundFile(x).frames for x in sess2audio[sess_name]])
+            uem_end = max(x.frames for x in audio_index.info(sess2audio[sess_name]))
             c_uem = "{} 1 {} {}\n".format(
                 new_sess_name,
                 "{:.3f}".format(float(uem_start)),
                 "{:.3f}".format(float(uem_end / DIPCO_FS)),
             )
-            to_uem.append(c_uem)
+            return c_uem
+
+        def gen_session_if_changed(j_file):
+            sess_name = Path(j_file).stem
+            return sessions.run(
+                f"{split}/{sess_name}",
+                lambda: gen_session(j_file),
+                annotations=[j_file],
+                audio=sess2audio[sess_name],
+                extra=[split],
+                outputs=[
+                    os.path.join(output_dir, x, split, sess_map[sess_name] + ".json")
+                    for x in ["devices", "transcriptions", "transcriptions_scoring"]
+                ]
+                + [
+                    os.path.join(output_dir, "audio", split, link_name(sess_name, x))
+                    + ".wav"
+                    for x in sess2audio[sess_name]
+                ],
+            )
+
+        try:
+            to_uem = map_sessions(gen_session_if_changed, ann_json, jobs)
+        finally:
+            sessions.save()
+            audio_index.save()
 
         if len(to_uem) > 0:
             assert split in ["dev", "eval"]  # uem only for development set
-            Path(os.path.join(output_dir, "uem", split)).mkdir(parents=True)
+            Path(os.path.join(output_dir, "uem", split)).mkdir(
+                parents=True, exist_ok=True
+            )
             to_uem = sorted(to_uem)
-            with open(os.path.join(output_dir, "uem", split, "all.uem"), "w") as f:
+            with atomic_open(os.path.join(output_dir, "uem", split, "all.uem")) as f:
                 f.writelines(to_uem)
+    logger.info(f"DiPCo text normalization cache: {text_normalization.cache_info()}")
@@ -0,0 +1,237 @@
+"""
+Streaming download and extraction of tar archives.
+Members are extracted while the archive is being downloaded, so the data
+is read and written once and the archive itself does not need to be kept.
+Extracted members are recorded in a journal next to them, so that an
+interrupted extraction resumes without writing them again and, if the
+partial archive was kept, without downloading it again either.
+"""
+
+import http.client
+import logging
+import os
+import tarfile
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+import tqdm
+
+from chime_utils.dgen.utils import atomic_open
+
+logger = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 1 << 20
+# some servers refuse requests without a browser-like user agent
+_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_4) AppleWebKit/603.1.30 "
+        "(KHTML, like Gecko) Version/10.1 Safari/603.1.30"
+    )
+}
+
+
+class _ArchiveStream:
+    """
+    File-like object reading the kept part of the archive (if any) and then
+    the HTTP response, copying what comes from the response to `archive`.
+    A response ending before its Content-Length raises IncompleteRead.
+    """
+
+    def __init__(self, local, response, archive, progress):
+        self.local = local
+        self.response = response
+        self.archive = archive
+        self.progress = progress
+        self.remaining = None
+        if response is not None and response.headers.get("Content-Length"):
+            self.remaining = int(response.headers["Content-Length"])
+
+    def read(self, size=-1):
+        if self.local is not None:
+            data = self.local.read(size)
+            if len(data) > 0:
+                self.progress.update(len(data))
+                return data
+            self.local.close()
+            self.local = None
+        if self.response is None:
+            return b""
+        data = self.response.read(size)
+        if self.remaining is not None:
+            self.remaining -= len(data)
+            if len(data) == 0 and self.remaining > 0:
+                raise http.client.IncompleteRead(b"", self.remaining)
+        if self.archive is not None:
+            self.archive.write(data)
+        self.progress.update(len(data))
+        return data
+
+
+def _is_within(directory: str, path: str) -> bool:
+    directory = os.path.realpath(directory)
+    return os.path.commonpath([directory, os.path.realpath(path)]) == directory
+
+
+def _check_member(member: tarfile.TarInfo, target_dir: str):
+    # same spirit as lhotse.utils.safe_extract, which needs the whole archive
+    dest = os.path.join(target_dir, member.name)
+    if os.path.isabs(member.name) or not _is_within(target_dir, dest):
+        raise ValueError(f"Tar member {member.name} is outside {target_dir}.")
+    if member.issym():
+        link = os.path.join(os.path.dirname(dest), member.linkname)
+        if os.path.isabs(member.linkname) or not _is_within(target_dir, link):
+            raise ValueError(
+                f"Tar member {member.name} links outside {target_dir}: "
+                f"{member.linkname}."
+            )
+    elif member.islnk():
+        link = os.path.join(target_dir, member.linkname)
+        if not _is_within(target_dir, link):
+            raise ValueError(
+                f"Tar member {member.name} links outside {target_dir}: "
+                f"{member.linkname}."
+            )
+
+
+def _extract_member(tar, member: tarfile.TarInfo, target_dir: str):
+    dest = os.path.join(target_dir, member.name)
+    if member.isdir():
+        os.makedirs(dest, exist_ok=True)
+        return
+    Path(dest).parent.mkdir(parents=True, exist_ok=True)
+    if member.isfile():
+        source = tar.extractfile(member)
+        with atomic_open(dest, "wb") as f:
+            while True:
+                chunk = source.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+        os.chmod(dest, member.mode & 0o755 | 0o600)
+    elif member.issym() or member.islnk():
+        if os.path.lexists(dest):
+            os.remove(dest)
+        if member.issym():
+            os.symlink(member.linkname, dest)
+        else:
+            os.link(os.path.join(target_dir, member.linkname), dest)
+    else:
+        logger.warning(f"Skipping tar member {member.name}, unsupported type.")
+
+
+def _open_response(url: str, offset: int):
+    """
+    Returns the response for `url` from byte `offset` and the offset it
+    actually starts from (0 if the server does not support ranges),
+    or (None, offset) if there is nothing left to download.
+    """
+    headers = dict(_HEADERS)
+    if offset > 0:
+        headers["Range"] = f"bytes={offset}-"
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers))
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset > 0:
+            # the kept archive is already complete
+            return None, offset
+        raise
+    if offset > 0 and response.status != 206:
+        logger.warning(f"{url} does not support resuming, downloading it again.")
+        return response, 0
+    return response, offset
+
+
+def stream_download_extract(
+    url: str,
+    target_dir,
+    archive_path=None,
+    force_download: bool = False,
+) -> Path:
+    """
+    Downloads the tar archive (optionally compressed) at `url` and extracts
+    it in `target_dir` at the same time.
+    Members that would be written outside `target_dir` (absolute paths,
+    '..' or links pointing outside) make the extraction fail.
+
+    :param url: str, URL of the archive.
+    :param target_dir: Pathlike, where the archive is extracted.
+    :param archive_path: Pathlike, where to keep a copy of the archive,
+        if None the archive is not stored at all.
+    :param force_download: bool, if True, extract everything again
+        even if a previous extraction completed.
+    :return: the path to the extracted directory.
+    """
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    name = os.path.basename(urllib.parse.urlparse(url).path)
+    done_marker = target_dir / f".{name}.extracted"
+    journal_path = target_dir / f".{name}.journal"
+    if force_download:
+        for x in [done_marker, journal_path]:
+            if x.exists():
+                x.unlink()
+        if archive_path is not None and os.path.exists(archive_path):
+            os.remove(archive_path)
+    if done_marker.exists():
+        logger.info(f"{url} already extracted in {target_dir}.")
+        return target_dir
+
+    extracted = set()
+    if journal_path.exists():
+        with open(journal_path, "r") as f:
+            extracted = set(f.read().splitlines())
+        logger.info(f"Resuming the extraction of {url}.")
+
+    offset = 0
+    if archive_path is not None and os.path.exists(archive_path):
+        offset = os.path.getsize(archive_path)
+    response, offset = _open_response(url, offset)
+    total = offset
+    if response is not None:
+        total += int(response.headers.get("Content-Length", 0))
+    local = None
+    if archive_path is not None and offset > 0:
+        local = open(archive_path, "rb")
+    archive = None
+    if archive_path is not None and response is not None:
+        archive = open(archive_path, "r+b" if offset > 0 else "wb")
+        archive.seek(offset)
+        archive.truncate()
+
+    try:
+        with tqdm.tqdm(
+            total=total, unit="B", unit_scale=True, desc=name
+        ) as progress, open(journal_path, "a") as journal:
+            stream = _ArchiveStream(local, response, archive, progress)
+            with tarfile.open(fileobj=stream, mode="r|*") as tar:
+                for member in tar:
+                    _check_member(member, str(target_dir))
+                    dest = target_dir / member.name
+                    if (
+                        member.name in extracted
+                        and os.path.lexists(dest)
+                        and (not member.isfile() or dest.stat().st_size == member.size)
+                    ):
+                        continue  # done by an interrupted run
+                    _extract_member(tar, member, str(target_dir))
+                    journal.write(member.name + "\n")
+                    journal.flush()
+            # the end of archive padding, for the kept copy to be complete
+            while len(stream.read(_CHUNK_SIZE)) > 0:
+                pass
+    except (http.client.IncompleteRead, ConnectionError):
+        logger.error(
+            f"Download of {url} interrupted, run it again to resume the extraction."
+        )
+        raise
+    finally:
+        for x in [local, response, archive]:
+            if x is not None:
+                x.close()
+
+    with atomic_open(str(done_marker)) as f:
+        f.write(url + "\n")
+    journal_path.unlink()
+    return target_dir
@@ -1,13 +1,31 @@
 import glob
 import json
+import logging
 import os
 from copy import deepcopy
 from pathlib import Path
 
-import soundfile as sf
-
-from chime_utils.dgen.utils import get_mappings
+from chime_utils.dgen.audio_index import AudioIndex
+from chime_utils.dgen.utils import (
+    SessionCache,
+    atomic_open,
+    atomic_symlink,
+    get_mappings,
+    get_mappings_file,
+    map_sessions,
+)
 from chime_utils.text_norm import get_txt_norm
+from chime_utils.text_norm.cache import DEFAULT_CACHE_SIZE
+from chime_utils.text_norm.disk_cache import normalizer_version
+
+logging.basicConfig(
+    format=(
+        "%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d]" " %(message)s"
+    ),
+    datefmt="%Y-%m-%d:%H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
 
 devices2type = {
     "CH01": "lavaliere",
@@ -43,6 +61,8 @@ def gen_mixer6(
     corpus_dir,
     dset_part="train_call,train_intv,dev",
     challenge="chime8",
+    jobs=1,
+    incremental=False,
 ):
     """
     :param output_dir: Pathlike,
@@ -59,12 +79,22 @@ def gen_mixer6(
     :param challenge: str, choose between chime7 and chime8, it controls the
         choice of the text normalization and possibly how sessions are split
         between dev and eval.
+    :param jobs: int, number of sessions generated in parallel.
+    :param incremental: bool, whether to regenerate only the sessions whose
+        inputs changed since the last run in output_dir (see SessionCache).
     """
     corpus_dir = Path(corpus_dir).resolve()  # allow for relative path
     mapping = get_mappings(challenge)
     spk_map = mapping["spk_map"]["mixer6"]
     sess_map = mapping["sessions_map"]["mixer6"]
-    scoring_txt_normalization = get_txt_norm(challenge)
+    scoring_txt_normalization = get_txt_norm(challenge, DEFAULT_CACHE_SIZE)
+    sessions = SessionCache(
+        output_dir,
+        incremental,
+        static=[challenge, normalizer_version(scoring_txt_normalization)],
+        static_files=[__file__, get_mappings_file(challenge)],
+    )
+    audio_index = AudioIndex(output_dir)
 
     def normalize_mixer6(annotation, txt_normalizer):
         annotation_scoring = []
@@ -77,6 +107,13 @@ def gen_mixer6(
             # if empty remove segment from scoring
         return annotation, annotation_scoring
 
+    def link_name(split, tgt_sess_name, c_audio):
+        # name of the symlink of c_audio, None if it is not used in split
+        channel_num = int(Path(c_audio).stem.split("_")[-1].strip("CH"))
+        if channel_num <= 3 and split == "eval":
+            return None
+        return "{}_CH{:02d}".format(tgt_sess_name, channel_num)
+
     def create_audio_symlinks(
         split,
         tgt_sess_name,
@@ -88,12 +125,11 @@ def gen_mixer6(
         # we also create a JSON that describes each device
         devices_json = {}
         for c_audio in audios:
-            audioname = Path(c_audio).stem
-            channel_num = int(audioname.split("_")[-1].strip("CH"))
-            if channel_num <= 3 and split == "eval":
+            new_name = link_name(split, tgt_sess_name, c_audio)
+            if new_name is None:
                 continue
-            new_name = "{}_CH{:02d}".format(tgt_sess_name, channel_num)
-            os.symlink(
+            channel_num = int(Path(c_audio).stem.split("_")[-1].strip("CH"))
+            atomic_symlink(
                 c_audio,
                 os.path.join(output_dir, "audio", split, new_name + ".flac"),
             )
@@ -120,7 +156,7 @@ def gen_mixer6(
         devices_json = dict(
             sorted(devices_json.items(), key=lambda x: int(x[0].strip("CH")))
         )
-        with open(out_json, "w") as f:
+        with atomic_open(out_json) as f:
             json.dump(devices_json, f, indent=4)
 
     splits = dset_part.split(",")
@@ -144,10 +180,10 @@ def gen_mixer6(
     for c_split in splits:
         assert c_split in ["train_intv", "train_call", "dev", "eval"]
         Path(os.path.join(output_dir, "audio", c_split)).mkdir(
-            parents=True, exist_ok=False
+            parents=True, exist_ok=True
         )
         Path(os.path.join(output_dir, "transcriptions", c_split)).mkdir(
-            parents=True, exist_ok=False
+            parents=True, exist_ok=True
         )
         Path(os.path.join(output_dir, "transcriptions_scoring", c_split)).mkdir(
             parents=True, exist_ok=True
@@ -167,8 +203,8 @@ def gen_mixer6(
             list_file = os.path.join(corpus_dir, "splits", "test.list")
 
         sess2subintv = read_list_file(list_file)
-        to_uem = []
-        for j_file in ann_json:
+
+        def gen_session(j_file):
             with open(j_file, "r") as f:
                 annotation = json.load(f)
             sess_name = Path(j_file).stem
@@ -195,24 +231,22 @@ def gen_mixer6(
                 spk_map[subject],
             )
 
-            with open(
+            with atomic_open(
                 os.path.join(
                     output_dir,
                     "transcriptions",
                     c_split,
                     sess_map[sess_name] + ".json",
-                ),
-                "w",
+                )
             ) as f:
                 json.dump(annotation, f, indent=4)
-            with open(
+            with atomic_open(
                 os.path.join(
                     output_dir,
                     "transcriptions_scoring",
                     c_split,
                     sess_map[sess_name] + ".json",
-                ),
-                "w",
+                )
             ) as f:
                 json.dump(annotation_scoring, f, indent=4)
             # dump uem too for dev only
@@ -228,20 +262,57 @@ def gen_mixer6(
                     "{:.3f}".format(float(uem_start)),
                     "{:.3f}".format(float(uem_end)),
                 )
-                to_uem.append(c_uem)
+                return c_uem
             elif c_split == "eval":
                 uem_start = 0
-                uem_end = max([sf.SoundFile(x).frames for x in sess2audio[sess_name]])
+                uem_end = max(x.frames for x in audio_index.info(sess2audio[sess_name]))
                 c_uem = "{} 1 {} {}\n".format(
                     sess_map[sess_name],
                     "{:.3f}".format(float(uem_start)),
                     "{:.3f}".format(float(uem_end / 16000)),
                 )
-                to_uem.append(c_uem)
+                return c_uem
 
+        def gen_session_if_changed(j_file):
+            sess_name = Path(j_file).stem
+            return sessions.run(
+                f"{c_split}/{sess_name}",
+                lambda: gen_session(j_file),
+                annotations=[j_file, list_file],
+                audio=sess2audio[sess_name],
+                extra=[c_split],
+                outputs=[
+                    os.path.join(output_dir, x, c_split, sess_map[sess_name] + ".json")
+                    for x in ["devices", "transcriptions", "transcriptions_scoring"]
+                ]
+                + [
+                    os.path.join(output_dir, "audio", c_split, name + ".flac")
+                    for name in [
+                        link_name(c_split, sess_map[sess_name], x)
+                        for x in sess2audio[sess_name]
+                    ]
+                    if name is not None
+                ],
+            )
+
+        # only dev and eval sessions have an UEM
+        try:
+            to_uem = [
+                x
+                for x in map_sessions(gen_session_if_changed, ann_json, jobs)
+                if x is not None
+            ]
+        finally:
+            sessions.save()
+            audio_index.save()
         if len(to_uem) > 0:
             assert c_split in ["dev", "eval"]  # uem only for development set
-            Path(os.path.join(output_dir, "uem", c_split)).mkdir(parents=True)
+            Path(os.path.join(output_dir, "uem", c_split)).mkdir(
+                parents=True, exist_ok=True
+            )
             to_uem = sorted(to_uem)
-            with open(os.path.join(output_dir, "uem", c_split, "all.uem"), "w") as f:
+            with atomic_open(os.path.join(output_dir, "uem", c_split, "all.uem")) as f:
                 f.writelines(to_uem)
+    logger.info(
+        "Mixer 6 text normalization cache: " f"{scoring_txt_normalization.cache_info()}"
+    )
@@ -5,11 +5,19 @@ import os
 from copy import deepcopy
 from pathlib import Path
 
-import soundfile as sf
-
+from chime_utils.dgen.audio_index import AudioIndex
 from chime_utils.dgen.azure_storage import download_meeting_subset
-from chime_utils.dgen.utils import get_mappings
+from chime_utils.dgen.utils import (
+    SessionCache,
+    atomic_open,
+    atomic_symlink,
+    get_mappings,
+    get_mappings_file,
+    map_sessions,
+)
 from chime_utils.text_norm import get_txt_norm
+from chime_utils.text_norm.cache import DEFAULT_CACHE_SIZE, CachedNormalizer
+from chime_utils.text_norm.disk_cache import normalizer_version
 
 logging.basicConfig(
     format=(
@@ -23,10 +31,17 @@ logger = logging.getLogger(__name__)
 NOTSOFAR1_FS = 16000
 
 
+# dset_part -> (subset name, version) of the meetings in the Azure storage
+NOTSOFAR1_SUBSETS = {"dev": ("dev_set", "240121_dev")}
+
+
 def download_notsofar1(download_dir, subset_name):
-    if subset_name == "dev":
-        subset_name = "dev_set"
-        version = "240121_dev"
+    if subset_name not in NOTSOFAR1_SUBSETS:
+        raise NotImplementedError(
+            f"NOTSOFAR1 {subset_name} can't be downloaded yet, "
+            f"choose between {list(NOTSOFAR1_SUBSETS.keys())}."
+        )
+    subset_name, version = NOTSOFAR1_SUBSETS[subset_name]
     dev_meetings_dir = download_meeting_subset(
         subset_name=subset_name, version=version, destination_dir=str(download_dir)
     )
@@ -36,9 +51,69 @@ def download_notsofar1(download_dir, subset_name):
     return os.path.join(download_dir, subset_name, version, "MTG")
 
 
+def normalize_word_timing(word_timing, word_normalization):
+    """
+    Normalizes each word of a NOTSOFAR1 word_timing list ([word, start, end])
+    on its own, so a cache on word_normalization makes the cost grow with
+    the vocabulary size rather than the number of tokens.
+    Note that this is not the same as normalizing the whole segment,
+    as replacements spanning several words (e.g. "wi fi") do not apply.
+    Words removed by the normalization are dropped and words expanded to
+    several ones (e.g. "don't" -> "do not") evenly split their interval.
+    All times are formatted with millisecond precision.
+    """
+    output = []
+    for word, start, end in word_timing:
+        tokens = word_normalization(word).split()
+        step = (float(end) - float(start)) / max(len(tokens), 1)
+        for i, token in enumerate(tokens):
+            c_end = (
+                float(end) if i == len(tokens) - 1 else float(start) + (i + 1) * step
+            )
+            output.append(
+                [
+                    token,
+                    "{:.3f}".format(float(start) + i * step),
+                    "{:.3f}".format(c_end),
+                ]
+            )
+    return output
+
+
+def audio_links(c_split, audio_dir, session_name, output_root):
+    """
+    :return: list of (audio file, symbolic link in the output) of the far-field
+        channels of a device and, except for eval, of the close-talk audio.
+    """
+    output_audio_f = os.path.join(output_root, "audio", c_split)
+    links = []
+    for elem in glob.glob(os.path.join(audio_dir, "*.wav")):
+        filename = Path(elem).stem
+        tgt_name = "{}_U01.CH{}.wav".format(session_name, int(filename.strip("ch")) + 1)
+        links.append((elem, os.path.join(output_audio_f, tgt_name)))
+    if c_split.startswith("eval"):
+        return links  # no close talk
+    for elem in glob.glob(os.path.join(Path(audio_dir).parent, "close_talk", "*.wav")):
+        filename = Path(elem).stem
+        tgt_name = "{}_P{:02d}.wav".format(session_name, int(filename.split("_")[-1]))
+        links.append((elem, os.path.join(output_audio_f, tgt_name)))
+    return links
+
+
 def convert2chime(
-    c_split, audio_dir, session_name, spk_map, txt_normalization, output_root
+    c_split,
+    audio_dir,
+    session_name,
+    spk_map,
+    txt_normalization,
+    output_root,
+    word_normalization=None,
 ):
+    """
+    :param word_normalization: Callable, if not None the word_timing of each
+        segment is normalized word by word with it and kept in the
+        scoring transcriptions (see normalize_word_timing).
+    """
     output_audio_f = os.path.join(output_root, "audio", c_split)
 
     os.makedirs(output_audio_f, exist_ok=True)
@@ -48,28 +123,11 @@ def convert2chime(
     output_txt_f_norm = os.path.join(output_root, "transcriptions_scoring", c_split)
     os.makedirs(output_txt_f_norm, exist_ok=True)
 
-    far_field_audio = glob.glob(os.path.join(audio_dir, "*.wav"))
-    for elem in far_field_audio:
-        # create symbolic link
-        filename = Path(elem).stem
-        tgt_name = os.path.join(
-            output_audio_f,
-            "{}_U01.CH{}.wav".format(session_name, int(filename.strip("ch")) + 1),
-        )
-        os.symlink(elem, tgt_name)
+    for elem, tgt_name in audio_links(c_split, audio_dir, session_name, output_root):
+        atomic_symlink(elem, tgt_name)
 
     if c_split.startswith("eval"):
         return  # no close talk and transcriptions
-    close_talk_audio = glob.glob(
-        os.path.join(Path(audio_dir).parent, "close_talk", "*.wav")
-    )
-    for elem in close_talk_audio:
-        filename = Path(elem).stem
-        tgt_name = os.path.join(
-            output_audio_f,
-            "{}_P{:02d}.wav".format(session_name, int(filename.split("_")[-1])),
-        )
-        os.symlink(elem, tgt_name)
 
     # load now transcription JSON and make some modifications
     with open(os.path.join(Path(audio_dir).parent, "gt_transcription.json"), "r") as f:
@@ -96,38 +154,75 @@ def convert2chime(
         if len(c_copy["words"]) == 0:
             continue
 
-        del c_copy["word_timing"]
+        if word_normalization is None:
+            del c_copy["word_timing"]
+        else:
+            c_copy["word_timing"] = normalize_word_timing(
+                c_copy["word_timing"], word_normalization
+            )
         del c_copy["ct_wav_file_name"]
         output_normalized.append(c_copy)
 
     output = sorted(output, key=lambda x: float(x["start_time"]))
     output_normalized = sorted(output_normalized, key=lambda x: float(x["start_time"]))
 
-    with open(os.path.join(output_txt_f, f"{session_name}.json"), "w") as f:
+    with atomic_open(os.path.join(output_txt_f, f"{session_name}.json")) as f:
         json.dump(output, f, indent=4)
 
-    with open(os.path.join(output_txt_f_norm, f"{session_name}.json"), "w") as f:
+    with atomic_open(os.path.join(output_txt_f_norm, f"{session_name}.json")) as f:
         json.dump(output_normalized, f, indent=4)
 
 
 def gen_notsofar1(
-    output_dir, corpus_dir, download=False, dset_part="dev", challenge="chime8"
+    output_dir,
+    corpus_dir,
+    download=False,
+    dset_part="dev",
+    challenge="chime8",
+    word_timing=False,
+    jobs=1,
+    incremental=False,
 ):
+    """
+    :param output_dir: Pathlike, the path of the dir to storage the final dataset
+        (note that we will use symbolic links to the original dataset where
+        possible to minimize storage requirements).
+    :param corpus_dir: Pathlike, the original path to NOTSOFAR1 root folder.
+    :param download: bool, whether to download the dataset or not (you may have
+        it already in storage).
+    :param dset_part: str, choose between 'train', 'dev', 'public_eval', 'eval'.
+    :param challenge: str, it controls the choice of the text normalization.
+    :param word_timing: bool, whether to keep word-level timings in the scoring
+        transcriptions, normalized word by word.
+    :param jobs: int, number of sessions generated in parallel.
+    :param incremental: bool, whether to regenerate only the meetings whose
+        inputs changed since the last run in output_dir (see SessionCache).
+    """
     corpus_dir = Path(corpus_dir).resolve()  # allow for relative path
     mapping = get_mappings(challenge)
     spk_map = mapping["spk_map"]["notsofar1"]
     sess_map = mapping["sessions_map"]["notsofar1"]
-    text_normalization = get_txt_norm(challenge)
+    text_normalization = get_txt_norm(challenge, DEFAULT_CACHE_SIZE)
+    # vocabulary is small, cache all word types
+    word_normalization = (
+        CachedNormalizer(get_txt_norm(challenge), maxsize=None) if word_timing else None
+    )
 
     if download:
         corpus_dir = download_notsofar1(corpus_dir, subset_name=dset_part)
     else:
-        if dset_part == "dev":
-            subset_name = "dev_set"
-            version = "240121_dev"
+        if dset_part in NOTSOFAR1_SUBSETS:
+            subset_name, version = NOTSOFAR1_SUBSETS[dset_part]
             corpus_dir = os.path.join(corpus_dir, subset_name, version, "MTG")
 
     Path(output_dir).mkdir(parents=True, exist_ok=True)
+    sessions = SessionCache(
+        output_dir,
+        incremental,
+        static=[challenge, normalizer_version(text_normalization)],
+        static_files=[__file__, get_mappings_file(challenge)],
+    )
+    audio_index = AudioIndex(output_dir)
     # we fetch the
     device_jsons = glob.glob(
         os.path.join(corpus_dir, "**/devices.json"), recursive=True
@@ -141,8 +236,9 @@ def gen_notsofar1(
 
     uem_file = os.path.join(output_dir, "uem", dset_part, "all.uem")
     Path(uem_file).parent.mkdir(parents=True, exist_ok=True)
-    uem_data = []
-    for device_j in device_jsons:
+
+    def mc_sessions(device_j):
+        # (device folder, session name) of each multichannel device
         orig_sess_name = Path(device_j).parent.stem
 
         with open(device_j, "r") as f:
@@ -154,6 +250,7 @@ def gen_notsofar1(
             if x["is_close_talk"] is False and x["is_mc"] is True
         ]
 
+        out = []
         for mc_device in mc_devices:
             device_folder = os.path.join(
                 Path(device_j).parent, f"mc_{mc_device['device_name']}"
@@ -165,7 +262,12 @@ def gen_notsofar1(
                 )
                 continue
             device_name = mc_device["device_name"]
-            sess_name = sess_map[f"{orig_sess_name}_{device_name}_mc"]
+            out.append((device_folder, sess_map[f"{orig_sess_name}_{device_name}_mc"]))
+        return out
+
+    def gen_session(device_j):
+        c_uem = []
+        for device_folder, sess_name in mc_sessions(device_j):
             convert2chime(
                 dset_part,
                 device_folder,
@@ -173,20 +275,62 @@ def gen_notsofar1(
                 spk_map,
                 text_normalization,
                 output_dir,
+                word_normalization,
             )
 
             # use close talk audio files to get UEM
             ct_audio = glob.glob(
                 os.path.join(Path(device_j).parent, "close_talk", "*.wav")
             )[0]
-            info = sf.SoundFile(ct_audio)
+            info = audio_index.get(ct_audio)
             c_duration = info.frames / NOTSOFAR1_FS
-            uem_data.append(
+            c_uem.append(
                 "{} 1 {} {}\n".format(
                     sess_name,
                     "{:.3f}".format(float(0.0)),
                     "{:.3f}".format(float(c_duration)),
                 )
             )
-    with open(uem_file, "w") as f:
+        return c_uem
+
+    def gen_session_if_changed(device_j):
+        meeting_dir = Path(device_j).parent
+        outputs = [
+            x
+            for device_folder, sess_name in mc_sessions(device_j)
+            for _, x in audio_links(dset_part, device_folder, sess_name, output_dir)
+        ]
+        if not dset_part.startswith("eval"):
+            outputs += [
+                os.path.join(output_dir, x, dset_part, f"{sess_name}.json")
+                for _, sess_name in mc_sessions(device_j)
+                for x in ["transcriptions", "transcriptions_scoring"]
+            ]
+        return sessions.run(
+            f"{dset_part}/{meeting_dir.stem}",
+            lambda: gen_session(device_j),
+            annotations=glob.glob(
+                os.path.join(meeting_dir, "**/*.json"), recursive=True
+            ),
+            audio=glob.glob(os.path.join(meeting_dir, "**/*.wav"), recursive=True),
+            extra=[dset_part, word_timing],
+            outputs=outputs,
+        )
+
+    uem_data = []
+    try:
+        for c_uem in map_sessions(gen_session_if_changed, device_jsons, jobs):
+            uem_data.extend(c_uem)
+    finally:
+        sessions.save()
+        audio_index.save()
+    with atomic_open(uem_file) as f:
         f.writelines(uem_data)
+    logger.info(
+        f"NOTSOFAR1 text normalization cache: {text_normalization.cache_info()}"
+    )
+    if word_normalization is not None:
+        logger.info(
+            "NOTSOFAR1 word-level normalization cache: "
+            f"{word_normalization.cache_info()}"
+        )
@@ -0,0 +1,282 @@
+"""
+Repacking of the microphone arrays of generated DASR data into
+multichannel audio files.
+dgen only symlinks the original recordings, where each array channel is a
+separate mono file (e.g. S02_U01.CH1.wav ... S02_U01.CH4.wav), so reading
+a multi-device segment opens and seeks in every one of them.
+Here the channels are interleaved in one file per array
+(e.g. S02_U01.flac) or per session (S02_mdm.wav), written to a new
+output folder with the same layout as the generated data: close-talk and
+other non-array audio, transcriptions and UEMs are symbolic links to the
+generated ones, and the device JSONs describe the packed devices,
+with the original name of each of their channels in order.
+"""
+
+import glob
+import json
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+
+from chime_utils.dgen.audio_index import AudioInfo
+from chime_utils.dgen.utils import (
+    SessionCache,
+    atomic_open,
+    atomic_symlink,
+    map_sessions,
+)
+
+logging.basicConfig(
+    format=(
+        "%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d]" " %(message)s"
+    ),
+    datefmt="%Y-%m-%d:%H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+# device name of the array channels, e.g. U01.CH1
+ARRAY_CHANNEL = re.compile(r"^(U\d+)\.CH(\d+)$")
+SESSION_DEVICE = "mdm"
+BLOCK_FRAMES = 1 << 18
+MAX_FLAC_CHANNELS = 8
+_SAMPLE_BYTES = {"PCM_S8": 1, "PCM_U8": 1, "PCM_16": 2, "PCM_24": 3, "DOUBLE": 8}
+
+
+def pack_channels(inputs: List[str], output: str, audio_format: str = "flac"):
+    """
+    Writes all the channels of the audio files `inputs`, in order,
+    interleaved in one file. Inputs shorter than the longest one are padded
+    with zeros, they must all have the same sampling rate.
+    The subtype (e.g. PCM_16) of the first input is kept if the format
+    supports it and WAV files too large for it are written as RF64.
+
+    :param inputs: list of Pathlike, mono or multichannel audio files.
+    :param output: Pathlike, packed audio file, written atomically.
+    :param audio_format: str, 'flac' (at most 8 channels) or 'wav'.
+    :return: AudioInfo of the packed file.
+    """
+    files = [sf.SoundFile(str(x)) for x in inputs]
+    try:
+        samplerate = files[0].samplerate
+        if any(x.samplerate != samplerate for x in files):
+            raise ValueError(f"Can't pack {inputs}, sampling rates are different.")
+        channels = sum(x.channels for x in files)
+        frames = max(x.frames for x in files)
+        if any(x.frames != frames for x in files):
+            logger.warning(
+                f"{output}: inputs have different lengths, "
+                f"padding them with zeros to {frames} frames."
+            )
+        audio_format = audio_format.upper()
+        if audio_format == "FLAC" and channels > MAX_FLAC_CHANNELS:
+            raise ValueError(
+                f"Can't write {channels} channels to {output}, FLAC supports at "
+                f"most {MAX_FLAC_CHANNELS}, use wav instead."
+            )
+        subtype = files[0].subtype
+        size = frames * channels * _SAMPLE_BYTES.get(subtype, 4)
+        if audio_format == "WAV" and size >= (1 << 32) - (1 << 16):
+            audio_format = "RF64"
+        if not sf.check_format(audio_format, subtype):
+            subtype = sf.default_subtype(audio_format)
+        dtype = "float64" if subtype in ["FLOAT", "DOUBLE"] else "int32"
+        block = np.zeros((min(BLOCK_FRAMES, frames), channels), dtype=dtype)
+        with atomic_open(output, "wb") as f, sf.SoundFile(
+            f, "w", samplerate, channels, subtype, format=audio_format
+        ) as out:
+            for start in range(0, frames, BLOCK_FRAMES):
+                n_frames = min(BLOCK_FRAMES, frames - start)
+                channel = 0
+                for x in files:
+                    data = x.read(n_frames, dtype=dtype, always_2d=True)
+                    block[: len(data), channel : channel + x.channels] = data
+                    block[len(data) : n_frames, channel : channel + x.channels] = 0
+                    channel += x.channels
+                out.write(block[:n_frames])
+        return AudioInfo(frames, samplerate, channels, subtype)
+    finally:
+        for x in files:
+            x.close()
+
+
+def group_array_channels(
+    audio_files: List[str], per: str = "array"
+) -> Tuple[Dict[Tuple[str, str], List[Tuple[str, str]]], List[str]]:
+    """
+    Groups the array channels of a split by array or by session.
+
+    :param audio_files: list of Pathlike, audio files named
+        <session>_<device>.wav (or .flac) as in the generated data.
+    :param per: str, 'array' or 'session'.
+    :return: dict mapping (session, packed device name) to the list of
+        (device name, path) of its channels in order, and the list of
+        the other audio files.
+    """
+    groups = {}
+    others = []
+    for x in audio_files:
+        session, device = Path(x).stem.rsplit("_", 1)
+        match = ARRAY_CHANNEL.match(device)
+        if match is None:
+            others.append(x)
+            continue
+        array, channel = match.group(1), int(match.group(2))
+        packed = array if per == "array" else SESSION_DEVICE
+        groups.setdefault((session, packed), []).append(((array, channel), device, x))
+    groups = {
+        k: [(device, x) for _, device, x in sorted(v)]
+        for k, v in sorted(groups.items())
+    }
+    return groups, sorted(others)
+
+
+def _packed_devices(devices_json, packed):
+    # device entries of the session with the packed arrays instead of
+    # their channels, the type of an array is the one of its channels
+    # without the channel name (e.g. kinect_array_CH1_mic -> kinect_array_mic)
+    out = {}
+    channels = {device: name for name, v in packed.items() for device, _ in v[1]}
+    types = {}
+    for k, v in devices_json.items():
+        # DiPCo keys also have the session name or a leading '_'
+        device = next((x for x in channels if k.endswith(x)), None)
+        if device is None:
+            out[k] = v
+        elif "device_type" in v:
+            types.setdefault(channels[device], re.sub(r"_CH\d+", "", v["device_type"]))
+    for name, (info, c_channels) in packed.items():
+        out[name] = {
+            "is_close_talk": False,
+            "speaker": None,
+            "num_channels": info.channels,
+            "device_type": types.get(name, "array_mic"),
+            "channels": [device for device, _ in c_channels],
+        }
+    return dict(sorted(out.items(), key=lambda x: x[0]))
+
+
+def repack_multichannel(
+    data_dir,
+    output_dir,
+    dset_part: Optional[str] = None,
+    per: str = "array",
+    audio_format: Optional[str] = None,
+    jobs: int = 1,
+    incremental: bool = False,
+):
+    """
+    :param data_dir: Pathlike, a corpus folder generated by dgen
+        (e.g. chime8_dasr/chime6).
+    :param output_dir: Pathlike, where the repacked corpus is written.
+    :param dset_part: str, which splits to repack, e.g. 'train,dev',
+        by default all the ones in data_dir.
+    :param per: str, 'array' for one file per array, or 'session' for one
+        file per session with all its arrays (named <session>_mdm).
+    :param audio_format: str, 'flac' or 'wav', by default flac for arrays
+        and wav for sessions (FLAC supports at most 8 channels).
+    :param jobs: int, number of sessions repacked in parallel.
+    :param incremental: bool, whether to repack only the sessions whose
+        inputs changed since the last run in output_dir (see SessionCache).
+    """
+    if per not in ["array", "session"]:
+        raise ValueError(f"per must be 'array' or 'session', not {per}.")
+    if audio_format is None:
+        audio_format = "flac" if per == "array" else "wav"
+    if audio_format not in ["flac", "wav"]:
+        raise ValueError(f"audio_format must be 'flac' or 'wav', not {audio_format}.")
+    data_dir = Path(data_dir).resolve()
+    if dset_part is None:
+        splits = sorted(x.name for x in (data_dir / "audio").iterdir() if x.is_dir())
+    else:
+        splits = dset_part.split(",")
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    sessions = SessionCache(output_dir, incremental, static_files=[__file__])
+
+    for split in splits:
+        for x in [
+            "audio",
+            "devices",
+            "transcriptions",
+            "transcriptions_scoring",
+            "uem",
+        ]:
+            Path(os.path.join(output_dir, x, split)).mkdir(parents=True, exist_ok=True)
+        # annotations are not changed
+        for x in ["transcriptions", "transcriptions_scoring", "uem"]:
+            for c_file in glob.glob(os.path.join(data_dir, x, split, "*")):
+                atomic_symlink(
+                    os.path.realpath(c_file),
+                    os.path.join(output_dir, x, split, Path(c_file).name),
+                )
+
+        audio_files = glob.glob(os.path.join(data_dir, "audio", split, "*.wav"))
+        audio_files += glob.glob(os.path.join(data_dir, "audio", split, "*.flac"))
+        groups, others = group_array_channels(audio_files, per)
+        for x in others:
+            atomic_symlink(
+                os.path.realpath(x),
+                os.path.join(output_dir, "audio", split, Path(x).name),
+            )
+        sess2groups = {}
+        for (session, packed), channels in groups.items():
+            sess2groups.setdefault(session, {})[packed] = channels
+        for x in glob.glob(os.path.join(data_dir, "devices", split, "*.json")):
+            if Path(x).stem not in sess2groups:
+                # no array to pack (e.g. Mixer 6)
+                atomic_symlink(
+                    os.path.realpath(x),
+                    os.path.join(output_dir, "devices", split, Path(x).name),
+                )
+
+        def repack_session(session):
+            packed = {}
+            for name, channels in sess2groups[session].items():
+                info = pack_channels(
+                    [x for _, x in channels],
+                    os.path.join(
+                        output_dir, "audio", split, f"{session}_{name}.{audio_format}"
+                    ),
+                    audio_format,
+                )
+                packed[name] = (info, channels)
+            devices_file = os.path.join(data_dir, "devices", split, f"{session}.json")
+            devices_json = {}
+            if os.path.exists(devices_file):
+                with open(devices_file, "r") as f:
+                    devices_json = json.load(f)
+            with atomic_open(
+                os.path.join(output_dir, "devices", split, f"{session}.json")
+            ) as f:
+                json.dump(_packed_devices(devices_json, packed), f, indent=4)
+
+        def repack_session_if_changed(session):
+            devices_file = os.path.join(data_dir, "devices", split, f"{session}.json")
+            return sessions.run(
+                f"{split}/{session}",
+                lambda: repack_session(session),
+                annotations=[devices_file] if os.path.exists(devices_file) else [],
+                audio=[x for v in sess2groups[session].values() for _, x in v],
+                extra=[per, audio_format],
+                outputs=[
+                    os.path.join(
+                        output_dir, "audio", split, f"{session}_{x}.{audio_format}"
+                    )
+                    for x in sess2groups[session]
+                ]
+                + [os.path.join(output_dir, "devices", split, f"{session}.json")],
+            )
+
+        try:
+            map_sessions(repack_session_if_changed, sorted(sess2groups), jobs)
+        finally:
+            sessions.save()
+        logger.info(
+            f"Repacked {len(groups)} {'arrays' if per == 'array' else 'sessions'} "
+            f"of {split} in {output_dir}."
+        )
@@ -0,0 +1,330 @@
+"""
+Export of the annotated segments of generated DASR data as sharded tar
+archives, for training without seeking into long recordings.
+Each segment is cut from the audio of a device of its session and stored
+as <key>.flac, followed by <key>.json with its session, speaker, times
+and transcriptions (raw and normalized for scoring), as expected by
+streaming data loaders such as WebDataset:
+
+    <output_dir>/<split>/shard-000000.tar
+        S03_P01_0000050_0000125.flac
+        S03_P01_0000050_0000125.json
+        ...
+    <output_dir>/<split>/shards.json
+
+Segments are cut in parallel for each session into a staging folder next
+to the shards, then shuffled across all sessions of the split (with a
+fixed seed) and written sequentially in shards of about `shard_size` bytes,
+so the output does not depend on the number of jobs.
+"""
+
+import glob
+import io
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import tarfile
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+import soundfile as sf
+
+from chime_utils.dgen.utils import atomic_open, map_sessions
+
+logging.basicConfig(
+    format=(
+        "%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d]" " %(message)s"
+    ),
+    datefmt="%Y-%m-%d:%H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHARD_SIZE = 512 << 20
+IHM_DEVICE = "ihm"
+_BLOCK = tarfile.BLOCKSIZE
+
+
+class Utterance(NamedTuple):
+    key: str
+    audio: str  # staged FLAC file
+    size: int
+    metadata: dict
+
+
+def _tar_size(size: int) -> int:
+    # header and content padded to whole blocks
+    return _BLOCK + -(-size // _BLOCK) * _BLOCK
+
+
+def _find_audio(data_dir, split, name) -> Optional[str]:
+    for ext in ["wav", "flac"]:
+        path = os.path.join(data_dir, "audio", split, f"{name}.{ext}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _number_free(name: str) -> str:
+    # device names without leading zeros, e.g. CH01 -> CH1
+    return re.sub(r"\d+", lambda x: str(int(x.group())), name).lstrip("_")
+
+
+def close_talk_audio(data_dir, split: str, session: str) -> Dict[str, str]:
+    """
+    Finds the close-talk microphone of each speaker of a session from its
+    device JSON (devices/<split>/<session>.json), whose keys are not always
+    the device part of the audio file names, e.g. P01 for S02_P01.wav in
+    CHiME-6 but CH1 for <session>_CH01.flac in Mixer 6.
+
+    :param data_dir: Pathlike, a corpus folder generated by dgen.
+    :param split: str, e.g. 'train'.
+    :param session: str, session name.
+    :return: dict mapping each speaker to the name of its audio file
+        (without extension), the first one if the speaker has several.
+    """
+    devices_file = os.path.join(data_dir, "devices", split, f"{session}.json")
+    if not os.path.exists(devices_file):
+        return {}
+    with open(devices_file, "r") as f:
+        devices = json.load(f)
+    names = {}
+    for ext in ["wav", "flac"]:
+        for x in glob.glob(
+            os.path.join(data_dir, "audio", split, f"{session}_*.{ext}")
+        ):
+            name = Path(x).stem
+            names[_number_free(name[len(session) + 1 :])] = name
+            names[_number_free(name)] = name
+    out = {}
+    for k, v in sorted(devices.items()):
+        if v.get("is_close_talk") and v.get("speaker") is not None:
+            name = names.get(_number_free(k))
+            if name is not None:
+                out.setdefault(v["speaker"], name)
+    return out
+
+
+def cut_session(
+    data_dir, split: str, session: str, staging_dir: str, device: str = IHM_DEVICE
+) -> List[Utterance]:
+    """
+    Cuts all the segments of `session` from the audio of `device` and
+    writes them as FLAC files in `staging_dir`.
+
+    :param data_dir: Pathlike, a corpus folder generated by dgen.
+    :param split: str, e.g. 'train'.
+    :param session: str, session name.
+    :param staging_dir: Pathlike, where the FLAC files are written.
+    :param device: str, device name (e.g. U01.CH1, or U01 for data repacked
+        with repack_multichannel) or 'ihm' for the close-talk microphone of
+        the speaker of each segment (see close_talk_audio, or the
+        <session>_<speaker> audio file if the device JSON has none).
+    :return: the list of cut segments, by start time.
+    """
+    with open(os.path.join(data_dir, "transcriptions", split, f"{session}.json")) as f:
+        annotation = json.load(f)
+    normalized = {}
+    scoring_file = os.path.join(
+        data_dir, "transcriptions_scoring", split, f"{session}.json"
+    )
+    if os.path.exists(scoring_file):
+        with open(scoring_file) as f:
+            for x in json.load(f):
+                normalized[(x["speaker"], x["start_time"], x["end_time"])] = x["words"]
+
+    annotation = sorted(annotation, key=lambda x: float(x["start_time"]))
+    out = []
+    keys = set()
+    files = {}
+    close_talk = {}
+    if device == IHM_DEVICE:
+        close_talk = close_talk_audio(data_dir, split, session)
+    try:
+        for x in annotation:
+            if device == IHM_DEVICE:
+                name = close_talk.get(x["speaker"], f"{session}_{x['speaker']}")
+            else:
+                name = f"{session}_{device}"
+            if name not in files:
+                path = _find_audio(data_dir, split, name)
+                files[name] = None if path is None else sf.SoundFile(path)
+                if path is None:
+                    logger.warning(
+                        f"No {name} audio in {split}, skipping its segments."
+                    )
+            audio = files[name]
+            if audio is None:
+                continue
+            start = round(float(x["start_time"]) * audio.samplerate)
+            end = min(round(float(x["end_time"]) * audio.samplerate), audio.frames)
+            key = "{}_{}_{:07d}_{:07d}".format(
+                session,
+                x["speaker"],
+                round(float(x["start_time"]) * 100),
+                round(float(x["end_time"]) * 100),
+            )
+            if end <= start or key in keys:
+                logger.warning(f"Skipping empty or duplicate segment {key}.")
+                continue
+            keys.add(key)
+            audio.seek(start)
+            data = audio.read(end - start, dtype="int32", always_2d=True)
+            subtype = audio.subtype
+            if not sf.check_format("FLAC", subtype):
+                subtype = "PCM_16"
+            staged = os.path.join(staging_dir, f"{key}.flac")
+            sf.write(staged, data, audio.samplerate, subtype, format="FLAC")
+            metadata = {
+                "session_id": session,
+                "speaker": x["speaker"],
+                "start_time": x["start_time"],
+                "end_time": x["end_time"],
+                "words": x["words"],
+                "words_normalized": normalized.get(
+                    (x["speaker"], x["start_time"], x["end_time"]), ""
+                ),
+                "device": device,
+                "split": split,
+            }
+            out.append(Utterance(key, staged, os.path.getsize(staged), metadata))
+    finally:
+        for x in files.values():
+            if x is not None:
+                x.close()
+    return out
+
+
+def _add_member(tar, name: str, f, size: int):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = 0
+    tar.addfile(info, f)
+
+
+def write_shard(path: str, utterances: List[Utterance]):
+    """
+    Writes `utterances` (audio and JSON sidecar of each one) in the
+    tar archive `path`, atomically.
+    """
+    with atomic_open(path, "wb") as f, tarfile.open(fileobj=f, mode="w") as tar:
+        for x in utterances:
+            with open(x.audio, "rb") as audio:
+                _add_member(tar, f"{x.key}.flac", audio, x.size)
+            metadata = json.dumps(x.metadata, indent=4).encode("utf-8")
+            _add_member(tar, f"{x.key}.json", io.BytesIO(metadata), len(metadata))
+
+
+def assign_shards(
+    utterances: List[Utterance], shard_size: int
+) -> List[List[Utterance]]:
+    """
+    Splits `utterances` (in order) in consecutive shards whose tar archive
+    is at most `shard_size` bytes, unless a single utterance is larger.
+    """
+    shards = [[]]
+    size = 2 * _BLOCK  # end of archive
+    for x in utterances:
+        c_size = _tar_size(x.size) + _tar_size(len(json.dumps(x.metadata, indent=4)))
+        # tarfile pads the archive to whole records
+        total = -(-(size + c_size) // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+        if len(shards[-1]) > 0 and total > shard_size:
+            shards.append([])
+            size = 2 * _BLOCK
+        shards[-1].append(x)
+        size += c_size
+    return [x for x in shards if len(x) > 0]
+
+
+def export_shards(
+    data_dir,
+    output_dir,
+    dset_part: Optional[str] = None,
+    device: str = IHM_DEVICE,
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    seed: int = 0,
+    jobs: int = 1,
+) -> Dict[str, List[str]]:
+    """
+    :param data_dir: Pathlike, a corpus folder generated by dgen
+        (e.g. chime8_dasr/chime6).
+    :param output_dir: Pathlike, where the shards are written,
+        in one subfolder for each split.
+    :param dset_part: str, which splits to export, e.g. 'train,dev',
+        by default all the ones in data_dir.
+    :param device: str, which audio the segments are cut from, 'ihm' for
+        the close-talk microphone of each speaker or a device name,
+        e.g. U01.CH1 (see cut_session).
+    :param shard_size: int, target size of each shard in bytes.
+    :param seed: int, seed of the shuffling of the segments.
+    :param jobs: int, number of sessions cut (and shards written) in parallel.
+    :return: dict mapping each split to the paths of its shards.
+    :raises RuntimeError: if no segment of a split has audio of `device`.
+    """
+    data_dir = Path(data_dir).resolve()
+    if dset_part is None:
+        splits = sorted(
+            x.name for x in (data_dir / "transcriptions").iterdir() if x.is_dir()
+        )
+    else:
+        splits = dset_part.split(",")
+
+    out = {}
+    for split in splits:
+        sessions = sorted(
+            Path(x).stem
+            for x in glob.glob(
+                os.path.join(data_dir, "transcriptions", split, "*.json")
+            )
+        )
+        split_dir = os.path.join(output_dir, split)
+        staging_dir = os.path.join(split_dir, ".staging")
+        if os.path.exists(staging_dir):
+            shutil.rmtree(staging_dir)  # left by an interrupted run
+        Path(staging_dir).mkdir(parents=True)
+        for x in glob.glob(os.path.join(split_dir, "shard-*.tar")):
+            os.remove(x)
+        try:
+            utterances = [
+                x
+                for c_utterances in map_sessions(
+                    lambda s: cut_session(data_dir, split, s, staging_dir, device),
+                    sessions,
+                    jobs,
+                )
+                for x in c_utterances
+            ]
+            if len(utterances) == 0:
+                raise RuntimeError(
+                    f"No segment of {split} could be cut from the {device} audio "
+                    f"in {data_dir}."
+                )
+            random.Random(seed).shuffle(utterances)
+            shards = assign_shards(utterances, shard_size)
+            paths = [
+                os.path.join(split_dir, f"shard-{i:06d}.tar")
+                for i in range(len(shards))
+            ]
+            map_sessions(lambda x: write_shard(*x), list(zip(paths, shards)), jobs)
+        finally:
+            shutil.rmtree(staging_dir)
+
+        with atomic_open(os.path.join(split_dir, "shards.json")) as f:
+            json.dump(
+                [
+                    {"path": Path(p).name, "num_utterances": len(s)}
+                    for p, s in zip(paths, shards)
+                ],
+                f,
+                indent=4,
+            )
+        logger.info(
+            f"Exported {len(utterances)} segments of {split} "
+            f"in {len(paths)} shards in {split_dir}."
+        )
+        out[split] = paths
+    return out
@@ -1,11 +1,32 @@
-import glob
 import hashlib
 import json
 import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
-import tqdm
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+from chime_utils.dgen.checksum import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_JOBS,
+    MANIFEST_VERSION,
+    DigestCache,
+    Manifest,
+    ManifestEntry,
+    create_manifest,
+    hash_file,
+    hash_files,
+    load_manifest,
+    save_manifest,
+    scan_tree,
+    verify_files,
+)
 
 logging.basicConfig(
     format=(
@@ -17,12 +38,202 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def map_sessions(fn, items, jobs=1):
+    """
+    Applies `fn` to each element of `items` with a pool of `jobs` threads
+    (serially if jobs <= 1) and returns the results in the order of `items`,
+    so that anything merged from them does not depend on `jobs`.
+    Per-session work is mostly waiting on file system metadata
+    (JSON loads, symlinks, audio headers), so threads are enough to overlap it.
+    """
+    if jobs <= 1:
+        return [fn(x) for x in items]
+    with ThreadPoolExecutor(jobs) as executor:
+        return list(executor.map(fn, items))
+
+
+def _tmp_path(path):
+    # unique per process and thread, next to path so os.replace is atomic
+    return f"{path}.tmp{os.getpid()}_{threading.get_ident()}"
+
+
+@contextmanager
+def atomic_open(path, mode="w"):
+    """
+    Opens a temporary file next to `path` for writing, which replaces
+    `path` only once it has been completely written.
+    """
+    tmp = _tmp_path(path)
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive lock for updating `path` (a lock on its folder, so nothing is
+    left behind) across processes and threads, e.g. for read-modify-write
+    updates of a shared JSON file. Does nothing where fcntl is not available.
+    """
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # releases the lock
+
+
+def atomic_symlink(src, dst):
+    """
+    Creates (or replaces) the `dst` symbolic link to `src`.
+    """
+    tmp = _tmp_path(dst)
+    os.symlink(src, tmp)
+    os.replace(tmp, dst)
+
+
+class SessionCache:
+    """
+    Keeps track of the inputs each generated session was made from, so that
+    re-running a generation script only regenerates the sessions whose
+    inputs changed.
+    The fingerprint of a session is made of the content of its annotation
+    files, the path, size and mtime of its audio files, the challenge
+    mapping, the text normalizer version and the generation code.
+    Records are stored in `.dgen_sessions.json` in the output directory,
+    together with the value returned for the session (e.g. its UEM line).
+    Several generations can share the output directory (e.g. the splits
+    of a corpus generated concurrently), save only updates their own records.
+
+    :param output_dir: Pathlike, output directory of the corpus.
+    :param enabled: bool, if False every session is generated
+        and nothing is stored.
+    :param static: list of str, describe what all sessions depend on.
+    :param static_files: list of Pathlike, files all sessions depend on.
+    """
+
+    FILENAME = ".dgen_sessions.json"
+
+    def __init__(self, output_dir, enabled=True, static=(), static_files=()):
+        self.enabled = enabled
+        self.path = os.path.join(output_dir, self.FILENAME)
+        self.lock = threading.Lock()
+        self.records = self._load() if enabled else {}
+        self.updated = set()
+        h = hashlib.sha1()
+        for x in static:
+            h.update(str(x).encode("utf-8") + b"\0")
+        for x in static_files:
+            with open(x, "rb") as f:
+                h.update(f.read())
+        self.static = h.hexdigest()
+        self.generated = 0
+        self.skipped = 0
+
+    def fingerprint(self, annotations, audio, extra=()):
+        h = hashlib.sha1(self.static.encode("utf-8"))
+        for x in extra:
+            h.update(str(x).encode("utf-8") + b"\0")
+        for x in sorted(annotations):
+            with open(x, "rb") as f:
+                h.update(f.read())
+        for x in sorted(audio):
+            stat = os.stat(x)
+            h.update(f"{x} {stat.st_size} {stat.st_mtime_ns}\n".encode("utf-8"))
+        return h.hexdigest()
+
+    def run(self, key, fn, annotations=(), audio=(), extra=(), outputs=()):
+        """
+        Returns fn(), or what it returned last time if the fingerprint of the
+        session did not change and all its `outputs` still exist (symbolic
+        links included, as long as they are not dangling).
+
+        :param key: str, unique name of the session (e.g. split/session).
+        :param fn: Callable, generates the session.
+        :param annotations: list of Pathlike, read in full for the fingerprint.
+        :param audio: list of Pathlike, only their size and mtime are used.
+        :param extra: list of str, anything else the session depends on.
+        :param outputs: list of Pathlike, files the session generates.
+        """
+        if not self.enabled:
+            return fn()
+        fingerprint = self.fingerprint(annotations, audio, extra)
+        with self.lock:
+            record = self.records.get(key)
+        if (
+            record is not None
+            and record["fingerprint"] == fingerprint
+            and all(os.path.exists(x) for x in outputs)
+        ):
+            with self.lock:
+                self.skipped += 1
+            return record["result"]
+        result = fn()
+        with self.lock:
+            self.records[key] = {"fingerprint": fingerprint, "result": result}
+            self.updated.add(key)
+            self.generated += 1
+        return result
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def save(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            logger.info(
+                f"{self.generated} sessions generated, "
+                f"{self.skipped} unchanged sessions skipped."
+            )
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            with file_lock(self.path):
+                # records written meanwhile by other generations are kept
+                records = self._load()
+                records.update({k: self.records[k] for k in self.updated})
+                with atomic_open(self.path) as f:
+                    json.dump(records, f, indent=4, sort_keys=True)
+            self.records = records
+            self.updated = set()
+
+
 def md5_file(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    return hash_file(fname, "md5")
+
+
+def sidecar_file(root_folder, algo):
+    # hidden, so that it is not checked itself
+    return os.path.join(root_folder, f".dgen_checksum_{algo}.json")
+
+
+def _files_to_check(all_files, manifest, has_eval, forgive_missing):
+    # decide what to check before hashing anything
+    if not has_eval:
+        all_files = [
+            x
+            for x in all_files
+            if os.path.basename(os.path.dirname(x.relpath)) != "eval"
+        ]
+    unknown = [x.relpath for x in all_files if x.relpath not in manifest.entries]
+    if len(unknown) > 0:
+        if not forgive_missing:
+            raise KeyError(
+                f"{len(unknown)} files not in JSON {manifest.algo} checksum file: "
+                + ", ".join(unknown)
+            )
+        all_files = [x for x in all_files if x.relpath in manifest.entries]
+    return all_files
 
 
 def data_check(
@@ -31,6 +242,13 @@ def data_check(
     input_json=None,
     forgive_missing=False,
     create=False,
+    jobs=DEFAULT_JOBS,
+    full_check=False,
+    manifest_version=1,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    algo="md5",
+    sidecar_json=None,
+    create_sidecar=False,
 ):
     """
     :param root_folder: Pathlike, path to the root folder
@@ -38,63 +256,117 @@ def data_check(
     :param has_eval: bool, if you want to check integrity also
             of eval set (released later for some scenarios).
     :param input_json: Pathlike, path to the JSON file containing
-        the MD5 hash for each file.
+        the MD5 hash for each file, legacy or version 2 manifest
+        (see chime_utils.dgen.checksum).
         If not provided it uses the default from organizers.
-    :param input_json:
+    :param forgive_missing: bool, whether to skip files that are not in
+        the JSON file instead of failing.
     :param create: bool, organizer only, used to compute MD5 hashes.
+    :param jobs: int, number of files hashed in parallel.
+    :param full_check: bool, whether to hash every file again, by default
+        files whose size, mtime and inode did not change since the last check
+        reuse the digest stored in root_folder/.dgen_checksum_cache.json.
+    :param manifest_version: int, with create, 1 for the legacy format or 2
+        to store also the size and the digest of each chunk of the files.
+    :param chunk_size: int, with create and manifest_version 2,
+        size of the chunks in bytes.
+    :param algo: str, hashing algorithm, the official check is 'md5', any
+        other (e.g. the much faster 'blake2b') checks the data against the
+        sidecar manifest made with create_sidecar.
+    :param sidecar_json: Pathlike, manifest for algo other than md5,
+        by default .dgen_checksum_<algo>.json in root_folder.
+    :param create_sidecar: bool, whether to check the data with MD5 and,
+        if it is correct, write its sidecar manifest with algo.
     """
     if input_json is None:
         input_json = os.path.join(os.path.dirname(__file__), "chime8_dasr_md5.json")
+    if sidecar_json is None:
+        sidecar_json = sidecar_file(root_folder, algo)
+    if algo == "md5" and create_sidecar:
+        raise ValueError("The sidecar manifest is for a faster algorithm than md5.")
+    if algo != "md5" and create:
+        raise ValueError("Official checksum files use md5, see create_sidecar.")
 
-    open_option = "w" if create else "r"
+    all_files = scan_tree(root_folder, [".json", ".uem", ".wav", ".flac"])
+    cache_file = os.path.join(root_folder, DigestCache.FILENAME)
+    md5_cache = DigestCache(cache_file, "md5")
+    if full_check:
+        md5_cache.entries = {}
 
-    with open(input_json, open_option) as f:
-        input_json = json.load(f)
+    if create:
+        logger.info(f"Creating {input_json} MD5 Checksum file.")
+        # published digests are never taken from the cache, only refresh it
+        if manifest_version == 1:
+            digests = hash_files(all_files, "md5", jobs)
+            manifest = Manifest({k: ManifestEntry(v) for k, v in digests.items()})
+        else:
+            manifest = create_manifest(all_files, "md5", chunk_size, jobs)
+            digests = {k: v.digest for k, v in manifest.entries.items()}
+        md5_cache.update(all_files, digests)
+        md5_cache.save()
+        save_manifest(manifest, input_json)
+        return
 
-    all_files = []
-    for ext in [".json", ".uem", ".wav", ".flac"]:
-        all_files.extend(
-            glob.glob(os.path.join(root_folder, "**/*{}".format(ext)), recursive=True)
+    if algo == "md5" or create_sidecar:
+        manifest = load_manifest(input_json)
+        if manifest.algo != "md5":
+            raise ValueError(f"{input_json} is not an MD5 checksum file.")
+        cache = md5_cache
+    else:
+        if not os.path.exists(sidecar_json):
+            raise FileNotFoundError(
+                f"No {algo} manifest in {sidecar_json}, create it with "
+                "create_sidecar (--create-sidecar) after a successful MD5 check."
+            )
+        manifest = load_manifest(sidecar_json)
+        if manifest.algo != algo:
+            raise ValueError(f"{sidecar_json} is not a {algo} checksum file.")
+        cache = DigestCache(cache_file, algo)
+        if full_check:
+            cache.entries = {}
+
+    all_files = _files_to_check(all_files, manifest, has_eval, forgive_missing)
+    sidecar = None
+    if create_sidecar:
+        # hashed with algo while checking MD5, in the same read of each file
+        sidecar = Manifest({}, algo, chunk_size, MANIFEST_VERSION)
+    errors = verify_files(all_files, manifest, jobs, cache, sidecar)
+    cache.save()
+    for k, v in errors.items():
+        logger.error(f"{k}: {v}.")
+    if len(errors) > 0:
+        raise RuntimeError(
+            "{} Checksum for {} files is not the same: {}. "
+            "Data has not been generated correctly. "
+            "You can retry to generate it or re-download it. "
+            "If this does not work, please reach us. ".format(
+                manifest.algo.upper(),
+                len(errors),
+                ", ".join(f"{k} ({v})" for k, v in errors.items()),
+            )
         )
+    logger.info(
+        f"Checked {len(all_files)} files, all {manifest.algo.upper()} "
+        "checksums are correct."
+    )
 
-    if create:
-        logger.info(f"Creating {input_json} MD5 Checksum file.")
-        output = {}
-        for f in tqdm.tqdm(all_files):
-            digest = md5_file(f)
-            relpath = str(Path(f).relative_to(root_folder))
-            output[relpath] = digest
+    if create_sidecar:
+        logger.info(f"Creating {sidecar_json} {algo} checksum file.")
+        save_manifest(sidecar, sidecar_json)
+        algo_cache = DigestCache(cache_file, algo)
+        algo_cache.update(all_files, {k: v.digest for k, v in sidecar.entries.items()})
+        algo_cache.save()
 
-        with open(input_json, "w") as f:
-            json.dump(output, f, indent=4)
 
-    else:
-        for f in tqdm.tqdm(all_files):
-            digest = md5_file(f)
-            if not has_eval and Path(f).parent.stem == "eval":
-                continue
-
-            c_rel_path = str(Path(f).relative_to(root_folder))
-            if c_rel_path not in input_json.keys():
-                if not forgive_missing:
-                    raise KeyError(f"{c_rel_path} not in JSON md5 checksum file.")
-                else:
-                    continue
-
-            if not input_json[c_rel_path] == digest:
-                raise RuntimeError(
-                    "MD5 Checksum for {} is not the same. "
-                    "Data has not been generated correctly. "
-                    "You can retry to generate it or re-download it. "
-                    "If this does not work, please reach us. ".format(
-                        str(Path(f).relative_to(root_folder))
-                    )
-                )
+def get_mappings_file(challenge):
+    if challenge == "chime8":
+        return os.path.join(os.path.dirname(__file__), "c8map.json")
+    raise NotImplementedError
 
 
 def get_mappings(challenge):
     if challenge == "chime8":
-        json_mapping_file = os.path.join(os.path.dirname(__file__), "c8map.json")
+        json_mapping_file = get_mappings_file(challenge)
         with open(json_mapping_file, "r") as f:
             mapping = json.load(f)
     else:
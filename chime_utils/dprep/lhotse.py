@@ -12,13 +12,15 @@ from collections import defaultdict
 from pathlib import Path
 from typing import Dict, Optional, Union
 
-import soundfile as sf
 from lhotse import fix_manifests, validate_recordings_and_supervisions
 from lhotse.audio import AudioSource, Recording, RecordingSet
 from lhotse.supervision import SupervisionSegment, SupervisionSet
 from lhotse.utils import Pathlike, add_durations
 
+from chime_utils.dgen.audio_index import AudioIndex
+from chime_utils.dgen.repack import SESSION_DEVICE
 from chime_utils.text_norm import get_txt_norm
+from chime_utils.text_norm.cache import DEFAULT_CACHE_SIZE
 
 logging.basicConfig(
     format=(
@@ -35,6 +37,65 @@ DIPCO_FS = 16000
 MIXER6_FS = 16000
 
 
+def _array_sources(
+    corpus_dir: Pathlike,
+    dset_part: str,
+    session: str,
+    discard: Optional[str] = None,
+):
+    """
+    Returns the AudioSources of the array microphones of a session, either
+    one mono file for each channel (e.g. S02_U01.CH1.wav) as generated by
+    dgen, or multichannel files (e.g. S02_U01.flac or S02_mdm.wav) repacked
+    with repack_multichannel, whose number of channels is in the device JSON.
+    :param corpus_dir: Pathlike, the path of the generated dataset.
+    :param dset_part: str, the dataset partition (e.g. dev).
+    :param session: str, the session name.
+    :param discard: str, optional name of an array to leave out (e.g. U05).
+    :return: list of AudioSource, with consecutive channels in the order
+        of the audio file names.
+    """
+    devices_file = os.path.join(corpus_dir, "devices", dset_part, f"{session}.json")
+    devices = {}
+    if os.path.exists(devices_file):
+        with open(devices_file, "r") as f:
+            devices = json.load(f)
+    audio_paths = sorted(
+        Path(x)
+        for name in ["U*", SESSION_DEVICE]
+        for ext in ["wav", "flac"]
+        for x in glob.glob(
+            os.path.join(corpus_dir, "audio", dset_part, f"{session}_{name}.{ext}")
+        )
+    )
+    sources = []
+    offset = 0
+    for audio_path in audio_paths:
+        device = audio_path.stem[len(session) + 1 :]
+        channels = devices.get(device, {}).get("channels", [device])
+        if discard is not None and device.startswith(discard):
+            continue
+        if discard is not None and any(x.startswith(discard) for x in channels):
+            logger.warning(
+                f"Can't discard {discard} in session {session}, it is packed "
+                f"with other arrays in {audio_path}."
+            )
+        num_channels = devices.get(device, {}).get("num_channels", len(channels))
+        sources.append(
+            AudioSource(
+                type="file",
+                channels=list(range(offset, offset + num_channels)),
+                source=str(audio_path),
+            )
+        )
+        offset += num_channels
+    if len(sources) == 0:
+        raise FileNotFoundError(
+            f"No array audio found for session {session} in {dset_part} set."
+        )
+    return sources
+
+
 def prepare_chime6(
     corpus_dir: Pathlike,
     output_dir: Optional[Pathlike] = None,
@@ -70,7 +131,9 @@ def prepare_chime6(
         ("train", "dev" and "eval"), and the
         value is Dicts with the keys 'recordings' and 'supervisions'.
     """
-    txt_normalizer = get_txt_norm(txt_norm)
+    txt_normalizer = get_txt_norm(txt_norm, DEFAULT_CACHE_SIZE)
+    # headers indexed by dgen in the same folder are not read again
+    audio_index = AudioIndex(corpus_dir)
     assert mic in ["ihm", "mdm"], "mic must be either 'ihm' or 'mdm'."
     transcriptions_dir = (
         os.path.join(corpus_dir, "transcriptions_scoring")
@@ -94,17 +157,21 @@ def prepare_chime6(
     supervisions = []
     # First we create the recordings
     if mic == "ihm":
+        sess2audio = {}
         for session in all_sessions:
-            audio_paths = [
+            sess2audio[session] = [
                 Path(x)
                 for x in glob.glob(
                     os.path.join(corpus_dir, "audio", dset_part, f"{session}_P*.wav")
                 )
             ]
-            if len(audio_paths) == 0:
+            if len(sess2audio[session]) == 0:
                 raise FileNotFoundError(
                     f"No audio found for session {session} in {dset_part} set."
                 )
+        # headers not indexed yet are read in parallel
+        infos = audio_index.info(x[0] for x in sess2audio.values())
+        for (session, audio_paths), audio_sf in zip(sess2audio.items(), infos):
             sources = []
             # NOTE: Each headset microphone is binaural in CHiME-6
             for idx, audio_path in enumerate(audio_paths):
@@ -113,7 +180,6 @@ def prepare_chime6(
                     AudioSource(type="file", channels=channels, source=str(audio_path))
                 )
                 spk_id = audio_path.stem.split("_")[1]
-                audio_sf = sf.SoundFile(str(audio_paths[0]))
                 recordings.append(
                     Recording(
                         id=session + f"_{spk_id}",
@@ -124,34 +190,21 @@ def prepare_chime6(
                     )
                 )
     else:
-        for session in all_sessions:
-            audio_paths = [
-                Path(x)
-                for x in glob.glob(
-                    os.path.join(corpus_dir, "audio", dset_part, f"{session}_U*.wav")
-                )
-            ]
-            # discard some problematic arrays because their
-            # files length is a lot different and causes GSS to fail
-            if discard_problematic and session == "S12":
-                audio_paths = [
-                    x for x in audio_paths if not Path(x).stem.startswith("S12_U05")
-                ]
-            elif discard_problematic and session == "S24":
-                audio_paths = [
-                    x for x in audio_paths if not Path(x).stem.startswith("S24_U06")
-                ]
-            elif discard_problematic and session == "S18":
-                audio_paths = [
-                    x for x in audio_paths if not Path(x).stem.startswith("S18_U06")
-                ]
-            sources = []
-            for idx, audio_path in enumerate(sorted(audio_paths)):
-                sources.append(
-                    AudioSource(type="file", channels=[idx], source=str(audio_path))
-                )
-
-            audio_sf = sf.SoundFile(str(audio_paths[0]))
+        # discard some problematic arrays because their
+        # files length is a lot different and causes GSS to fail
+        problematic = {"S12": "U05", "S24": "U06", "S18": "U06"}
+        sess2sources = {
+            session: _array_sources(
+                corpus_dir,
+                dset_part,
+                session,
+                problematic.get(session) if discard_problematic else None,
+            )
+            for session in all_sessions
+        }
+        # headers not indexed yet are read in parallel
+        infos = audio_index.info(x[0].source for x in sess2sources.values())
+        for (session, sources), audio_sf in zip(sess2sources.items(), infos):
             recordings.append(
                 Recording(
                     id=session,
@@ -218,6 +271,7 @@ def prepare_chime6(
     )
     if txt_normalizer is not None:
         supervision_set = supervision_set.transform_text(txt_normalizer)
+        logger.info(f"Text normalization cache: {txt_normalizer.cache_info()}")
     # Fix manifests
     validate_recordings_and_supervisions(recording_set, supervision_set)
 
@@ -228,6 +282,7 @@ def prepare_chime6(
         recording_set.to_file(
             os.path.join(output_dir, f"chime6-{mic}_recordings_{dset_part}.jsonl.gz")
         )
+    audio_index.save()
     manifests[dset_part] = {
         "recordings": recording_set,
         "supervisions": supervision_set,
@@ -265,7 +320,8 @@ def prepare_dipco(
         value is Dicts with the keys 'recordings' and 'supervisions'.
     """
 
-    txt_normalizer = get_txt_norm(txt_norm)
+    txt_normalizer = get_txt_norm(txt_norm, DEFAULT_CACHE_SIZE)
+    audio_index = AudioIndex(corpus_dir)
     assert mic in ["ihm", "mdm"], "mic must be one of 'ihm' or 'mdm'"
     transcriptions_dir = (
         os.path.join(corpus_dir, "transcriptions_scoring")
@@ -287,44 +343,35 @@ def prepare_dipco(
     supervisions = []
     # First we create the recordings
     if mic == "ihm":
-        for session in all_sessions:
-            audio_paths = [
-                Path(x)
-                for x in glob.glob(
-                    os.path.join(corpus_dir, "audio", dset_part, f"{session}_P*.wav")
-                )
-            ]
-            # sources = []
-            for idx, audio_path in enumerate(audio_paths):
-                sources = [
-                    AudioSource(type="file", channels=[0], source=str(audio_path))
-                ]
-                spk_id = audio_path.stem.split("_")[1]
-                audio_sf = sf.SoundFile(str(audio_path))
-                recordings.append(
-                    Recording(
-                        id=session + "_{}".format(spk_id),
-                        sources=sources,
-                        sampling_rate=int(audio_sf.samplerate),
-                        num_samples=audio_sf.frames,
-                        duration=audio_sf.frames / audio_sf.samplerate,
-                    )
+        sess_audio = [
+            (session, Path(x))
+            for session in all_sessions
+            for x in glob.glob(
+                os.path.join(corpus_dir, "audio", dset_part, f"{session}_P*.wav")
+            )
+        ]
+        # headers not indexed yet are read in parallel
+        infos = audio_index.info(x for _, x in sess_audio)
+        for (session, audio_path), audio_sf in zip(sess_audio, infos):
+            sources = [AudioSource(type="file", channels=[0], source=str(audio_path))]
+            spk_id = audio_path.stem.split("_")[1]
+            recordings.append(
+                Recording(
+                    id=session + "_{}".format(spk_id),
+                    sources=sources,
+                    sampling_rate=int(audio_sf.samplerate),
+                    num_samples=audio_sf.frames,
+                    duration=audio_sf.frames / audio_sf.samplerate,
                 )
+            )
     else:
-        for session in all_sessions:
-            audio_paths = [
-                Path(x)
-                for x in glob.glob(
-                    os.path.join(corpus_dir, "audio", dset_part, f"{session}_U*.wav")
-                )
-            ]
-            sources = []
-            for idx, audio_path in enumerate(sorted(audio_paths)):
-                sources.append(
-                    AudioSource(type="file", channels=[idx], source=str(audio_path))
-                )
-
-            audio_sf = sf.SoundFile(str(audio_paths[0]))
+        sess2sources = {
+            session: _array_sources(corpus_dir, dset_part, session)
+            for session in all_sessions
+        }
+        # headers not indexed yet are read in parallel
+        infos = audio_index.info(x[0].source for x in sess2sources.values())
+        for (session, sources), audio_sf in zip(sess2sources.items(), infos):
             recordings.append(
                 Recording(
                     id=session,
@@ -373,6 +420,7 @@ def prepare_dipco(
     # Fix manifests
     if txt_normalizer is not None:
         supervision_set = supervision_set.transform_text(txt_normalizer)
+        logger.info(f"Text normalization cache: {txt_normalizer.cache_info()}")
     validate_recordings_and_supervisions(recording_set, supervision_set)
     if output_dir is not None:
         supervision_set.to_file(
@@ -382,6 +430,7 @@ def prepare_dipco(
             os.path.join(output_dir, f"dipco-{mic}_recordings_{dset_part}.jsonl.gz")
         )
 
+    audio_index.save()
     manifests[dset_part] = {
         "recordings": recording_set,
         "supervisions": supervision_set,
@@ -413,7 +462,8 @@ def prepare_mixer6(
     ("train", "dev" and "eval"), and the
         value is Dicts with the keys 'recordings' and 'supervisions'.
     """
-    txt_normalizer = get_txt_norm(txt_norm)
+    txt_normalizer = get_txt_norm(txt_norm, DEFAULT_CACHE_SIZE)
+    audio_index = AudioIndex(corpus_dir)
     assert mic in ["ihm", "mdm"], "mic must be one of 'ihm' or 'mdm'"
     if mic == "ihm":
         assert dset_part in [
@@ -448,22 +498,19 @@ def prepare_mixer6(
         else:
             sess2audio[sess_name].append(audio_f)
 
-    recordings = []
-    supervisions = []
+    sess2current = {}
     for sess in all_sessions:
-        with open(os.path.join(transcriptions_dir, dset_part, f"{sess}.json")) as f:
-            transcript = json.load(f)
         if mic == "ihm":
             if dset_part.startswith("train"):
                 if mic == "ihm" and dset_part.startswith("train"):
-                    current_sess_audio = [
+                    sess2current[sess] = [
                         x
                         for x in sess2audio[sess]
                         if Path(x).stem.split("_")[-1] in ["CH02"]
                     ]  # only interview and call
 
             elif dset_part == "dev":
-                current_sess_audio = [
+                sess2current[sess] = [
                     x
                     for x in sess2audio[sess]
                     if Path(x).stem.split("_")[-1] in ["CH02", "CH01"]
@@ -472,7 +519,7 @@ def prepare_mixer6(
                 raise NotImplementedError("No close-talk mics for eval set")
 
         elif mic == "mdm":
-            current_sess_audio = [
+            sess2current[sess] = [
                 x
                 for x in sess2audio[sess]
                 if Path(x).stem.split("_")[-1] not in ["CH01", "CH02", "CH03"]
@@ -480,12 +527,20 @@ def prepare_mixer6(
         else:
             raise NotImplementedError
 
+    # headers not indexed yet are read in parallel
+    infos = audio_index.info(sess2current[x][0] for x in all_sessions)
+
+    recordings = []
+    supervisions = []
+    for sess, audio_sf in zip(all_sessions, infos):
+        with open(os.path.join(transcriptions_dir, dset_part, f"{sess}.json")) as f:
+            transcript = json.load(f)
+        current_sess_audio = sess2current[sess]
         # recordings here
         sources = [
             AudioSource(type="file", channels=[idx], source=str(audio_path))
             for idx, audio_path in enumerate(current_sess_audio)
         ]
-        audio_sf = sf.SoundFile(str(current_sess_audio[0]))
         recordings.append(
             Recording(
                 id=f"{sess}-{dset_part}-{mic}",
@@ -541,6 +596,7 @@ def prepare_mixer6(
 
     if txt_normalizer is not None:
         supervision_set = supervision_set.transform_text(txt_normalizer)
+        logger.info(f"Text normalization cache: {txt_normalizer.cache_info()}")
     # Fix manifests
     validate_recordings_and_supervisions(recording_set, supervision_set)
 
@@ -552,6 +608,7 @@ def prepare_mixer6(
             os.path.join(output_dir, f"mixer6-{mic}_recordings_{dset_part}.jsonl.gz")
         )
 
+    audio_index.save()
     manifests[dset_part] = {
         "recordings": recording_set,
         "supervisions": supervision_set,
@@ -586,7 +643,8 @@ def prepare_notsofar1(
         value is Dicts with the keys 'recordings' and 'supervisions'.
     """
 
-    txt_normalizer = get_txt_norm(txt_norm)
+    txt_normalizer = get_txt_norm(txt_norm, DEFAULT_CACHE_SIZE)
+    audio_index = AudioIndex(corpus_dir)
     assert mic in ["ihm", "mdm"], "mic must be one of 'ihm' or 'mdm'"
     transcriptions_dir = (
         os.path.join(corpus_dir, "transcriptions_scoring")
@@ -608,44 +666,35 @@ def prepare_notsofar1(
     supervisions = []
     # First we create the recordings
     if mic == "ihm":
-        for session in all_sessions:
-            audio_paths = [
-                Path(x)
-                for x in glob.glob(
-                    os.path.join(corpus_dir, "audio", dset_part, f"{session}_P*.wav")
-                )
-            ]
-            # sources = []
-            for idx, audio_path in enumerate(audio_paths):
-                sources = [
-                    AudioSource(type="file", channels=[0], source=str(audio_path))
-                ]
-                spk_id = audio_path.stem.split("_")[1]
-                audio_sf = sf.SoundFile(str(audio_path))
-                recordings.append(
-                    Recording(
-                        id=session + "_{}".format(spk_id),
-                        sources=sources,
-                        sampling_rate=int(audio_sf.samplerate),
-                        num_samples=audio_sf.frames,
-                        duration=audio_sf.frames / audio_sf.samplerate,
-                    )
+        sess_audio = [
+            (session, Path(x))
+            for session in all_sessions
+            for x in glob.glob(
+                os.path.join(corpus_dir, "audio", dset_part, f"{session}_P*.wav")
+            )
+        ]
+        # headers not indexed yet are read in parallel
+        infos = audio_index.info(x for _, x in sess_audio)
+        for (session, audio_path), audio_sf in zip(sess_audio, infos):
+            sources = [AudioSource(type="file", channels=[0], source=str(audio_path))]
+            spk_id = audio_path.stem.split("_")[1]
+            recordings.append(
+                Recording(
+                    id=session + "_{}".format(spk_id),
+                    sources=sources,
+                    sampling_rate=int(audio_sf.samplerate),
+                    num_samples=audio_sf.frames,
+                    duration=audio_sf.frames / audio_sf.samplerate,
                 )
+            )
     else:
-        for session in all_sessions:
-            audio_paths = [
-                Path(x)
-                for x in glob.glob(
-                    os.path.join(corpus_dir, "audio", dset_part, f"{session}_U*.wav")
-                )
-            ]
-            sources = []
-            for idx, audio_path in enumerate(sorted(audio_paths)):
-                sources.append(
-                    AudioSource(type="file", channels=[idx], source=str(audio_path))
-                )
-
-            audio_sf = sf.SoundFile(str(audio_paths[0]))
+        sess2sources = {
+            session: _array_sources(corpus_dir, dset_part, session)
+            for session in all_sessions
+        }
+        # headers not indexed yet are read in parallel
+        infos = audio_index.info(x[0].source for x in sess2sources.values())
+        for (session, sources), audio_sf in zip(sess2sources.items(), infos):
             recordings.append(
                 Recording(
                     id=session,
@@ -694,6 +743,7 @@ def prepare_notsofar1(
     # Fix manifests
     if txt_normalizer is not None:
         supervision_set = supervision_set.transform_text(txt_normalizer)
+        logger.info(f"Text normalization cache: {txt_normalizer.cache_info()}")
     validate_recordings_and_supervisions(recording_set, supervision_set)
     if output_dir is not None:
         supervision_set.to_file(
@@ -705,6 +755,7 @@ def prepare_notsofar1(
             os.path.join(output_dir, f"notsofar1-{mic}_recordings_{dset_part}.jsonl.gz")
         )
 
+    audio_index.save()
     manifests[dset_part] = {
         "recordings": recording_set,
         "supervisions": supervision_set,
@@ -8,6 +8,7 @@ from typing import Optional
 from lhotse.utils import Pathlike
 
 from chime_utils.text_norm import get_txt_norm
+from chime_utils.text_norm.cache import DEFAULT_CACHE_SIZE
 
 logging.basicConfig(
     format=(
@@ -59,7 +60,7 @@ def prepare_chime6(
     :return dict: Dict, see https://arxiv.org/pdf/2106.04624.pdf section
          4.2. Speechbrain JSON annotation format for long-form audio.
     """
-    txt_normalizer = get_txt_norm(txt_norm)
+    txt_normalizer = get_txt_norm(txt_norm, DEFAULT_CACHE_SIZE)
     assert mic in ["ihm", "mdm"], "mic must be either 'ihm' or 'mdm'."
 
     transcriptions_dir = (
@@ -1,16 +1,47 @@
-from chime_utils.text_norm.c7dasr import chime6_norm_scoring, chime7_norm_scoring
-from chime_utils.text_norm.whisper_like import EnglishTextNormalizer
+import importlib
 
+from chime_utils.text_norm.batch import iter_normalize, normalize_many
+from chime_utils.text_norm.cache import CachedNormalizer
+from chime_utils.text_norm.disk_cache import DiskCachedNormalizer
+from chime_utils.text_norm.registry import (
+    available_normalizers,
+    get_normalizer,
+    preload_normalizers,
+    register_normalizer,
+)
 
-def get_txt_norm(txt_norm):
-    assert txt_norm in ["chime6", "chime7", "chime8", None]
+# imported on first access, see registry.py
+_LAZY_ATTRIBUTES = {
+    "chime6_norm_scoring": "chime_utils.text_norm.c7dasr",
+    "chime7_norm_scoring": "chime_utils.text_norm.c7dasr",
+    "EnglishTextNormalizer": "chime_utils.text_norm.whisper_like",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_txt_norm(txt_norm, cache_size=0, cache_path=None):
+    """
+    :param txt_norm: str, which text normalization to use,
+        choose between 'chime6', 'chime7', 'chime8' or None.
+        The normalizer is built once per process and shared.
+    :param cache_size: int, if different from 0 the normalizer is wrapped
+        in a CachedNormalizer keeping up to this many utterances
+        (None for an unbounded cache).
+    :param cache_path: str, if not None the normalized utterances are also
+        stored in (and read from) this SQLite database, which persists
+        across runs, see DiskCachedNormalizer.
+    """
     if txt_norm is None:
         return None
-    elif txt_norm == "chime8":
-        return EnglishTextNormalizer()
-    elif txt_norm == "chime7":
-        return chime7_norm_scoring
-    elif txt_norm == "chime6":
-        return chime6_norm_scoring
-    else:
-        raise NotImplementedError
+    normalizer = get_normalizer(txt_norm)
+    if cache_path is not None:
+        normalizer = DiskCachedNormalizer(normalizer, cache_path)
+
+    if cache_size == 0:
+        return normalizer
+    return CachedNormalizer(normalizer, cache_size)
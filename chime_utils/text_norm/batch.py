@@ -0,0 +1,86 @@
+"""
+Batch text normalization, optionally spread over a pool of worker processes.
+"""
+
+import multiprocessing
+import os
+from collections import deque
+from functools import partial
+from typing import Iterable, Iterator, List, Optional
+
+from more_itertools import chunked
+
+from chime_utils.text_norm.registry import get_normalizer, preload_normalizers
+
+
+def _normalize_chunk(txt_norm: str, texts: List[str]) -> List[str]:
+    normalizer = get_normalizer(txt_norm)
+    normalized = {}
+    out = []
+    for text in texts:
+        c_norm = normalized.get(text)
+        if c_norm is None:
+            c_norm = normalizer(text)
+            normalized[text] = c_norm
+        out.append(c_norm)
+    return out
+
+
+def iter_normalize(
+    texts: Iterable[str],
+    norm: Optional[str] = "chime8",
+    workers: Optional[int] = None,
+    chunksize: int = 1024,
+) -> Iterator[str]:
+    """
+    Lazily normalizes `texts`, yielding the results in input order.
+    The input is consumed in chunks of `chunksize` and at most two chunks
+    per worker are in flight at any time, so arbitrarily long iterables
+    can be streamed.
+
+    :param texts: Iterable of str, the utterances to normalize.
+    :param norm: str, which text normalization to use,
+        choose between 'chime6', 'chime7', 'chime8' or None (no-op).
+    :param workers: int, number of worker processes,
+        defaults to the number of CPUs. With 1 or less everything
+        runs in the current process.
+    :param chunksize: int, number of utterances sent to a worker at once.
+    """
+    if norm is None:
+        yield from texts
+        return
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    normalize_chunk = partial(_normalize_chunk, norm)
+    chunks = chunked(texts, chunksize)
+    if workers <= 1:
+        for chunk in chunks:
+            yield from normalize_chunk(chunk)
+        return
+
+    # built here first so that forked workers inherit it
+    preload_normalizers([norm])
+    with multiprocessing.Pool(
+        workers, initializer=preload_normalizers, initargs=([norm],)
+    ) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(normalize_chunk, (chunk,)))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().get()
+        while len(pending) > 0:
+            yield from pending.popleft().get()
+
+
+def normalize_many(
+    texts: Iterable[str],
+    norm: Optional[str] = "chime8",
+    workers: Optional[int] = None,
+    chunksize: int = 1024,
+) -> List[str]:
+    """
+    Normalizes all `texts` and returns the results in input order,
+    see `iter_normalize` for the arguments.
+    """
+    return list(iter_normalize(texts, norm, workers, chunksize))
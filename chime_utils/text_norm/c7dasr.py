@@ -1,38 +1,40 @@
 """
 legacy CHiME-7 DASR and CHiME-6 text normalization.
+
+Self-contained version of lhotse `normalize_text_chime6(txt, normalize="kaldi")`
+followed by the jiwer pipelines used for scoring in CHiME-6 and CHiME-7,
+with the same output but without re-splitting the string at each step.
 """
 
-import jiwer
-from jiwer.transforms import RemoveKaldiNonWords
-from lhotse.recipes.chime6 import normalize_text_chime6
-
-jiwer_chime6_scoring = jiwer.Compose(
-    [
-        RemoveKaldiNonWords(),
-        jiwer.SubstituteRegexes(
-            {r"\"": " ", "^[ \t]+|[ \t]+$": "", r"\u2019": "'"}
-        ),  # noqa E501
-        jiwer.RemoveEmptyStrings(),
-        jiwer.RemoveMultipleSpaces(),
-    ]
-)
-jiwer_chime7_scoring = jiwer.Compose(
-    [
-        jiwer.SubstituteRegexes(
-            {
-                "(?:^|(?<= ))(hm|hmm|mhm|mmh|mmm)(?:(?= )|$)": "hmmm",
-                "(?:^|(?<= ))(uhm|um|umm|umh|ummh)(?:(?= )|$)": "ummm",
-                "(?:^|(?<= ))(uh|uhh)(?:(?= )|$)": "uhhh",
-            }
-        ),
-        jiwer.RemoveEmptyStrings(),
-        jiwer.RemoveMultipleSpaces(),
-    ]
-)
+import re
+
+_PUNCTUATION = str.maketrans("", "", ".?,:;!")
+_WHITESPACE_RE = re.compile(r"\s+")
+_INAUDIBLE_RE = re.compile(r"\[inaudible[- 0-9]*\]")
+_NON_WORDS_RE = re.compile(r"[<\[][^>\]]*[>\]]")
+
+# non-words sounds mapping, applied to whole words only
+_CHIME7_NON_WORDS = {
+    **{x: "hmmm" for x in ["hm", "hmm", "mhm", "mmh", "mmm"]},
+    **{x: "ummm" for x in ["uhm", "um", "umm", "umh", "ummh"]},
+    **{x: "uhhh" for x in ["uh", "uhh"]},
+}
 
 
 def chime6_norm_scoring(txt):
-    return jiwer_chime6_scoring(normalize_text_chime6(txt, normalize="kaldi"))
+    if "[redacted]" in txt:
+        return ""
+    # kaldi-style normalization from lhotse CHiME-6 recipe
+    txt = txt.lower().translate(_PUNCTUATION)
+    txt = _WHITESPACE_RE.sub(" ", txt)
+    txt = _INAUDIBLE_RE.sub("[inaudible]", txt)
+    txt = txt.replace(" - ", " ").replace("mm-", "mm")
+    # scoring: remove kaldi non-words, quotes and extra spaces.
+    # only single spaces are left after the whitespace substitution above,
+    # so stripping and collapsing spaces is a split and join.
+    txt = _NON_WORDS_RE.sub("", txt)
+    txt = txt.replace('"', " ").replace("’", "'")
+    return " ".join(word for word in txt.split(" ") if word)
 
 
 def chime7_norm_scoring(txt):
@@ -41,8 +43,7 @@ def chime7_norm_scoring(txt):
     you are free to use whatever normalization you prefer for training but this
     normalization below will be used when we score your submissions.
     """
-    return jiwer_chime7_scoring(
-        jiwer_chime6_scoring(
-            normalize_text_chime6(txt, normalize="kaldi")
-        )  # noqa: E731
-    )  # noqa: E731
+    return " ".join(
+        _CHIME7_NON_WORDS.get(word, word)
+        for word in chime6_norm_scoring(txt).split(" ")
+    )
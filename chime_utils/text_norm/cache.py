@@ -0,0 +1,91 @@
+"""
+Memoization for text normalizers.
+CHiME transcripts are highly repetitive (e.g. "yeah", "mhm", "okay") so
+the same utterance is normalized many times over a corpus.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Callable, NamedTuple, Optional
+
+DEFAULT_CACHE_SIZE = 2**16
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    maxsize: Optional[int]
+    currsize: int
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+class CachedNormalizer:
+    """
+    Wraps any text normalizer (e.g. one returned by `get_txt_norm`)
+    with a bounded least-recently-used cache.
+
+    :param normalizer: Callable, maps a string to its normalized version.
+    :param maxsize: int, maximum number of utterances kept in the cache,
+        the least recently used one is evicted first when it is full.
+        Use None for an unbounded cache and 0 to disable caching
+        (statistics are still collected).
+    """
+
+    def __init__(
+        self,
+        normalizer: Callable[[str], str],
+        maxsize: Optional[int] = DEFAULT_CACHE_SIZE,
+    ):
+        if maxsize is not None and maxsize < 0:
+            raise ValueError(f"maxsize must be None or >= 0, got {maxsize}.")
+        self.normalizer = normalizer
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __call__(self, s: str) -> str:
+        with self._lock:
+            out = self._cache.get(s)
+            if out is not None:
+                self._cache.move_to_end(s)
+                self._hits += 1
+                return out
+
+        out = self.normalizer(s)
+        with self._lock:
+            self._misses += 1
+            if self.maxsize != 0:
+                self._cache[s] = out
+                if self.maxsize is not None and len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+                    self._evictions += 1
+        return out
+
+    def cache_info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(
+                self._hits,
+                self._misses,
+                self._evictions,
+                self.maxsize,
+                len(self._cache),
+            )
+
+    def cache_clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+
+    def __reduce__(self):
+        # locks can't be pickled, worker processes start with an empty cache
+        return self.__class__, (self.normalizer, self.maxsize)
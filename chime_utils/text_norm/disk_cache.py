@@ -0,0 +1,240 @@
+"""
+Persistent on-disk memoization for text normalizers.
+Normalized utterances are stored in a SQLite database keyed by the
+normalizer identity, a hash of its source code and data files and the
+input text, so that re-running data preparation or scoring on the same
+transcripts skips the normalization altogether, while any change to the
+normalizer (code or english.json) invalidates its old entries.
+"""
+
+import functools
+import glob
+import hashlib
+import inspect
+import logging
+import os
+import sqlite3
+import threading
+import weakref
+from typing import Callable, Dict, Optional
+
+from chime_utils.text_norm.cache import CachedNormalizer, CacheInfo
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS normalized ("
+    "normalizer TEXT, version TEXT, input TEXT, output TEXT, "
+    "PRIMARY KEY (normalizer, version, input)) WITHOUT ROWID"
+)
+
+
+def _unwrap(normalizer):
+    while isinstance(normalizer, (CachedNormalizer, DiskCachedNormalizer)):
+        normalizer = normalizer.normalizer
+    return normalizer
+
+
+@functools.lru_cache(maxsize=None)
+def _hash_dir(directory: str) -> str:
+    h = hashlib.sha1()
+    for path in sorted(
+        glob.glob(os.path.join(directory, "*.py"))
+        + glob.glob(os.path.join(directory, "*.json"))
+    ):
+        h.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def normalizer_identity(normalizer: Callable[[str], str]) -> str:
+    """
+    Qualified name of the normalizer function or class, followed for
+    objects by their simple configuration attributes (e.g.
+    standardize_numbers for EnglishTextNormalizer).
+    """
+    normalizer = _unwrap(normalizer)
+    target = normalizer if inspect.isfunction(normalizer) else type(normalizer)
+    identity = f"{target.__module__}.{target.__qualname__}"
+    if target is not normalizer and hasattr(normalizer, "__dict__"):
+        config = []
+        for k, v in sorted(vars(normalizer).items()):
+            if isinstance(v, (bool, int, float, str)) or v is None:
+                config.append(f"{k}={v!r}")
+            elif not isinstance(v, (dict, list, tuple, set)):
+                config.append(f"{k}={type(v).__name__}")
+        identity += "(" + ",".join(config) + ")"
+    return identity
+
+
+def normalizer_version(normalizer: Callable[[str], str]) -> str:
+    """
+    Hash of the python sources and JSON data files next to the module
+    defining the normalizer, it changes whenever they are edited.
+    """
+    normalizer = _unwrap(normalizer)
+    target = normalizer if inspect.isfunction(normalizer) else type(normalizer)
+    module_file = inspect.getsourcefile(target)
+    return _hash_dir(os.path.dirname(os.path.abspath(module_file)))
+
+
+class _Store:
+    # kept apart from DiskCachedNormalizer so that it can be finalized
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending: Dict[str, str] = {}
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        # a forked process must not reuse the parent connection
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False
+            )
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(_SCHEMA)
+            self.connection.commit()
+            self.pid = os.getpid()
+        return self.connection
+
+    def flush(self, identity: str, version: str):
+        if len(self.pending) == 0:
+            return
+        connection = self.connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO normalized VALUES (?, ?, ?, ?)",
+                [(identity, version, k, v) for k, v in self.pending.items()],
+            )
+        self.pending.clear()
+
+    def close(self, identity: str, version: str):
+        with self.lock:
+            try:
+                self.flush(identity, version)
+            except sqlite3.Error as e:
+                logger.warning(f"Could not write the normalization cache: {e}")
+            if self.connection is not None and self.pid == os.getpid():
+                self.connection.close()
+            self.connection = None
+
+
+class DiskCachedNormalizer:
+    """
+    Wraps any text normalizer (e.g. one returned by `get_txt_norm`)
+    with a persistent cache stored in a SQLite database.
+    New entries are written in batches, call `flush` (or `close`) to make
+    sure everything is on disk, this is done anyway when the object is
+    garbage collected or at interpreter exit.
+    Entries of other versions of the same normalizer are kept (e.g. for
+    another checkout sharing the database) until `vacuum` is called.
+    The database can be shared by several processes.
+
+    :param normalizer: Callable, maps a string to its normalized version.
+    :param path: str, path of the SQLite database, created if missing.
+    :param identity: str, name under which the normalizer outputs are
+        stored, by default derived from its class (or function) and
+        configuration, see `normalizer_identity`.
+    :param batch_size: int, number of new entries written at once.
+    """
+
+    def __init__(
+        self,
+        normalizer: Callable[[str], str],
+        path: str,
+        identity: Optional[str] = None,
+        batch_size: int = 1024,
+    ):
+        self.normalizer = normalizer
+        self.path = path
+        self.identity = (
+            normalizer_identity(normalizer) if identity is None else identity
+        )
+        self.version = normalizer_version(normalizer)
+        self.batch_size = batch_size
+        self._hits = 0
+        self._misses = 0
+        self._store = _Store(path)
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        weakref.finalize(self, self._store.close, self.identity, self.version)
+
+    def __call__(self, s: str) -> str:
+        with self._store.lock:
+            out = self._store.pending.get(s)
+            if out is None:
+                row = (
+                    self._store.connect()
+                    .execute(
+                        "SELECT output FROM normalized "
+                        "WHERE normalizer = ? AND version = ? AND input = ?",
+                        (self.identity, self.version, s),
+                    )
+                    .fetchone()
+                )
+                out = None if row is None else row[0]
+            if out is not None:
+                self._hits += 1
+                return out
+
+        out = self.normalizer(s)
+        with self._store.lock:
+            self._misses += 1
+            self._store.pending[s] = out
+            if len(self._store.pending) >= self.batch_size:
+                self._store.flush(self.identity, self.version)
+        return out
+
+    def flush(self):
+        with self._store.lock:
+            self._store.flush(self.identity, self.version)
+
+    def close(self):
+        self._store.close(self.identity, self.version)
+
+    def vacuum(self) -> int:
+        """
+        Removes the entries of the other versions of this normalizer.
+
+        :return: int, number of entries removed.
+        """
+        with self._store.lock:
+            connection = self._store.connect()
+            with connection:
+                cursor = connection.execute(
+                    "DELETE FROM normalized WHERE normalizer = ? AND version != ?",
+                    (self.identity, self.version),
+                )
+            return cursor.rowcount
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def cache_info(self) -> CacheInfo:
+        with self._store.lock:
+            self._store.flush(self.identity, self.version)
+            (currsize,) = (
+                self._store.connect()
+                .execute(
+                    "SELECT COUNT(*) FROM normalized "
+                    "WHERE normalizer = ? AND version = ?",
+                    (self.identity, self.version),
+                )
+                .fetchone()
+            )
+            return CacheInfo(self._hits, self._misses, 0, None, currsize)
+
+    def __reduce__(self):
+        # connections can't be pickled, each process opens its own
+        return self.__class__, (
+            self.normalizer,
+            self.path,
+            self.identity,
+            self.batch_size,
+        )
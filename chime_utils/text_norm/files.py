@@ -0,0 +1,204 @@
+"""
+Streaming text normalization of hypothesis/reference files.
+Supported formats are CHiME-style JSON (a list of segments with a "words"
+field), JSONL (one such segment per line), CTM and STM.
+Files are read and written incrementally and the normalization is done
+by `iter_normalize`, possibly with a pool of worker processes.
+"""
+
+import itertools
+import json
+import os
+from typing import IO, Iterable, Iterator, Optional
+
+from chime_utils.text_norm.batch import iter_normalize
+
+FORMATS = ["json", "jsonl", "ctm", "stm"]
+_STM_IGNORE = "ignore_time_segment_in_scoring"
+_READ_SIZE = 1 << 16
+
+
+def guess_format(path: str) -> str:
+    """
+    :param path: str, file path, the format is taken from its extension
+        (a trailing .gz is not supported).
+    """
+    ext = os.path.splitext(path)[-1].lstrip(".").lower()
+    if ext not in FORMATS:
+        raise ValueError(f"Can't guess the format of {path}, choose between {FORMATS}.")
+    return ext
+
+
+def iter_json_array(f: IO[str]) -> Iterator:
+    """
+    Yields the elements of the JSON array in `f` one at a time,
+    without reading the whole file in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    started = False
+
+    def skip(chars):
+        nonlocal pos
+        while pos < len(buffer) and buffer[pos] in chars:
+            pos += 1
+
+    while True:
+        skip(" \t\r\n," if started else " \t\r\n")
+        if pos < len(buffer):
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array.")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # a number may be cut at the buffer end, wait for a delimiter
+                if end < len(buffer) or eof:
+                    yield obj
+                    pos = end
+                    continue
+        if eof:
+            raise ValueError("Unterminated JSON array.")
+        chunk = f.read(_READ_SIZE)
+        eof = len(chunk) == 0
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def _dump_json_array(items: Iterable, f: IO[str]):
+    """
+    Writes `items` as a JSON array, with the same layout as
+    json.dump(list(items), f, indent=4), one item at a time.
+    """
+    first = True
+    for item in items:
+        c_item = json.dumps(item, indent=4).replace("\n", "\n    ")
+        f.write(("[\n    " if first else ",\n    ") + c_item)
+        first = False
+    f.write("[]" if first else "\n]")
+
+
+def _split_ctm_word(fields, tokens):
+    """
+    Words removed by the normalization are dropped and words expanded to
+    several ones (e.g. "don't" -> "do not") evenly split their duration.
+    """
+    if len(tokens) == 0:
+        return
+    if len(tokens) == 1:
+        yield fields[:4] + [tokens[0]] + fields[5:]
+        return
+    start, duration = float(fields[2]), float(fields[3]) / len(tokens)
+    for i, token in enumerate(tokens):
+        yield (
+            fields[:2]
+            + ["{:.3f}".format(start + i * duration), "{:.3f}".format(duration)]
+            + [token]
+            + fields[5:]
+        )
+
+
+def _text_of(fmt, record):
+    if fmt in ["json", "jsonl"]:
+        return record.get("words", "")
+    # ctm and stm, comments are kept as they are
+    if record[0].startswith(";;") or record[-1] == _STM_IGNORE:
+        return ""
+    if fmt == "ctm":
+        return record[4]
+    return record[-1]
+
+
+def _read_records(f: IO[str], fmt: str) -> Iterator:
+    if fmt == "json":
+        yield from iter_json_array(f)
+        return
+    for line in f:
+        if len(line.strip()) == 0:
+            continue
+        if fmt == "jsonl":
+            yield json.loads(line)
+        elif line.startswith(";;"):
+            yield [line.rstrip("\n")]
+        elif fmt == "ctm":
+            # file channel start duration word [confidence]
+            yield line.split()
+        else:
+            # file channel speaker start end [<label>] transcript
+            fields = line.split(maxsplit=5)
+            if len(fields) < 6:
+                yield fields + [""]
+            elif fields[5].startswith("<"):
+                label, *transcript = fields[5].split(maxsplit=1)
+                yield fields[:5] + [label] + [" ".join(transcript)]
+            else:
+                yield fields[:5] + [fields[5].rstrip()]
+
+
+def _write_records(records: Iterable, f: IO[str], fmt: str):
+    if fmt == "json":
+        _dump_json_array(records, f)
+        return
+    for record in records:
+        if fmt == "jsonl":
+            f.write(json.dumps(record) + "\n")
+        else:
+            f.write(" ".join(field for field in record if field) + "\n")
+
+
+def normalize_file(
+    input_file: IO[str],
+    output_file: IO[str],
+    fmt: str,
+    norm: Optional[str] = "chime8",
+    workers: int = 1,
+    chunksize: int = 1024,
+):
+    """
+    Normalizes the transcripts in `input_file` and writes them in
+    `output_file` with the same format, streaming from one to the other.
+    JSON/JSONL segments get their "words" field normalized, CTM words
+    removed by the normalization are dropped and STM segments are kept
+    even if their transcript becomes empty.
+
+    :param input_file: file object opened in text mode.
+    :param output_file: file object opened in text mode.
+    :param fmt: str, choose between 'json', 'jsonl', 'ctm' and 'stm'.
+    :param norm: str, which text normalization to use,
+        choose between 'chime6', 'chime7', 'chime8' or None.
+    :param workers: int, number of worker processes, see `iter_normalize`,
+        by default everything runs in the current process.
+    :param chunksize: int, number of transcripts sent to a worker at once.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}, choose between {FORMATS}.")
+    # the two copies are at most the in-flight chunks apart
+    records, to_normalize = itertools.tee(_read_records(input_file, fmt))
+    texts = iter_normalize(
+        (_text_of(fmt, r) for r in to_normalize), norm, workers, chunksize
+    )
+
+    def normalized_records():
+        for record, text in zip(records, texts):
+            if fmt in ["json", "jsonl"]:
+                if "words" in record:
+                    record["words"] = text
+                yield record
+            elif record[0].startswith(";;") or record[-1] == _STM_IGNORE:
+                yield record
+            elif fmt == "ctm":
+                yield from _split_ctm_word(record, text.split())
+            else:
+                yield record[:-1] + [text]
+
+    _write_records(normalized_records(), output_file, fmt)
@@ -0,0 +1,82 @@
+"""
+Process-wide registry of text normalizers.
+Each normalizer is built at most once per process and shared between
+threads, as building them (e.g. parsing english.json and compiling all
+the replacers of the CHiME-8 one) is far from free.
+Their modules are imported on first use too, so that importing
+chime_utils.text_norm stays cheap.
+"""
+
+import threading
+from typing import Callable, Dict, Iterable, Optional
+
+
+# backends are imported only when the corresponding normalizer is requested
+def _chime6():
+    from chime_utils.text_norm.c7dasr import chime6_norm_scoring
+
+    return chime6_norm_scoring
+
+
+def _chime7():
+    from chime_utils.text_norm.c7dasr import chime7_norm_scoring
+
+    return chime7_norm_scoring
+
+
+def _chime8():
+    from chime_utils.text_norm.whisper_like import EnglishTextNormalizer
+
+    return EnglishTextNormalizer()
+
+
+_FACTORIES: Dict[str, Callable[[], Callable[[str], str]]] = {
+    "chime6": _chime6,
+    "chime7": _chime7,
+    "chime8": _chime8,
+}
+_NORMALIZERS: Dict[str, Callable[[str], str]] = {}
+_LOCK = threading.Lock()
+
+
+def available_normalizers():
+    return sorted(_FACTORIES.keys())
+
+
+def register_normalizer(name: str, factory: Callable[[], Callable[[str], str]]):
+    """
+    :param name: str, name used to retrieve the normalizer with `get_txt_norm`.
+    :param factory: Callable, takes no arguments and returns the normalizer,
+        it is called only once, the first time the normalizer is requested.
+    """
+    with _LOCK:
+        _FACTORIES[name] = factory
+        _NORMALIZERS.pop(name, None)
+
+
+def get_normalizer(name: str) -> Callable[[str], str]:
+    normalizer = _NORMALIZERS.get(name)
+    if normalizer is None:
+        with _LOCK:
+            normalizer = _NORMALIZERS.get(name)
+            if normalizer is None:
+                if name not in _FACTORIES:
+                    raise NotImplementedError(
+                        f"Unknown text normalization {name}, "
+                        f"choose between {available_normalizers()}."
+                    )
+                normalizer = _FACTORIES[name]()
+                _NORMALIZERS[name] = normalizer
+    return normalizer
+
+
+def preload_normalizers(names: Optional[Iterable[str]] = None):
+    """
+    Builds the given normalizers (all registered ones by default) in the
+    current process.
+    Call it before creating a fork-based worker pool so that the workers
+    inherit them instead of building their own, or pass it as the pool
+    `initializer` when workers are spawned.
+    """
+    for name in available_normalizers() if names is None else names:
+        get_normalizer(name)
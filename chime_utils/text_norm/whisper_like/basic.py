@@ -1,7 +1,9 @@
+import functools
 import re
 import unicodedata
+from typing import Callable, List, Tuple
 
-import regex
+from .profiling import NormalizerStats
 
 # non-ASCII letters that are not separated by "NFKD" normalization
 ADDITIONAL_DIACRITICS = {
@@ -24,29 +26,52 @@ ADDITIONAL_DIACRITICS = {
 }
 
 
+class _SymbolsTable(dict):
+    """
+    `str.translate` table for `remove_symbols_and_diacritics` and
+    `remove_symbols`, filled lazily one codepoint at a time so that
+    `unicodedata.category` is called at most once per character ever seen.
+    """
+
+    def __init__(self, keep: str, remove_diacritics: bool):
+        super().__init__()
+        self.keep = keep
+        self.remove_diacritics = remove_diacritics
+
+    def __missing__(self, codepoint: int):
+        c = chr(codepoint)
+        if c in self.keep:
+            out = c
+        elif self.remove_diacritics and c in ADDITIONAL_DIACRITICS:
+            out = ADDITIONAL_DIACRITICS[c]
+        elif self.remove_diacritics and unicodedata.category(c) == "Mn":
+            out = ""
+        elif unicodedata.category(c)[0] in "MSP":
+            out = " "
+        else:
+            out = c
+        self[codepoint] = out
+        return out
+
+
+@functools.lru_cache(maxsize=None)
+def _symbols_table(keep: str, remove_diacritics: bool) -> _SymbolsTable:
+    table = _SymbolsTable(keep, remove_diacritics)
+    for codepoint in range(128):
+        table[codepoint]  # ASCII is always needed, fill it eagerly
+    return table
+
+
 def remove_symbols_and_diacritics(s: str, keep=""):
     """
     Replace any other markers, symbols, and punctuations with a space,
     and drop any diacritics (category 'Mn' and some manual mappings)
     """
-    return "".join(
-        (
-            c
-            if c in keep
-            else (
-                ADDITIONAL_DIACRITICS[c]
-                if c in ADDITIONAL_DIACRITICS
-                else (
-                    ""
-                    if unicodedata.category(c) == "Mn"
-                    else " "
-                    if unicodedata.category(c)[0] in "MSP"
-                    else c
-                )
-            )
-        )
-        for c in unicodedata.normalize("NFKD", s)
-    )
+    table = _symbols_table(keep, True)
+    if s.isascii():
+        # NFKD leaves ASCII unchanged
+        return s.translate(table)
+    return unicodedata.normalize("NFKD", s).translate(table)
 
 
 def remove_symbols(s: str):
@@ -54,32 +79,69 @@ def remove_symbols(s: str):
     Replace any other markers, symbols,
     punctuations with a space, keeping diacritics
     """
-    return "".join(
-        " " if unicodedata.category(c)[0] in "MSP" else c
-        for c in unicodedata.normalize("NFKC", s)
-    )
+    table = _symbols_table("", False)
+    if s.isascii():
+        # NFKC leaves ASCII unchanged
+        return s.translate(table)
+    return unicodedata.normalize("NFKC", s).translate(table)
 
 
 class BasicTextNormalizer:
-    def __init__(self, remove_diacritics: bool = False, split_letters: bool = False):
+    def __init__(
+        self,
+        remove_diacritics: bool = False,
+        split_letters: bool = False,
+        profile: bool = False,
+    ):
+        """
+        :param profile: bool, whether to collect per-stage timings
+            in `self.stats` (a NormalizerStats).
+        """
         self.clean = (
             remove_symbols_and_diacritics if remove_diacritics else remove_symbols
         )
         self.split_letters = split_letters
+        self.stats = NormalizerStats() if profile else None
 
-    def __call__(self, s: str):
+    def remove_brackets(self, s: str):
         s = s.lower()
         # remove words between brackets
         s = re.sub(r"[<\[][^>\]]*[>\]]", "", s)
         # remove words between parenthesis
         s = re.sub(r"\(([^)]+?)\)", "", s)
-        s = self.clean(s).lower()
+        return s
+
+    def remove_symbols(self, s: str):
+        return self.clean(s).lower()
+
+    def letters(self, s: str):
+        import regex
+
+        return " ".join(regex.findall(r"\X", s, regex.U))
 
+    def cleanup(self, s: str):
+        # replace any successive whitespace characters with a space
+        return re.sub(r"\s+", " ", s)
+
+    def stages(self) -> List[Tuple[str, Callable[[str], str]]]:
+        """
+        Named steps of the normalization, applied in this order.
+        """
+        stages = [
+            ("bracket removal", self.remove_brackets),
+            ("symbol stripping", self.remove_symbols),
+        ]
         if self.split_letters:
-            s = " ".join(regex.findall(r"\X", s, regex.U))
+            stages.append(("letters splitting", self.letters))
+        stages.append(("cleanup", self.cleanup))
+        return stages
 
-        s = re.sub(
-            r"\s+", " ", s
-        )  # replace any successive whitespace characters with a space
+    def __call__(self, s: str):
+        if self.stats is not None:
+            return self.stats.run(self.stages(), s)
 
-        return s
+        s = self.remove_brackets(s)
+        s = self.remove_symbols(s)
+        if self.split_letters:
+            s = self.letters(s)
+        return self.cleanup(s)
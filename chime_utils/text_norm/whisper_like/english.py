@@ -1,12 +1,36 @@
+import functools
 import json
 import os
 import re
+import threading
 from fractions import Fraction
-from typing import Iterator, List, Match, Optional, Union
+from types import MappingProxyType
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Match,
+    Optional,
+    Tuple,
+    Union,
+)
 
 from more_itertools import windowed
 
 from .basic import remove_symbols_and_diacritics
+from .profiling import NormalizerStats
+
+_NUMERIC_RE = re.compile(r"^\d+(\.\d+)?$")
+_DIGIT_RE = re.compile(r"\d")
+_AND_A_HALF_RE = re.compile(r"\band\s+a\s+half\b")
+_LETTER_DIGIT_RE = re.compile(r"([a-z])([0-9])")
+_DIGIT_LETTER_RE = re.compile(r"([0-9])([a-z])")
+_NUMBER_SUFFIX_RE = re.compile(r"([0-9])\s+(st|nd|rd|th|s)\b")
+_CENTS_RE = re.compile(r"([€£$])([0-9]+) (?:and )?¢([0-9]{1,2})\b")
+_ZERO_CURRENCY_RE = re.compile(r"[€£$]0.([0-9]{1,2})\b")
+_ONE_RE = re.compile(r"\b1(s?)\b")
 
 
 class EnglishNumberNormalizer:
@@ -161,6 +185,19 @@ class EnglishNumberNormalizer:
             ]
         )
         self.literal_words = {"one", "ones"}
+        # without any digit, the words below are the only ones that can make
+        # the output differ from the input, all the others are copied as is
+        self.trigger_words = {
+            *self.zeros,
+            *self.ones,
+            *self.ones_suffixed,
+            *self.tens,
+            *self.tens_suffixed,
+            *self.multipliers,
+            *self.multipliers_suffixed,
+            *self.preceding_prefixers,
+            "point",
+        }
 
     def process_words(self, words: List[str]) -> Iterator[str]:
         prefix: Optional[str] = None
@@ -190,10 +227,10 @@ class EnglishNumberNormalizer:
                 skip = False
                 continue
 
-            next_is_numeric = next is not None and re.match(r"^\d+(\.\d+)?$", next)
+            next_is_numeric = next is not None and _NUMERIC_RE.match(next)
             has_prefix = current[0] in self.prefixes
             current_without_prefix = current[1:] if has_prefix else current
-            if re.match(r"^\d+(\.\d+)?$", current_without_prefix):
+            if _NUMERIC_RE.match(current_without_prefix):
                 # arabic numbers (potentially with signs and fractions)
                 f = to_fraction(current_without_prefix)
                 assert f is not None
@@ -390,7 +427,7 @@ class EnglishNumberNormalizer:
         # replace "<number> and a half" with "<number> point five"
         results = []
 
-        segments = re.split(r"\band\s+a\s+half\b", s)
+        segments = _AND_A_HALF_RE.split(s)
         for i, segment in enumerate(segments):
             if len(segment.strip()) == 0:
                 continue
@@ -407,11 +444,11 @@ class EnglishNumberNormalizer:
         s = " ".join(results)
 
         # put a space at number/letter boundary
-        s = re.sub(r"([a-z])([0-9])", r"\1 \2", s)
-        s = re.sub(r"([0-9])([a-z])", r"\1 \2", s)
+        s = _LETTER_DIGIT_RE.sub(r"\1 \2", s)
+        s = _DIGIT_LETTER_RE.sub(r"\1 \2", s)
 
         # but remove spaces which could be a suffix
-        s = re.sub(r"([0-9])\s+(st|nd|rd|th|s)\b", r"\1\2", s)
+        s = _NUMBER_SUFFIX_RE.sub(r"\1\2", s)
 
         return s
 
@@ -432,21 +469,56 @@ class EnglishNumberNormalizer:
                 return m.string
 
         # apply currency postprocessing; "$2 and ¢7" -> "$2.07"
-        s = re.sub(r"([€£$])([0-9]+) (?:and )?¢([0-9]{1,2})\b", combine_cents, s)
-        s = re.sub(r"[€£$]0.([0-9]{1,2})\b", extract_cents, s)
+        s = _CENTS_RE.sub(combine_cents, s)
+        s = _ZERO_CURRENCY_RE.sub(extract_cents, s)
 
         # write "one(s)" instead of "1(s)", just for the readability
-        s = re.sub(r"\b1(s?)\b", r"one\1", s)
+        s = _ONE_RE.sub(r"one\1", s)
 
         return s
 
-    def __call__(self, s: str):
+    def has_numbers(self, s: str) -> bool:
+        """
+        False only if `s` surely contains no number, in which case the
+        normalization just collapses whitespace.
+        """
+        return (
+            _DIGIT_RE.search(s) is not None
+            or _AND_A_HALF_RE.search(s) is not None
+            or not self.trigger_words.isdisjoint(s.split())
+        )
+
+    def convert(self, s: str):
         s = self.preprocess(s)
         s = " ".join(word for word in self.process_words(s.split()) if word is not None)
         s = self.postprocess(s)
 
         return s
 
+    def __call__(self, s: str):
+        if not self.has_numbers(s):
+            return " ".join(s.split())
+        return self.convert(s)
+
+
+_SPELLING_MAPPING: Optional[Mapping[str, str]] = None
+_SPELLING_MAPPING_LOCK = threading.Lock()
+
+
+def get_spelling_mapping() -> Mapping[str, str]:
+    """
+    British-American spelling mapping from english.json, parsed once per
+    process on first use and shared (read-only) by all normalizers.
+    """
+    global _SPELLING_MAPPING
+    if _SPELLING_MAPPING is None:
+        with _SPELLING_MAPPING_LOCK:
+            if _SPELLING_MAPPING is None:
+                mapping_path = os.path.join(os.path.dirname(__file__), "english.json")
+                with open(mapping_path, "r") as f:
+                    _SPELLING_MAPPING = MappingProxyType(json.load(f))
+    return _SPELLING_MAPPING
+
 
 class EnglishSpellingNormalizer:
     """
@@ -456,15 +528,150 @@ class EnglishSpellingNormalizer:
     """
 
     def __init__(self):
-        mapping_path = os.path.join(os.path.dirname(__file__), "english.json")
-        self.mapping = json.load(open(mapping_path))
+        self.mapping = get_spelling_mapping()
+
+    def __reduce__(self):
+        # the mapping is shared per process, fetch it again when unpickling
+        return self.__class__, ()
 
     def __call__(self, s: str):
         return " ".join(self.mapping.get(word, word) for word in s.split())
 
 
+_BRACKETS_RE = re.compile(r"[<\[][^>\]]*[>\]]")
+_PARENTHESIS_RE = re.compile(r"\(([^)]+?)\)")
+_SPACE_APOSTROPHE_RE = re.compile(r"\s+'")
+_DIGIT_COMMA_RE = re.compile(r"(\d),(\d)")
+_PERIOD_RE = re.compile(r"\.([^0-9]|$)")
+_PREFIX_SYMBOL_RE = re.compile(r"[.$¢€£]([^0-9])")
+_SUFFIX_SYMBOL_RE = re.compile(r"([^0-9])%")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=None)
+def _matches_replacement(pattern: str, replacement: str) -> bool:
+    """
+    Whether `pattern` can match a span overlapping `replacement`, when it is
+    put between any prefix and any suffix of the literal text the pattern
+    starts and ends with (plus a space and a word character).
+    """
+    regexp = re.compile(pattern)
+    head = re.match(r"(?:\\b)?([\w' ]*)", pattern).group(1)
+    tail = re.search(r"([\w' ]*)(?:\\b)?$", pattern).group(1)
+    lefts = {head[:i] for i in range(len(head) + 1)} | {" ", "x"}
+    rights = {tail[i:] for i in range(len(tail) + 1)} | {" ", "x"}
+    for left in lefts:
+        for right in rights:
+            text = left + replacement + right
+            start, end = len(left), len(left) + len(replacement)
+            for pos in range(end):
+                m = regexp.match(text, pos)
+                if m is not None and m.end() > max(start, m.start()):
+                    return True
+    return False
+
+
+class FusedReplacer:
+    """
+    Applies an ordered mapping of regex replacers, giving the same result as
+    calling `re.sub` for each of them in turn, but scanning the string only
+    once per stage instead of once per pattern.
+
+    The patterns of a stage are merged into a single alternation and each
+    match is dispatched to its replacement through the name of the outer
+    group that matched.
+    Patterns that must start with a known character are bucketed behind a
+    lookahead on that character, which lets the engine skip most of the
+    alternatives at each position. Patterns starting with different
+    characters can never match at the same position, so the leftmost-first
+    semantics of the original order are kept; patterns whose first
+    character is not known are never moved.
+    A new stage is started after any replacer that rewrites a leading word
+    character into a non-word one (e.g. `n't` -> ` not`), as this can create
+    word boundaries that the following patterns may match on, and after any
+    replacer whose output a following pattern can match (e.g. `gotta` ->
+    `got to`, then `'s got` -> ` has got`), since a single scan never
+    looks at replaced text again.
+    Replacements must be literal strings (no group references).
+    """
+
+    def __init__(self, replacers: Dict[str, str]):
+        self.stages = []
+        stage = []
+        items = list(replacers.items())
+        for i, (pattern, replacement) in enumerate(items):
+            if "\\" in replacement:
+                raise ValueError(
+                    f"Replacement {replacement!r} for {pattern!r} is not literal."
+                )
+            stage.append((pattern, replacement))
+            if (re.match(r"\w", pattern) and re.match(r"\W", replacement)) or any(
+                _matches_replacement(x, replacement) for x, _ in items[i + 1 :]
+            ):
+                self.stages.append(self._compile(stage))
+                stage = []
+        if len(stage) > 0:
+            self.stages.append(self._compile(stage))
+
+    @staticmethod
+    def _first_char(pattern: str) -> Optional[str]:
+        # first character of every match, if it is fixed by the pattern
+        m = re.match(r"(?:\\b)?\(?([\w'])(?![*?{])", pattern)
+        if m is None or "|" in pattern:
+            return None
+        return m.group(1)
+
+    @classmethod
+    def _compile(cls, stage):
+        dispatch = {}
+        alternatives = []
+        buckets = {}
+
+        def flush():
+            for c, bucket in buckets.items():
+                alternatives.append(f"(?={re.escape(c)})(?:{'|'.join(bucket)})")
+            buckets.clear()
+
+        for pattern, replacement in stage:
+            name = f"r{len(dispatch)}"
+            dispatch[name] = (pattern, replacement)
+            c = cls._first_char(pattern)
+            if c is None:
+                flush()
+                alternatives.append(f"(?P<{name}>{pattern})")
+            else:
+                buckets.setdefault(c, []).append(f"(?P<{name}>{pattern})")
+        flush()
+        return re.compile("|".join(alternatives)), dispatch
+
+    def __call__(self, s: str, counts: Optional[Dict[str, int]] = None):
+        """
+        :param s: str, text to apply the replacers to.
+        :param counts: dict, if given the number of matches of each
+            pattern is added to it.
+        """
+        for regexp, dispatch in self.stages:
+            if counts is None:
+                s = regexp.sub(lambda m: dispatch[m.lastgroup][1], s)
+            else:
+
+                def replace(m):
+                    pattern, replacement = dispatch[m.lastgroup]
+                    counts[pattern] = counts.get(pattern, 0) + 1
+                    return replacement
+
+                s = regexp.sub(replace, s)
+        return s
+
+
 class EnglishTextNormalizer:
-    def __init__(self, standardize_numbers=False):
+    def __init__(self, standardize_numbers=False, profile=False):
+        """
+        :param standardize_numbers: bool, whether to convert spelled-out
+            numbers into arabic numbers.
+        :param profile: bool, whether to collect per-stage timings and
+            replacers match counts in `self.stats` (a NormalizerStats).
+        """
         self.replacers = {
             # common non verbal sounds are mapped to the similar ones
             r"\b(hm+)\b|\b(mhm)\b|\b(mm+)\b|\b(m+h)\b|\b(hm+)\b|\b(um+)\b|\b(uhm+)\b": (  # noqa e501
@@ -534,37 +741,70 @@ class EnglishTextNormalizer:
         else:
             self.standardize_numbers = None
         self.standardize_spellings = EnglishSpellingNormalizer()
+        self.replace = FusedReplacer(self.replacers)
+        self.stats = NormalizerStats() if profile else None
 
-    def __call__(self, s: str):
+    def remove_brackets(self, s: str):
         s = s.lower()
 
-        s = re.sub(r"[<\[][^>\]]*[>\]]", "", s)
+        s = _BRACKETS_RE.sub("", s)
         # remove words between brackets
-        s = re.sub(r"\(([^)]+?)\)", "", s)
+        s = _PARENTHESIS_RE.sub("", s)
         # remove words between parenthesis
-        s = re.sub(r"\s+'", "'", s)
+        s = _SPACE_APOSTROPHE_RE.sub("'", s)
         # when there's a space before an apostrophe
 
-        for pattern, replacement in self.replacers.items():
-            s = re.sub(pattern, replacement, s)
+        return s
 
-        s = re.sub(r"(\d),(\d)", r"\1\2", s)
+    def remove_symbols(self, s: str):
+        s = _DIGIT_COMMA_RE.sub(r"\1\2", s)
         # remove commas between digits
-        s = re.sub(r"\.([^0-9]|$)", r" \1", s)
+        s = _PERIOD_RE.sub(r" \1", s)
         # remove periods not followed by numbers
         s = remove_symbols_and_diacritics(s, keep=".%$¢€£")
         # keep numeric symbols
 
-        if self.standardize_numbers is not None:
-            s = self.standardize_numbers(s)
-        s = self.standardize_spellings(s)
+        return s
 
+    def cleanup(self, s: str):
         # now remove prefix/suffix symbols
         # that are not preceded/followed by numbers
-        s = re.sub(r"[.$¢€£]([^0-9])", r" \1", s)
-        s = re.sub(r"([^0-9])%", r"\1 ", s)
+        s = _PREFIX_SYMBOL_RE.sub(r" \1", s)
+        s = _SUFFIX_SYMBOL_RE.sub(r"\1 ", s)
 
-        s = re.sub(r"\s+", " ", s)
+        s = _WHITESPACE_RE.sub(" ", s)
         # replace any successive whitespaces with a space
 
         return s
+
+    def stages(self) -> List[Tuple[str, Callable[[str], str]]]:
+        """
+        Named steps of the normalization, applied in this order.
+        """
+        if self.stats is not None:
+            counts = self.stats.replacer_matches
+            replace = functools.partial(self.replace, counts=counts)
+        else:
+            replace = self.replace
+        stages = [
+            ("bracket removal", self.remove_brackets),
+            ("replacers", replace),
+            ("symbol stripping", self.remove_symbols),
+        ]
+        if self.standardize_numbers is not None:
+            stages.append(("numbers", self.standardize_numbers))
+        stages.append(("spelling mapping", self.standardize_spellings))
+        stages.append(("cleanup", self.cleanup))
+        return stages
+
+    def __call__(self, s: str):
+        if self.stats is not None:
+            return self.stats.run(self.stages(), s)
+
+        s = self.remove_brackets(s)
+        s = self.replace(s)
+        s = self.remove_symbols(s)
+        if self.standardize_numbers is not None:
+            s = self.standardize_numbers(s)
+        s = self.standardize_spellings(s)
+        return self.cleanup(s)
@@ -0,0 +1,52 @@
+import json
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+
+
+class NormalizerStats:
+    """
+    Statistics collected by a text normalizer created with `profile=True`:
+    number of normalized utterances, time spent in each stage and,
+    for EnglishTextNormalizer, how many times each replacer matched.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.stage_seconds: Dict[str, float] = {}
+        self.replacer_matches: Dict[str, int] = Counter()
+
+    def run(self, stages: List[Tuple[str, Callable[[str], str]]], s: str) -> str:
+        self.calls += 1
+        for name, stage in stages:
+            start = time.perf_counter()
+            s = stage(s)
+            elapsed = time.perf_counter() - start
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + elapsed
+        return s
+
+    def reset(self):
+        self.calls = 0
+        self.stage_seconds = {}
+        self.replacer_matches = Counter()
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "total_seconds": sum(self.stage_seconds.values()),
+            "stage_seconds": dict(self.stage_seconds),
+            "replacer_matches": dict(
+                sorted(self.replacer_matches.items(), key=lambda x: -x[1])
+            ),
+        }
+
+    def dump(self, path: str):
+        """
+        :param path: str, JSON file where the statistics are written.
+        """
+        with open(path, "w") as f:
+            json.dump(self.as_dict(), f, indent=4)
+
+    def __repr__(self):
+        stages = ", ".join(f"{k}={v:.3f}s" for k, v in self.stage_seconds.items())
+        return f"NormalizerStats(calls={self.calls}, {stages})"
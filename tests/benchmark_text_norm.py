@@ -0,0 +1,194 @@
+"""
+Text normalization benchmark.
+
+Times `get_txt_norm` in chime6, chime7 and chime8 modes and the
+BasicTextNormalizer on a synthetic corpus of conversational transcripts,
+and breaks down the time spent in each stage of the whisper-like
+normalizers (bracket removal, replacers, symbol stripping, spelling mapping).
+The corpus is generated from a fixed seed so numbers are comparable
+across runs and machines.
+
+Usage:
+    PYTHONPATH=. python tests/benchmark_text_norm.py [--num-utts 20000] [--repeats 3]
+"""
+
+import json
+import random
+import time
+from collections import OrderedDict
+
+import click
+
+from chime_utils.text_norm import get_txt_norm
+from chime_utils.text_norm.whisper_like import (
+    BasicTextNormalizer,
+    EnglishTextNormalizer,
+)
+
+SPEAKER_WORDS = (
+    "i you we they it that this there what so well just really like know "
+    "think mean going gonna wanna kind of sort the a an and but or if then "
+    "yeah yes no okay right sure actually maybe probably basically "
+    "kitchen dinner coffee meeting project slides budget weekend colour "
+    "favourite organise theatre programme travelling neighbour realise "
+    "mr mrs dr st monday tuesday friday morning tonight tomorrow"
+).split()
+FILLERS = ["um", "uh", "hmm", "mhm", "mm", "uh-huh", "ah", "oh", "huh", "hm"]
+CONTRACTIONS = [
+    "don't",
+    "can't",
+    "won't",
+    "it's",
+    "that's",
+    "i'm",
+    "we're",
+    "they've",
+    "you'll",
+    "i'd",
+    "let's",
+    "y'all",
+    "gonna",
+    "wanna",
+    "ain't",
+    "shouldn't've",
+]
+NUMBERS = [
+    "one",
+    "two",
+    "twenty five",
+    "a hundred",
+    "three thousand",
+    "10",
+    "2.5",
+    "$20",
+    "1990s",
+    "fifth",
+    "50%",
+    "seven thirty",
+]
+NON_WORDS = [
+    "[laughs]",
+    "[noise]",
+    "[inaudible]",
+    "[inaudible 0:12:23.52]",
+    "<laugh>",
+    "(coughs)",
+    "[redacted]",
+]
+PUNCTUATION = [",", ".", "?", "!", "...", " -", ";", ":", '"']
+
+
+def synthetic_corpus(num_utts=20000, seed=0):
+    """
+    Conversational transcripts in CHiME style: mostly short utterances,
+    fillers, contractions, a few numbers, non-word tags and punctuation,
+    mixed case and British spellings. Short backchannels are repeated often,
+    as in real meetings.
+    """
+    rng = random.Random(seed)
+    utts = []
+    for _ in range(num_utts):
+        if rng.random() < 0.2:
+            utts.append(rng.choice(FILLERS + ["Yeah.", "Okay.", "Right.", "Mhm."]))
+            continue
+        words = []
+        for _ in range(max(1, int(rng.expovariate(1 / 9)))):
+            r = rng.random()
+            if r < 0.08:
+                words.append(rng.choice(FILLERS))
+            elif r < 0.18:
+                words.append(rng.choice(CONTRACTIONS))
+            elif r < 0.22:
+                words.append(rng.choice(NUMBERS))
+            elif r < 0.25:
+                words.append(rng.choice(NON_WORDS))
+            else:
+                words.append(rng.choice(SPEAKER_WORDS))
+            if rng.random() < 0.1:
+                words[-1] += rng.choice(PUNCTUATION)
+        words[0] = words[0].capitalize()
+        utts.append(" ".join(words) + rng.choice([".", "?", "", "..."]))
+    return utts
+
+
+def time_normalizer(normalizer, utts, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for utt in utts:
+            normalizer(utt)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def time_stages(stages, utts, repeats):
+    """
+    Times each stage on the output of the previous one, keeping the best
+    of `repeats` runs per stage.
+    """
+    timings = OrderedDict()
+    inputs = utts
+    for name, stage in stages.items():
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            outputs = [stage(utt) for utt in inputs]
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+        inputs = outputs
+    return timings, inputs
+
+
+def run_benchmark(num_utts=20000, repeats=3, seed=0):
+    utts = synthetic_corpus(num_utts, seed)
+    normalizers = OrderedDict(
+        [
+            ("chime6", get_txt_norm("chime6")),
+            ("chime7", get_txt_norm("chime7")),
+            ("chime8", get_txt_norm("chime8")),
+            ("chime8+numbers", EnglishTextNormalizer(standardize_numbers=True)),
+            ("basic", BasicTextNormalizer()),
+        ]
+    )
+    results = OrderedDict()
+    for name, normalizer in normalizers.items():
+        elapsed = time_normalizer(normalizer, utts, repeats)
+        c_result = {
+            "utt_per_s": len(utts) / elapsed,
+            "us_per_utt": elapsed / len(utts) * 1e6,
+        }
+        # only the whisper-like normalizers are split in stages
+        if hasattr(normalizer, "stages"):
+            timings, outputs = time_stages(
+                OrderedDict(normalizer.stages()), utts, repeats
+            )
+            # the stages must add up to the normalizer itself
+            assert outputs == [normalizer(utt) for utt in utts], name
+            c_result["stages_us_per_utt"] = OrderedDict(
+                (k, v / len(utts) * 1e6) for k, v in timings.items()
+            )
+        results[name] = c_result
+    return results
+
+
+@click.command()
+@click.option("--num-utts", type=int, default=20000, help="Corpus size.")
+@click.option("--repeats", type=int, default=3, help="Best of N runs.")
+@click.option("--seed", type=int, default=0, help="Corpus generation seed.")
+@click.option("--json-out", type=click.Path(dir_okay=False), default=None)
+def main(num_utts, repeats, seed, json_out):
+    results = run_benchmark(num_utts, repeats, seed)
+    for name, c_result in results.items():
+        print(
+            f"{name:<16} {c_result['utt_per_s']:>12.0f} utt/s "
+            f"{c_result['us_per_utt']:>8.2f} us/utt"
+        )
+        for stage, us in c_result.get("stages_us_per_utt", {}).items():
+            print(f"    {stage:<20} {us:>8.2f} us/utt")
+    if json_out is not None:
+        with open(json_out, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,977 @@
+import base64
+import glob
+import hashlib
+import http.client
+import http.server
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from chime_utils.dgen import audio_index, checksum, gen_chime6
+from chime_utils.dgen.audio_index import AudioIndex, AudioInfo
+from chime_utils.dgen.azure_storage import download_blob_container_dir
+from chime_utils.dgen.dasr import Task, TaskState, dasr_tasks, run_tasks
+from chime_utils.dgen.download import stream_download_extract
+from chime_utils.dgen.notsofar1 import normalize_word_timing
+from chime_utils.dgen.repack import repack_multichannel
+from chime_utils.dgen.shards import export_shards
+from chime_utils.dgen.utils import SessionCache, data_check, map_sessions
+from chime_utils.dprep.lhotse import prepare_chime6
+from chime_utils.text_norm import CachedNormalizer, get_txt_norm
+
+
+def test_normalize_word_timing():
+    word_norm = CachedNormalizer(get_txt_norm("chime8"), maxsize=None)
+    word_timing = [
+        ["Colour,", "0.5", "0.9"],
+        ["[laughs]", "0.9", "1.1"],
+        ["don't", "1.1", "1.5"],
+        ["colour", "1.5", "1.7"],
+    ]
+    assert normalize_word_timing(word_timing, word_norm) == [
+        ["color", "0.500", "0.900"],
+        ["do", "1.100", "1.300"],
+        ["not", "1.300", "1.500"],
+        ["color", "1.500", "1.700"],
+    ]
+    assert word_norm.cache_info().hits == 0
+    assert word_norm.cache_info().currsize == 4
+
+
+@pytest.fixture
+def chime6_corpus(tmp_path):
+    corpus_dir = tmp_path / "CHiME6"
+    words = ["Yeah.", "I don't know, [laughs]", "mhm", "The colour, uh, red"]
+    for split, sessions in [("train", ["S03", "S04", "S05"]), ("dev", ["S02"])]:
+        os.makedirs(corpus_dir / "transcriptions" / split)
+        os.makedirs(corpus_dir / "audio" / split)
+        for i, sess in enumerate(sessions):
+            annotation = [
+                {
+                    "speaker": f"P0{j % 2 + 1}",
+                    "start_time": f"0:00:{j + i:02d}.50",
+                    "end_time": f"0:00:{j + i + 1:02d}.25",
+                    "words": words[j % len(words)],
+                    "session_id": sess,
+                    "ref": "U01",
+                    "location": "kitchen",
+                }
+                for j in range(6)
+            ]
+            with open(corpus_dir / "transcriptions" / split / f"{sess}.json", "w") as f:
+                json.dump(annotation, f)
+            for device, channels in [("U01.CH1", 1), ("U01.CH2", 1), ("P01", 2)]:
+                sf.write(
+                    str(corpus_dir / "audio" / split / f"{sess}_{device}.wav"),
+                    np.zeros((16000 * (10 + i), channels), dtype="int16"),
+                    16000,
+                )
+    return corpus_dir
+
+
+def read_tree(root):
+    tree = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                tree[os.path.relpath(path, root)] = os.readlink(path)
+            else:
+                with open(path, "rb") as f:
+                    tree[os.path.relpath(path, root)] = f.read()
+    return tree
+
+
+def test_map_sessions():
+    items = list(range(50))
+    assert map_sessions(lambda x: x * 2, items, jobs=8) == [x * 2 for x in items]
+    assert map_sessions(lambda x: x * 2, items) == [x * 2 for x in items]
+
+
+def test_gen_chime6_jobs(chime6_corpus, tmp_path):
+    gen_chime6(str(tmp_path / "serial"), str(chime6_corpus), dset_part="train,dev")
+    gen_chime6(
+        str(tmp_path / "parallel"), str(chime6_corpus), dset_part="train,dev", jobs=4
+    )
+    serial = read_tree(tmp_path / "serial")
+    assert len(serial) > 0
+    assert serial == read_tree(tmp_path / "parallel")
+    assert serial[os.path.join("uem", "train", "all.uem")] == (
+        b"S03 1 0.500 10.000\nS04 1 1.500 11.000\nS05 1 2.500 12.000\n"
+    )
+
+
+def test_gen_chime6_incremental(chime6_corpus, tmp_path):
+    out = tmp_path / "out"
+    gen_chime6(str(out), str(chime6_corpus), dset_part="train,dev", incremental=True)
+    first = read_tree(out)
+    assert SessionCache.FILENAME in first
+    # mark the outputs as old to see which ones are written again
+    outputs = [
+        out / x / "train" / f"{sess}.json"
+        for x in ["transcriptions", "transcriptions_scoring"]
+        for sess in ["S03", "S04", "S05"]
+    ]
+    for x in outputs:
+        os.utime(x, ns=(0, 0))
+
+    gen_chime6(str(out), str(chime6_corpus), dset_part="train,dev", incremental=True)
+    assert read_tree(out) == first
+    assert all(os.stat(x).st_mtime_ns == 0 for x in outputs)
+
+    annotation_file = chime6_corpus / "transcriptions" / "train" / "S04.json"
+    with open(annotation_file, "r") as f:
+        annotation = json.load(f)
+    annotation[0]["words"] = "Something else."
+    with open(annotation_file, "w") as f:
+        json.dump(annotation, f)
+    gen_chime6(str(out), str(chime6_corpus), dset_part="train,dev", incremental=True)
+    assert [os.stat(x).st_mtime_ns != 0 for x in outputs] == [
+        False,
+        True,
+        False,
+    ] * 2
+    # deleted or dangling audio links are created again
+    os.remove(out / "audio" / "train" / "S03_P01.wav")
+    os.remove(out / "audio" / "train" / "S05_U01.CH1.wav")
+    os.symlink(tmp_path / "missing.wav", out / "audio" / "train" / "S05_U01.CH1.wav")
+    gen_chime6(str(out), str(chime6_corpus), dset_part="train,dev", incremental=True)
+    # same as generating everything from scratch
+    gen_chime6(str(tmp_path / "full"), str(chime6_corpus), dset_part="train,dev")
+    incremental = read_tree(out)
+    del incremental[SessionCache.FILENAME]
+    assert incremental == read_tree(tmp_path / "full")
+
+
+def test_gen_chime6_concurrent_parts(chime6_corpus, tmp_path, monkeypatch):
+    # both parts load the session and audio index files before either saves
+    barrier = threading.Barrier(2, timeout=60)
+    save = SessionCache.save
+
+    def synchronized_save(self):
+        barrier.wait()
+        save(self)
+
+    monkeypatch.setattr(SessionCache, "save", synchronized_save)
+    out = tmp_path / "out"
+
+    def gen(part):
+        gen_chime6(str(out), str(chime6_corpus), dset_part=part, incremental=True)
+
+    with ThreadPoolExecutor(2) as executor:
+        list(executor.map(gen, ["train", "dev"]))
+    monkeypatch.undo()
+    with open(out / SessionCache.FILENAME) as f:
+        records = json.load(f)
+    assert {"train/S03", "train/S04", "train/S05", "dev/S02"} <= set(records)
+    assert len(AudioIndex(str(out)).entries) == 12
+
+    outputs = glob.glob(str(out / "transcriptions*" / "*" / "*.json"))
+    for x in outputs:
+        os.utime(x, ns=(0, 0))
+    for part in ["train", "dev"]:
+        gen(part)
+    assert all(os.stat(x).st_mtime_ns == 0 for x in outputs)
+
+
+def test_repack_multichannel(chime6_corpus, tmp_path):
+    rng = np.random.default_rng(0)
+    channels = []
+    for device in ["U01.CH1", "U01.CH2"]:
+        data = rng.integers(-1000, 1000, (16000 * 11, 1), dtype="int16")
+        sf.write(
+            str(chime6_corpus / "audio" / "train" / f"S04_{device}.wav"), data, 16000
+        )
+        channels.append(data)
+    out = tmp_path / "out"
+    gen_chime6(str(out), str(chime6_corpus), dset_part="train,dev")
+
+    repack_multichannel(str(out), str(tmp_path / "array"), "train")
+    audio, fs = sf.read(
+        str(tmp_path / "array" / "audio" / "train" / "S04_U01.flac"), dtype="int16"
+    )
+    assert fs == 16000
+    assert np.array_equal(audio, np.concatenate(channels, axis=1))
+    assert sorted(os.listdir(tmp_path / "array" / "audio" / "train")) == [
+        f"{sess}_{device}"
+        for sess in ["S03", "S04", "S05"]
+        for device in ["P01.wav", "U01.flac"]
+    ]
+    assert os.path.realpath(
+        tmp_path / "array" / "audio" / "train" / "S04_P01.wav"
+    ) == str(chime6_corpus / "audio" / "train" / "S04_P01.wav")
+    with open(tmp_path / "array" / "devices" / "train" / "S04.json") as f:
+        devices = json.load(f)
+    assert devices == {
+        "P01": {
+            "is_close_talk": True,
+            "speaker": "P01",
+            "num_channels": 2,
+            "device_type": "binaural_mic",
+        },
+        "U01": {
+            "is_close_talk": False,
+            "speaker": None,
+            "num_channels": 2,
+            "device_type": "kinect_array_mic",
+            "channels": ["U01.CH1", "U01.CH2"],
+        },
+    }
+    for x in ["transcriptions", "transcriptions_scoring", "uem"]:
+        assert os.listdir(tmp_path / "array" / x / "train") == os.listdir(
+            out / x / "train"
+        )
+    assert not (tmp_path / "array" / "audio" / "dev").exists()
+
+    # all the arrays of a session in one file
+    repack_multichannel(str(out), str(tmp_path / "session"), per="session")
+    audio, _ = sf.read(
+        str(tmp_path / "session" / "audio" / "train" / "S04_mdm.wav"), dtype="int16"
+    )
+    assert np.array_equal(audio, np.concatenate(channels, axis=1))
+    assert (tmp_path / "session" / "audio" / "dev" / "S02_mdm.wav").exists()
+    with open(tmp_path / "session" / "devices" / "train" / "S04.json") as f:
+        assert json.load(f)["mdm"]["channels"] == ["U01.CH1", "U01.CH2"]
+
+
+@pytest.mark.parametrize("per", ["array", "session"])
+def test_prepare_repacked(chime6_corpus, tmp_path, per):
+    rng = np.random.default_rng(0)
+    channels = []
+    for device in ["U01.CH1", "U01.CH2"]:
+        data = rng.integers(-1000, 1000, (16000 * 11, 1), dtype="int16")
+        sf.write(
+            str(chime6_corpus / "audio" / "train" / f"S04_{device}.wav"), data, 16000
+        )
+        channels.append(data)
+    out = tmp_path / "out"
+    gen_chime6(str(out), str(chime6_corpus), dset_part="train")
+    repack_multichannel(str(out), str(tmp_path / per), per=per)
+
+    expected = prepare_chime6(out, dset_part="train", mic="mdm")["train"]
+    manifests = prepare_chime6(tmp_path / per, dset_part="train", mic="mdm")["train"]
+    recording = manifests["recordings"]["S04"]
+    assert len(recording.sources) == 1
+    assert recording.sources[0].channels == [0, 1]
+    assert recording.num_samples == expected["recordings"]["S04"].num_samples
+    audio = recording.load_audio()
+    assert np.array_equal(
+        np.round(audio.T * 32768), np.concatenate(channels, axis=1).astype("float64")
+    )
+    assert [x.channel for x in manifests["supervisions"]] == [
+        x.channel for x in expected["supervisions"]
+    ]
+
+
+def test_export_shards(chime6_corpus, tmp_path):
+    out = tmp_path / "out"
+    gen_chime6(str(out), str(chime6_corpus), dset_part="train,dev")
+    shards = export_shards(
+        str(out), str(tmp_path / "shards"), "train", "U01.CH1", shard_size=20480
+    )
+    assert len(shards["train"]) > 1
+    members = []
+    for x in shards["train"]:
+        assert os.path.getsize(x) <= 20480
+        with tarfile.open(x) as tar:
+            for member in tar:
+                members.append((member.name, tar.extractfile(member).read()))
+    # audio and sidecar of each segment next to each other, in shuffled order
+    keys = [name[: -len(".flac")] for name, _ in members[::2]]
+    assert [name for name, _ in members] == [
+        f"{k}.{ext}" for k in keys for ext in ["flac", "json"]
+    ]
+    assert len(keys) == 18
+    assert keys != sorted(keys)
+    for (_, audio), (_, sidecar) in zip(members[::2], members[1::2]):
+        metadata = json.loads(sidecar)
+        data, fs = sf.read(io.BytesIO(audio))
+        assert fs == 16000
+        duration = float(metadata["end_time"]) - float(metadata["start_time"])
+        assert len(data) == round(duration * 16000)
+        assert metadata["device"] == "U01.CH1"
+    with open(out / "transcriptions_scoring" / "train" / "S03.json") as f:
+        first = json.load(f)[0]
+    sidecar = members[keys.index("S03_P01_0000050_0000125") * 2 + 1][1]
+    assert json.loads(sidecar) == {
+        "session_id": "S03",
+        "speaker": "P01",
+        "start_time": "0.500",
+        "end_time": "1.250",
+        "words": "Yeah.",
+        "words_normalized": first["words"],
+        "device": "U01.CH1",
+        "split": "train",
+    }
+    assert not (tmp_path / "shards" / "train" / ".staging").exists()
+
+    # same shards with parallel jobs
+    parallel = export_shards(
+        str(out), str(tmp_path / "parallel"), "train", "U01.CH1", 20480, jobs=4
+    )
+    assert len(parallel["train"]) == len(shards["train"])
+    for x, y in zip(shards["train"], parallel["train"]):
+        with open(x, "rb") as f_x, open(y, "rb") as f_y:
+            assert f_x.read() == f_y.read()
+    # only P01 has a close-talk microphone
+    ihm = export_shards(str(out), str(tmp_path / "ihm"), "train", jobs=4)
+    with tarfile.open(ihm["train"][0]) as tar:
+        assert len(tar.getnames()) == 2 * 9
+        assert all("_P01_" in x for x in tar.getnames())
+    # no segment with audio of the device
+    with pytest.raises(RuntimeError):
+        export_shards(str(out), str(tmp_path / "missing"), "train", "U09.CH1")
+
+
+def test_export_shards_mixer6(tmp_path):
+    # Mixer 6 close-talk audio is named after the channel, not the speaker
+    data_dir = tmp_path / "mixer6"
+    for x in ["audio", "devices", "transcriptions"]:
+        os.makedirs(data_dir / x / "train")
+    rng = np.random.default_rng(0)
+    channels = {}
+    devices = {}
+    for channel, speaker in [(1, "I01"), (2, "S01"), (3, "I01"), (4, None)]:
+        channels[channel] = rng.integers(-1000, 1000, 16000 * 4, dtype="int16")
+        sf.write(
+            str(data_dir / "audio" / "train" / f"M01_CH{channel:02d}.flac"),
+            channels[channel],
+            16000,
+        )
+        devices[f"CH{channel}"] = {
+            "is_close_talk": speaker is not None,
+            "speaker": speaker,
+            "num_channels": 1,
+            "device_type": "mic",
+        }
+    with open(data_dir / "devices" / "train" / "M01.json", "w") as f:
+        json.dump(devices, f)
+    with open(data_dir / "transcriptions" / "train" / "M01.json", "w") as f:
+        json.dump(
+            [
+                {"speaker": x, "start_time": start, "end_time": end, "words": "hi"}
+                for x, start, end in [("I01", "0.5", "1.0"), ("S01", "1.0", "2.5")]
+            ],
+            f,
+        )
+    shards = export_shards(str(data_dir), str(tmp_path / "shards"))
+    with tarfile.open(shards["train"][0]) as tar:
+        audio = {
+            x.name: sf.read(io.BytesIO(tar.extractfile(x).read()), dtype="int16")[0]
+            for x in tar
+            if x.name.endswith(".flac")
+        }
+    assert sorted(audio) == [
+        "M01_I01_0000050_0000100.flac",
+        "M01_S01_0000100_0000250.flac",
+    ]
+    assert np.array_equal(
+        audio["M01_I01_0000050_0000100.flac"], channels[1][8000:16000]
+    )
+    assert np.array_equal(
+        audio["M01_S01_0000100_0000250.flac"], channels[2][16000:40000]
+    )
+
+
+def test_audio_index(chime6_corpus, tmp_path, monkeypatch):
+    out = tmp_path / "out"
+    gen_chime6(str(out), str(chime6_corpus), dset_part="train,dev")
+    index = AudioIndex(str(out))
+    assert len(index.entries) == 12
+    audio_file = chime6_corpus / "audio" / "train" / "S04_P01.wav"
+    # symlinks share the entry of the file they point to
+    assert index.get(out / "audio" / "train" / "S04_P01.wav") == AudioInfo(
+        16000 * 11, 16000, 2, "PCM_16"
+    )
+    assert index.get(audio_file).duration == 11.0
+    assert not index.dirty
+
+    def no_read(path):
+        raise AssertionError(f"{path} header read again")
+
+    monkeypatch.setattr(audio_index.sf, "info", no_read)
+    manifests = prepare_chime6(str(out), dset_part="train", mic="ihm")
+    recording = manifests["train"]["recordings"]["S04_P01"]
+    assert recording.num_samples == 16000 * 11
+    monkeypatch.undo()
+
+    # the headers of all the sessions are looked up at once
+    calls = []
+    info = AudioIndex.info
+
+    def batched_info(self, paths):
+        calls.append(list(paths))
+        return info(self, calls[-1])
+
+    monkeypatch.setattr(AudioIndex, "info", batched_info)
+    prepare_chime6(str(out), dset_part="train", mic="mdm")
+    assert [len(x) for x in calls] == [3]
+    monkeypatch.undo()
+
+    # a modified file is read again
+    sf.write(str(audio_file), np.zeros((16000, 2), dtype="int16"), 16000)
+    assert index.get(audio_file).frames == 16000
+    assert index.dirty
+    index.save()
+    assert AudioIndex(str(out)).get(audio_file).frames == 16000
+
+
+def test_data_check(chime6_corpus, tmp_path):
+    root = tmp_path / "dasr"
+    gen_chime6(str(root / "chime6"), str(chime6_corpus), dset_part="train,dev")
+    checksum_json = str(tmp_path / "md5.json")
+    data_check(str(root), input_json=checksum_json, create=True, jobs=4)
+    with open(checksum_json, "r") as f:
+        checksums = json.load(f)
+    # same files as the previous glob based listing
+    assert sorted(checksums) == sorted(
+        os.path.relpath(x, root)
+        for ext in [".json", ".uem", ".wav", ".flac"]
+        for x in glob.glob(os.path.join(root, f"**/*{ext}"), recursive=True)
+    )
+    uem = os.path.join("chime6", "uem", "train", "all.uem")
+    with open(root / uem, "rb") as f:
+        assert checksums[uem] == hashlib.md5(f.read()).hexdigest()
+    data_check(str(root), input_json=checksum_json, jobs=4)
+
+    # eval files are not checked (nor hashed) unless asked
+    os.makedirs(root / "chime6" / "audio" / "eval")
+    (root / "chime6" / "audio" / "eval" / "S01_U01.CH1.wav").write_bytes(b"x")
+    data_check(str(root), input_json=checksum_json)
+    with pytest.raises(KeyError):
+        data_check(str(root), has_eval=True, input_json=checksum_json)
+    data_check(str(root), has_eval=True, input_json=checksum_json, forgive_missing=True)
+
+    # every mismatching file is reported
+    for x in ["S03", "S05"]:
+        with open(root / "chime6" / "transcriptions" / "train" / f"{x}.json", "a") as f:
+            f.write(" ")
+    with pytest.raises(RuntimeError) as e:
+        data_check(str(root), input_json=checksum_json, jobs=4)
+    assert "2 files" in str(e.value)
+    assert "S03.json" in str(e.value) and "S05.json" in str(e.value)
+
+
+def test_scan_tree_symlinks(tmp_path):
+    (tmp_path / "data" / "a").mkdir(parents=True)
+    (tmp_path / "data" / "a" / "x.wav").write_bytes(b"x")
+    (tmp_path / "other").mkdir()
+    (tmp_path / "other" / "y.wav").write_bytes(b"y")
+    os.symlink(tmp_path / "other", tmp_path / "data" / "linked")
+    os.symlink(tmp_path / "data", tmp_path / "data" / "a" / "loop")
+    files = checksum.scan_tree(tmp_path / "data", [".wav"])
+    assert [x.relpath for x in files] == [
+        os.path.join("a", "x.wav"),
+        os.path.join("linked", "y.wav"),
+    ]
+    assert files[1].path == str(tmp_path / "data" / "linked" / "y.wav")
+
+
+def test_data_check_cache(chime6_corpus, tmp_path, monkeypatch):
+    root = tmp_path / "dasr"
+    gen_chime6(str(root / "chime6"), str(chime6_corpus), dset_part="train,dev")
+    checksum_json = str(tmp_path / "md5.json")
+    data_check(str(root), input_json=checksum_json, create=True)
+    assert os.path.exists(root / checksum.DigestCache.FILENAME)
+
+    hashed = []
+    hash_chunks = checksum._hash_chunks
+
+    def counting_hash_chunks(path, *args, **kwargs):
+        hashed.append(os.path.relpath(path, root))
+        return hash_chunks(path, *args, **kwargs)
+
+    monkeypatch.setattr(checksum, "_hash_chunks", counting_hash_chunks)
+    data_check(str(root), input_json=checksum_json)
+    assert hashed == []
+
+    # only the modified file is hashed again, and found wrong
+    transcription = root / "chime6" / "transcriptions" / "train" / "S04.json"
+    with open(transcription, "a") as f:
+        f.write(" ")
+    with pytest.raises(RuntimeError):
+        data_check(str(root), input_json=checksum_json)
+    assert hashed == [os.path.relpath(transcription, root)]
+
+    hashed.clear()
+    with pytest.raises(RuntimeError):
+        data_check(str(root), input_json=checksum_json, full_check=True)
+    with open(checksum_json, "r") as f:
+        assert sorted(hashed) == sorted(json.load(f))
+
+    # the published checksums never come from the cache
+    hashed.clear()
+    data_check(str(root), input_json=checksum_json, create=True)
+    with open(checksum_json, "r") as f:
+        assert sorted(hashed) == sorted(json.load(f))
+    hashed.clear()
+    data_check(str(root), input_json=checksum_json)
+    assert hashed == []
+
+
+def test_data_check_manifest_v2(chime6_corpus, tmp_path, monkeypatch):
+    root = tmp_path / "dasr"
+    gen_chime6(str(root / "chime6"), str(chime6_corpus), dset_part="train,dev")
+    checksum_json = str(tmp_path / "md5_v2.json")
+    chunk_size = 1 << 16
+    data_check(
+        str(root),
+        input_json=checksum_json,
+        create=True,
+        manifest_version=2,
+        chunk_size=chunk_size,
+    )
+    manifest = checksum.load_manifest(checksum_json)
+    assert manifest.version == 2 and manifest.chunk_size == chunk_size
+    wav = os.path.join("chime6", "audio", "train", "S04_P01.wav")
+    with open(root / wav, "rb") as f:
+        content = f.read()
+    entry = manifest.entries[wav]
+    assert entry.size == len(content)
+    assert entry.digest == hashlib.md5(content).hexdigest()
+    assert entry.chunks == [
+        hashlib.md5(content[i : i + chunk_size]).hexdigest()
+        for i in range(0, len(content), chunk_size)
+    ]
+    uem = manifest.entries[os.path.join("chime6", "uem", "train", "all.uem")]
+    assert uem.chunks is None
+    data_check(str(root), input_json=checksum_json, full_check=True)
+
+    hashed = []
+    hash_chunks = checksum._hash_chunks
+
+    def counting_hash_chunks(path, *args, **kwargs):
+        hashed.append(os.path.relpath(path, root))
+        return hash_chunks(path, *args, **kwargs)
+
+    monkeypatch.setattr(checksum, "_hash_chunks", counting_hash_chunks)
+    # files are symlinks to the original corpus
+    truncated = os.path.join("chime6", "audio", "train", "S03_U01.CH1.wav")
+    with open(root / truncated, "r+b") as f:
+        f.truncate(1000)
+    with open(root / wav, "r+b") as f:
+        f.seek(3 * chunk_size + 10)
+        f.write(b"corrupted")
+    with pytest.raises(RuntimeError) as e:
+        data_check(str(root), input_json=checksum_json)
+    assert f"size is 1000 bytes instead of {16000 * 10 * 2 + 44}" in str(e.value)
+    assert f"bytes {3 * chunk_size}-{4 * chunk_size}" in str(e.value)
+    # the truncated file is not even read
+    assert hashed == [wav]
+
+
+def test_data_check_sidecar(chime6_corpus, tmp_path, monkeypatch):
+    root = tmp_path / "dasr"
+    gen_chime6(str(root / "chime6"), str(chime6_corpus), dset_part="train,dev")
+    checksum_json = str(tmp_path / "md5.json")
+    data_check(str(root), input_json=checksum_json, create=True)
+    with pytest.raises(FileNotFoundError):
+        data_check(str(root), algo="blake2b")
+
+    hashed = []
+    hash_chunks = checksum._hash_chunks
+
+    def counting_hash_chunks(path, *args, **kwargs):
+        hashed.append(os.path.relpath(path, root))
+        return hash_chunks(path, *args, **kwargs)
+
+    monkeypatch.setattr(checksum, "_hash_chunks", counting_hash_chunks)
+    chunk_size = 1 << 16
+    data_check(
+        str(root),
+        input_json=checksum_json,
+        algo="blake2b",
+        create_sidecar=True,
+        chunk_size=chunk_size,
+    )
+    monkeypatch.undo()
+    sidecar = checksum.load_manifest(root / ".dgen_checksum_blake2b.json")
+    assert sidecar.algo == "blake2b" and sidecar.chunk_size == chunk_size
+    with open(checksum_json, "r") as f:
+        assert sorted(sidecar.entries) == sorted(json.load(f))
+    # checked with MD5 and hashed with blake2b in a single read
+    assert sorted(hashed) == sorted(sidecar.entries)
+    uem = os.path.join("chime6", "uem", "train", "all.uem")
+    with open(root / uem, "rb") as f:
+        assert sidecar.entries[uem].digest == hashlib.blake2b(f.read()).hexdigest()
+    wav = os.path.join("chime6", "audio", "train", "S04_P01.wav")
+    with open(root / wav, "rb") as f:
+        content = f.read()
+    assert sidecar.entries[wav].chunks == [
+        hashlib.blake2b(content[i : i + chunk_size]).hexdigest()
+        for i in range(0, len(content), chunk_size)
+    ]
+    data_check(str(root), algo="blake2b")
+    data_check(str(root), algo="blake2b", full_check=True)
+
+    transcription = root / "chime6" / "transcriptions" / "train" / "S04.json"
+    with open(transcription, "a") as f:
+        f.write(" ")
+    with pytest.raises(RuntimeError) as e:
+        data_check(str(root), algo="blake2b")
+    assert "BLAKE2B" in str(e.value) and "S04.json" in str(e.value)
+    # a sidecar is only made from data with the right MD5 checksums
+    os.remove(root / ".dgen_checksum_blake2b.json")
+    with pytest.raises(RuntimeError):
+        data_check(
+            str(root), input_json=checksum_json, algo="blake2b", create_sidecar=True
+        )
+    assert not os.path.exists(root / ".dgen_checksum_blake2b.json")
+
+
+def test_run_tasks(tmp_path):
+    state_file = str(tmp_path / "state.json")
+    lock = threading.Lock()
+    running = {"io": 0, "cpu": 0}
+    peak = {"io": 0, "cpu": 0}
+    calls = []
+
+    def make(name, kind, result, fail=False):
+        def fn(*args):
+            with lock:
+                calls.append((name, args))
+                running[kind] += 1
+                peak[kind] = max(peak[kind], running[kind])
+            time.sleep(0.05)
+            with lock:
+                running[kind] -= 1
+            if fail:
+                raise RuntimeError(name)
+            return result
+
+        return fn
+
+    def tasks(fail=False):
+        return [
+            Task("a:download", "io", make("a:download", "io", "a_dir")),
+            Task("b:download", "io", make("b:download", "io", "b_dir")),
+            Task("c:download", "io", make("c:download", "io", "c_dir")),
+            Task(
+                "a:dev",
+                "cpu",
+                make("a:dev", "cpu", 1, fail),
+                ["a:download"],
+                [str(tmp_path / "a" / "dev")],
+            ),
+            Task("a:eval", "cpu", make("a:eval", "cpu", 2), ["a:download"]),
+            Task("b:dev", "cpu", make("b:dev", "cpu", 3), ["b:download"]),
+            Task("d:dev", "cpu", make("d:dev", "cpu", None), [], [str(tmp_path / "d")]),
+            Task("e:dev", "cpu", make("e:dev", "cpu", None), ["a:dev"]),
+        ]
+
+    # outputs of tasks never started with this state file are kept
+    for x in ["a/dev", "d"]:
+        os.makedirs(tmp_path / x)
+        (tmp_path / x / "old.json").touch()
+    with pytest.raises(RuntimeError, match="a:dev"):
+        run_tasks(tasks(fail=True), TaskState(state_file), io_jobs=2, cpu_jobs=1)
+    assert peak == {"io": 2, "cpu": 1}
+    # dependencies get the results of the tasks they depend on
+    assert ("a:eval", ("a_dir",)) in calls
+    # a failed task does not stop the others, only the ones depending on it
+    assert "e:dev" not in [name for name, _ in calls]
+    assert set(TaskState(state_file).completed) == {
+        "a:download",
+        "b:download",
+        "c:download",
+        "a:eval",
+        "b:dev",
+        "d:dev",
+    }
+    assert TaskState(state_file).started == ["a:dev"]
+    assert os.path.exists(tmp_path / "a" / "dev" / "old.json")
+    assert os.path.exists(tmp_path / "d" / "old.json")
+
+    # resume, only the failed task and the ones depending on it are run
+    calls.clear()
+    state = TaskState(state_file)
+    run_tasks(tasks(), state, io_jobs=2, cpu_jobs=3)
+    assert calls == [("a:dev", ("a_dir",)), ("e:dev", (1,))]
+    assert len(state.completed) == 8
+    assert state.started == []
+    # the outputs of the failed task were removed before running it again
+    assert not os.path.exists(tmp_path / "a" / "dev")
+    assert os.path.exists(tmp_path / "d" / "old.json")
+
+
+def test_dasr_tasks(tmp_path):
+    tasks = dasr_tasks(
+        str(tmp_path / "dasr"), str(tmp_path / "dl"), "mixer6", ["train", "dev"]
+    )
+    deps = {t.name: t.deps for t in tasks}
+    assert deps == {
+        "chime6:train": [],
+        "mixer6:train_call": [],
+        "mixer6:train_intv": [],
+        "chime6:dev": [],
+        "mixer6:dev": [],
+        "dipco:download": [],
+        "dipco:dev": ["dipco:download"],
+        "notsofar1:download:dev": [],
+        "notsofar1:dev": ["notsofar1:download:dev"],
+    }
+    assert {t.name for t in tasks if t.kind == "io"} == {
+        "dipco:download",
+        "notsofar1:download:dev",
+    }
+
+
+class FakeServer(http.server.ThreadingHTTPServer):
+    """
+    Local HTTP stand-in serving `files` (path -> bytes) with range requests,
+    the connection is dropped after `fail_after` bytes if it is not None.
+    Files under /<container>/ can also be listed like an Azure blob container,
+    `page_size` blobs at a time, with the size and MD5 of `listed` (path ->
+    bytes) instead of the served ones if set, as if changed since listed.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.listed = {}
+        self.fail_after = None
+        self.page_size = 2
+        self.requests = []
+        super().__init__(("127.0.0.1", 0), FakeHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def list_blobs(self, container, query):
+        prefix = query.get("prefix", [""])[0]
+        names = sorted(
+            k[len(container) + 1 :]
+            for k in self.server.files
+            if k.startswith(container + "/")
+        )
+        names = [x for x in names if x.startswith(prefix)]
+        start = int(query.get("marker", ["0"])[0])
+        end = start + self.server.page_size
+        blobs = ""
+        for x in names[start:end]:
+            path = container + "/" + x
+            data = self.server.listed.get(path, self.server.files[path])
+            md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+            blobs += (
+                f"<Blob><Name>{x}</Name><Properties>"
+                f"<Content-Length>{len(data)}</Content-Length>"
+                f"<Content-MD5>{md5}</Content-MD5></Properties></Blob>"
+            )
+        marker = str(end) if end < len(names) else ""
+        body = (
+            f"<?xml version='1.0' encoding='utf-8'?><EnumerationResults>"
+            f"<Blobs>{blobs}</Blobs><NextMarker>{marker}</NextMarker>"
+            "</EnumerationResults>"
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        query = urllib.parse.parse_qs(query)
+        if query.get("comp") == ["list"]:
+            self.list_blobs(path, query)
+            return
+        data = self.server.files.get(self.path)
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        if data is None:
+            self.send_error(404)
+            return
+        start, end = 0, len(data)
+        if self.headers.get("Range") is not None:
+            c_range = self.headers["Range"].split("=")[1].split("-")
+            start = int(c_range[0])
+            if c_range[1]:
+                end = min(int(c_range[1]) + 1, len(data))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        if self.server.fail_after is not None and self.server.fail_after < end - start:
+            self.wfile.write(data[start : start + self.server.fail_after])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:end])
+
+
+@pytest.fixture
+def fake_server():
+    server = FakeServer({})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_tarball(members, links=()):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        for name, target in links:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            tar.addfile(info)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("keep_archive", [False, True])
+def test_stream_download_extract(fake_server, tmp_path, keep_archive):
+    rng = np.random.default_rng(0)
+    members = {
+        f"Dipco/audio/dev/S{i:02d}_U01.CH1.wav": rng.bytes(300_000) for i in range(6)
+    }
+    tarball = make_tarball(
+        members, links=[("Dipco/link.wav", "audio/dev/S00_U01.CH1.wav")]
+    )
+    fake_server.files["/DiPCo.tgz"] = tarball
+    url = fake_server.url("/DiPCo.tgz")
+    archive = str(tmp_path / "DiPCo.tgz") if keep_archive else None
+    target = tmp_path / "dipco"
+
+    fake_server.fail_after = len(tarball) // 2
+    with pytest.raises(http.client.IncompleteRead):
+        stream_download_extract(url, target, archive)
+    partial = {k for k in members if os.path.exists(target / k)}
+    assert 0 < len(partial) < len(members)
+    mtimes = {k: os.stat(target / k).st_mtime_ns for k in partial}
+
+    fake_server.fail_after = None
+    assert stream_download_extract(url, target, archive) == target
+    for k, v in members.items():
+        assert (target / k).read_bytes() == v
+    assert os.readlink(target / "Dipco" / "link.wav") == "audio/dev/S00_U01.CH1.wav"
+    # members extracted before the interruption are not written again
+    assert {k: os.stat(target / k).st_mtime_ns for k in partial} == mtimes
+    if keep_archive:
+        assert (tmp_path / "DiPCo.tgz").read_bytes() == tarball
+        assert fake_server.requests[-1][1] is not None  # resumed with a range
+    else:
+        assert not (tmp_path / "DiPCo.tgz").exists()
+        assert fake_server.requests[-1][1] is None
+
+    # nothing to do once completed
+    n_requests = len(fake_server.requests)
+    stream_download_extract(url, target, archive)
+    assert len(fake_server.requests) == n_requests
+
+
+def test_stream_download_extract_unsafe(fake_server, tmp_path):
+    fake_server.files["/evil.tar.gz"] = make_tarball({"../evil.txt": b"evil"})
+    fake_server.files["/link.tar.gz"] = make_tarball(
+        {"ok.txt": b"ok"}, links=[("data/passwd", "../../etc/passwd")]
+    )
+    for name in ["evil", "link"]:
+        with pytest.raises(ValueError):
+            stream_download_extract(
+                fake_server.url(f"/{name}.tar.gz"), tmp_path / "target"
+            )
+    assert not (tmp_path / "evil.txt").exists()
+    assert not os.path.lexists(tmp_path / "target" / "data" / "passwd")
+
+
+def test_download_blob_container_dir(fake_server, tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    files = {
+        "MTG/MTG_1/mc.wav": rng.bytes(150000),
+        "MTG/MTG_1/gt.json": b"{}",
+        "MTG/MTG_2/mc.wav": rng.bytes(70000),
+        "MTG/empty.txt": b"",
+        "other/file.txt": b"other",
+    }
+    for name, content in files.items():
+        fake_server.files[f"/container/{name}"] = content
+    account_url = fake_server.url("")
+
+    def download():
+        return download_blob_container_dir(
+            "MTG",
+            str(tmp_path),
+            "container",
+            keep_structure=True,
+            account_url=account_url,
+            max_connections=4,
+            part_size=65536,
+        )
+
+    # in parts of 64 KiB, only those smaller than fail_after complete
+    monkeypatch.setattr("time.sleep", lambda _: None)
+    fake_server.fail_after = 20000
+    assert download() is None
+    assert not (tmp_path / "MTG" / "MTG_1" / "mc.wav").exists()
+    assert (tmp_path / "MTG" / "MTG_1" / "mc.wav.part").exists()
+    assert (tmp_path / "MTG" / "MTG_1" / "gt.json").read_bytes() == b"{}"
+
+    # resumed with the missing parts only
+    fake_server.fail_after = None
+    fake_server.requests.clear()
+    assert download() == os.path.join(str(tmp_path), "MTG")
+    assert sorted(fake_server.requests) == [
+        ("/container/MTG/MTG_1/mc.wav", "bytes=0-65535"),
+        ("/container/MTG/MTG_1/mc.wav", "bytes=65536-131071"),
+        ("/container/MTG/MTG_2/mc.wav", "bytes=0-65535"),
+    ]
+    for name, content in files.items():
+        path = tmp_path / name
+        assert path.exists() == name.startswith("MTG/")
+        if path.exists():
+            assert path.read_bytes() == content
+    assert glob.glob(str(tmp_path / "**" / "*.part*"), recursive=True) == []
+
+    # complete files are not downloaded again
+    fake_server.requests.clear()
+    assert download() is not None
+    assert fake_server.requests == []
+
+    # nor written if their size changed since listed
+    fake_server.files["/container/MTG/MTG_3/mc.wav"] = rng.bytes(1200)
+    fake_server.listed["/container/MTG/MTG_3/mc.wav"] = rng.bytes(1000)
+    assert download() is None
+    assert not (tmp_path / "MTG" / "MTG_3" / "mc.wav").exists()
+
+    # or their content, then downloaded again from scratch
+    fake_server.files["/container/MTG/MTG_3/mc.wav"] = rng.bytes(1000)
+    assert download() is None
+    assert glob.glob(str(tmp_path / "MTG" / "MTG_3" / "*")) == []
+    fake_server.listed.clear()
+    assert download() is not None
+    assert (tmp_path / "MTG" / "MTG_3" / "mc.wav").read_bytes() == (
+        fake_server.files["/container/MTG/MTG_3/mc.wav"]
+    )
+
+    # resumed from scratch if interrupted with another part size
+    content = rng.bytes(150000)
+    fake_server.files["/container/MTG/MTG_4/mc.wav"] = content
+    (tmp_path / "MTG" / "MTG_4").mkdir()
+    staging = tmp_path / "MTG" / "MTG_4" / "mc.wav.part"
+    staging.write_bytes(content[:40000] + bytes(110000))
+    (tmp_path / "MTG" / "MTG_4" / "mc.wav.part.done").write_text("0-40000\n")
+    fake_server.requests.clear()
+    assert download() is not None
+    assert len(fake_server.requests) == 3
+    assert (tmp_path / "MTG" / "MTG_4" / "mc.wav").read_bytes() == content
@@ -1,6 +1,35 @@
+import glob
+import io
+import json
+import os
+import pickle
+import random
+import re
+import subprocess
+import sys
+import unicodedata
+
 import pytest
 
-from chime_utils.text_norm.whisper_like import EnglishTextNormalizer
+from chime_utils.text_norm import (
+    CachedNormalizer,
+    DiskCachedNormalizer,
+    batch,
+    disk_cache,
+    files,
+    get_txt_norm,
+    normalize_many,
+)
+from chime_utils.text_norm.whisper_like import (
+    BasicTextNormalizer,
+    EnglishTextNormalizer,
+)
+from chime_utils.text_norm.whisper_like.basic import (
+    ADDITIONAL_DIACRITICS,
+    remove_symbols,
+    remove_symbols_and_diacritics,
+)
+from chime_utils.text_norm.whisper_like.english import EnglishNumberNormalizer
 
 
 @pytest.mark.parametrize("std", [EnglishTextNormalizer()])
@@ -41,3 +70,388 @@ def test_text_normalizer(std):
         std("hmmm this is not as bad [unintelligible] ummm probably thirty" " minutes")
         == "hmm this is not as bad hmm probably thirty minutes"
     )
+
+
+def sequential_english_norm(std, s):
+    # reference implementation, applies each replacer with its own re.sub
+    s = s.lower()
+    s = re.sub(r"[<\[][^>\]]*[>\]]", "", s)
+    s = re.sub(r"\(([^)]+?)\)", "", s)
+    s = re.sub(r"\s+'", "'", s)
+    for pattern, replacement in std.replacers.items():
+        s = re.sub(pattern, replacement, s)
+    s = re.sub(r"(\d),(\d)", r"\1\2", s)
+    s = re.sub(r"\.([^0-9]|$)", r" \1", s)
+    s = remove_symbols_and_diacritics(s, keep=".%$¢€£")
+    if std.standardize_numbers is not None:
+        s = std.standardize_numbers(s)
+    s = std.standardize_spellings(s)
+    s = re.sub(r"[.$¢€£]([^0-9])", r" \1", s)
+    s = re.sub(r"([^0-9])%", r"\1 ", s)
+    s = re.sub(r"\s+", " ", s)
+    return s
+
+
+def dasr_transcripts():
+    # set CHIME_UTILS_DASR_DIR to a generated CHiME-8 DASR folder to check parity
+    # on CHiME-6, DiPCo, Mixer 6 and NOTSOFAR1 transcripts.
+    dasr_dir = os.environ.get("CHIME_UTILS_DASR_DIR")
+    if dasr_dir is None:
+        return []
+    utterances = []
+    for j_file in sorted(
+        glob.glob(os.path.join(dasr_dir, "*", "transcriptions", "*", "*.json"))
+    ):
+        with open(j_file, "r") as f:
+            utterances.extend(x["words"] for x in json.load(f))
+    return utterances
+
+
+PARITY_UTTERANCES = [
+    "Mr. Smith's gone, he'd been there; she's got it, we'd done it.",
+    "I can't, you won't, they aren't, she isn't, it'sn't, they'ren't.",
+    "Hmm mhm, mmm uhm... ahh, haa, ohhh, hooo, uhh, huuu, huh?",
+    "wi-fi hi-fi wi fi goin' y'all wanna gotta gonna i'ma imma ma'am",
+    "Dr. Prof. Capt. Gov. Ald. Gen. Sen. Rep. Pres. Rev. Hon. St. Lt. Col.",
+    "Asst. Assoc. Jr. Sr. Esq. Mrs. they're we'll you've I'm it'd",
+    "(laughs) [noise] <unk> it costs $1,000.50 or 20% or £3 and ¢7",
+    "Crème brûlée, naïve café, œuvre Ørsted straße   ",
+    "  'cause  'em   ' s   don ' t   ",
+]
+
+
+@pytest.mark.parametrize("standardize_numbers", [False, True])
+def test_fused_replacer_parity(standardize_numbers):
+    std = EnglishTextNormalizer(standardize_numbers=standardize_numbers)
+    for s in PARITY_UTTERANCES + dasr_transcripts():
+        assert std(s) == sequential_english_norm(std, s), s
+
+
+def test_fused_replacer_rescans_replacements():
+    # gotta -> got to, then 's got -> has got
+    std = EnglishTextNormalizer()
+    assert std("she's gotta go") == "she has got to go"
+    assert std("it's gotta be") == "it has got to be"
+
+
+def test_fused_replacer_random_parity():
+    std = EnglishTextNormalizer()
+    pieces = (
+        ["mr", "mrs", "st", "dr", "sen", "rep", "hon"]
+        + ["hm", "mhm", "mm", "um", "uhm", "ah", "ha", "oh", "ho", "uh", "huh"]
+        + ["wi", "fi", "-", "goin", "won't", "can't", "let's", "y'all", "ma'am"]
+        + ["'d", "'s", "'re", "'ll", "'t", "'ve", "'m", "n't", "been", "gone"]
+        + ["'", "n", "t", "s", " ", ".", "x", "she", "they"]
+        + ["gotta", "gonna", "wanna", "got", "she's ", "it's ", "he'd "]
+    )
+    rnd = random.Random(0)
+    for _ in range(20000):
+        s = "".join(rnd.choice(pieces) for _ in range(rnd.randint(1, 12)))
+        sequential = s
+        for pattern, replacement in std.replacers.items():
+            sequential = re.sub(pattern, replacement, sequential)
+        assert std.replace(s) == sequential, s
+
+
+def test_number_normalizer_fast_path():
+    std = EnglishNumberNormalizer()
+    pieces = sorted(std.words) + ["a", "half", "oh", "the", "cat", "one's", "x"]
+    pieces += ["$", "£", "%", "¢", "-", "+", "1", "2.5", "7th", "$3", "  ", "\t"]
+    rnd = random.Random(0)
+    skipped = 0
+    for _ in range(20000):
+        s = " ".join(rnd.choice(pieces) for _ in range(rnd.randint(0, 8)))
+        skipped += not std.has_numbers(s)
+        assert std(s) == std.convert(s), s
+    assert skipped > 0
+
+
+@pytest.mark.parametrize("keep", ["", ".%$¢€£"])
+def test_symbols_tables(keep):
+    def reference(s):
+        return "".join(
+            c
+            if c in keep
+            else ADDITIONAL_DIACRITICS[c]
+            if c in ADDITIONAL_DIACRITICS
+            else ""
+            if unicodedata.category(c) == "Mn"
+            else " "
+            if unicodedata.category(c)[0] in "MSP"
+            else c
+            for c in unicodedata.normalize("NFKD", s)
+        )
+
+    def reference_keep_diacritics(s):
+        return "".join(
+            " " if unicodedata.category(c)[0] in "MSP" else c
+            for c in unicodedata.normalize("NFKC", s)
+        )
+
+    codepoints = list(range(0x3000)) + list(range(0x3000, 0x110000, 7))
+    s = "".join(chr(i) for i in codepoints if not 0xD800 <= i < 0xE000)
+    for x in [s, "Crème brûlée, straße!", "plain ascii, isn't it? 100$"]:
+        assert remove_symbols_and_diacritics(x, keep=keep) == reference(x)
+        assert remove_symbols(x) == reference_keep_diacritics(x)
+
+
+def test_cached_normalizer():
+    std = get_txt_norm("chime8", cache_size=2)
+    assert isinstance(std, CachedNormalizer)
+    for s in ["Yeah", "mhm", "Yeah", "okay", "mhm", "Yeah"]:
+        assert std(s) == EnglishTextNormalizer()(s)
+    info = std.cache_info()
+    assert (info.hits, info.misses, info.evictions) == (1, 5, 3)
+    assert info.currsize == 2
+    assert pickle.loads(pickle.dumps(std))("Let's") == "let us"
+    assert get_txt_norm("chime8", cache_size=0).__class__ is EnglishTextNormalizer
+
+
+def test_normalizer_registry():
+    assert get_txt_norm("chime8") is get_txt_norm("chime8")
+    assert get_txt_norm("chime8", cache_size=8).normalizer is get_txt_norm("chime8")
+    mapping = EnglishTextNormalizer().standardize_spellings.mapping
+    assert mapping is get_txt_norm("chime8").standardize_spellings.mapping
+    with pytest.raises(TypeError):
+        mapping["colour"] = "colour"
+    with pytest.raises(NotImplementedError):
+        get_txt_norm("chime5")
+
+
+@pytest.mark.parametrize("norm", ["chime6", "chime8"])
+def test_normalize_many(norm):
+    texts = PARITY_UTTERANCES * 50
+    std = get_txt_norm(norm)
+    expected = [std(x) for x in texts]
+    assert normalize_many(texts, norm, workers=1) == expected
+    assert normalize_many(iter(texts), norm, workers=2, chunksize=7) == expected
+    assert normalize_many(texts, None) == texts
+
+
+def test_legacy_norm_parity():
+    jiwer = pytest.importorskip("jiwer")
+    chime6_recipe = pytest.importorskip("lhotse.recipes.chime6")
+    from chime_utils.text_norm.c7dasr import chime6_norm_scoring, chime7_norm_scoring
+
+    # original CHiME-6 and CHiME-7 DASR scoring pipelines
+    jiwer_chime6_scoring = jiwer.Compose(
+        [
+            jiwer.RemoveKaldiNonWords(),
+            jiwer.SubstituteRegexes(
+                {r"\"": " ", "^[ \t]+|[ \t]+$": "", r"\u2019": "'"}
+            ),
+            jiwer.RemoveEmptyStrings(),
+            jiwer.RemoveMultipleSpaces(),
+        ]
+    )
+    jiwer_chime7_scoring = jiwer.Compose(
+        [
+            jiwer.SubstituteRegexes(
+                {
+                    "(?:^|(?<= ))(hm|hmm|mhm|mmh|mmm)(?:(?= )|$)": "hmmm",
+                    "(?:^|(?<= ))(uhm|um|umm|umh|ummh)(?:(?= )|$)": "ummm",
+                    "(?:^|(?<= ))(uh|uhh)(?:(?= )|$)": "uhhh",
+                }
+            ),
+            jiwer.RemoveEmptyStrings(),
+            jiwer.RemoveMultipleSpaces(),
+        ]
+    )
+
+    def reference_chime6(s):
+        return jiwer_chime6_scoring(
+            chime6_recipe.normalize_text_chime6(s, normalize="kaldi")
+        )
+
+    pieces = (
+        ["hm", "hmm", "mhm", "mmm", "um", "umm", "uh", "uhh", "mm-", "mm", "-"]
+        + ["[inaudible 0:01:02.3]", "[inaudible-2]", "[laughs]", "<unk>", "[", "]"]
+        + ["[redacted]", "[REDACTED]", '"', "’", "'", ".", "?", ",", "!", ";"]
+        + [" ", " ", " ", "  ", "\t", "\n", " ", "Yeah", "ok", "x", "a b"]
+    )
+    rnd = random.Random(0)
+    texts = PARITY_UTTERANCES + dasr_transcripts()
+    for _ in range(20000):
+        texts.append("".join(rnd.choice(pieces) for _ in range(rnd.randint(0, 12))))
+    for s in texts:
+        assert chime6_norm_scoring(s) == reference_chime6(s), s
+        assert chime7_norm_scoring(s) == jiwer_chime7_scoring(reference_chime6(s)), s
+
+
+def test_benchmark_stages():
+    # the benchmark lives next to the tests, it checks by itself that its
+    # stages are equivalent to the normalizers
+    benchmark_text_norm = pytest.importorskip("benchmark_text_norm")
+    results = benchmark_text_norm.run_benchmark(num_utts=200, repeats=1)
+    assert set(results["chime8"]["stages_us_per_utt"]) == {
+        "bracket removal",
+        "replacers",
+        "symbol stripping",
+        "spelling mapping",
+        "cleanup",
+    }
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_normalize_file(workers, monkeypatch):
+    # small reads to have JSON values cut between reads
+    monkeypatch.setattr(files, "_READ_SIZE", 5)
+    std = get_txt_norm("chime8")
+    segments = [
+        {"words": "Hello, Mr. Smith! [laughs]", "speaker": "P01", "end_time": 1.5},
+        {"words": "It's the colour — uh — blue.", "session_id": "S02"},
+        {"session_id": "S02"},
+        *({"words": f"utterance {i} don't", "start_time": i} for i in range(50)),
+    ]
+    for indent in [None, 4]:
+        f_out = io.StringIO()
+        files.normalize_file(
+            io.StringIO(json.dumps(segments, indent=indent)),
+            f_out,
+            "json",
+            workers=workers,
+            chunksize=7,
+        )
+        expected = [
+            {**s, "words": std(s["words"])} if "words" in s else s for s in segments
+        ]
+        assert f_out.getvalue() == json.dumps(expected, indent=4)
+
+    f_out = io.StringIO()
+    files.normalize_file(io.StringIO("[]"), f_out, "json")
+    assert f_out.getvalue() == "[]"
+
+    # no worker processes unless asked for
+    with monkeypatch.context() as m:
+        m.setattr(batch.os, "cpu_count", lambda: 4)
+        m.setattr(batch.multiprocessing, "Pool", None)
+        f_out = io.StringIO()
+        files.normalize_file(io.StringIO(json.dumps(segments)), f_out, "json")
+        assert f_out.getvalue() == json.dumps(expected, indent=4)
+
+    f_out = io.StringIO()
+    jsonl = "".join(json.dumps(s) + "\n" for s in segments)
+    files.normalize_file(io.StringIO(jsonl), f_out, "jsonl", workers=workers)
+    assert [json.loads(x) for x in f_out.getvalue().splitlines()] == expected
+
+    ctm = (
+        ";; a comment\n"
+        "S02 1 0.50 0.40 Colour, 0.9\n"
+        "S02 1 0.90 0.20 [laughs] 0.8\n"
+        "S02 1 1.10 0.40 don't\n"
+    )
+    f_out = io.StringIO()
+    files.normalize_file(io.StringIO(ctm), f_out, "ctm", workers=workers)
+    assert f_out.getvalue() == (
+        ";; a comment\n"
+        "S02 1 0.50 0.40 color 0.9\n"
+        "S02 1 1.100 0.200 do\n"
+        "S02 1 1.300 0.200 not\n"
+    )
+
+    stm = (
+        "S02 1 P05 0.50 2.10 <O,F1> Hello, Mr. Smith!\n"
+        "S02 1 P06 2.10 3.00 Colour [noise]\n"
+        "S02 1 P06 3.00 4.00 [laughs]\n"
+        "S02 1 excluded 4.00 5.00 ignore_time_segment_in_scoring\n"
+    )
+    f_out = io.StringIO()
+    files.normalize_file(io.StringIO(stm), f_out, "stm", workers=workers)
+    assert f_out.getvalue() == (
+        "S02 1 P05 0.50 2.10 <O,F1> hello mister smith\n"
+        "S02 1 P06 2.10 3.00 color\n"
+        "S02 1 P06 3.00 4.00\n"
+        "S02 1 excluded 4.00 5.00 ignore_time_segment_in_scoring\n"
+    )
+
+
+def test_lazy_imports():
+    # run in a fresh interpreter, the test session has already imported all
+    code = (
+        "import sys\n"
+        "import chime_utils.text_norm as tn\n"
+        "loaded = lambda m: any(x.split('.')[0] == m for x in sys.modules)\n"
+        "assert not loaded('lhotse') and not loaded('jiwer') and not loaded('regex')\n"
+        "assert 'chime_utils.text_norm.whisper_like' not in sys.modules\n"
+        "tn.get_txt_norm('chime7')('hello')\n"
+        "assert 'chime_utils.text_norm.whisper_like' not in sys.modules\n"
+        "tn.get_txt_norm('chime8')('hello')\n"
+        "assert 'chime_utils.text_norm.whisper_like' in sys.modules\n"
+        "assert tn.EnglishTextNormalizer is not None\n"
+        "assert not loaded('lhotse') and not loaded('jiwer')\n"
+    )
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(__file__)), env.get("PYTHONPATH", "")]
+    )
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)
+
+
+def test_normalizer_profiling(tmp_path):
+    std = EnglishTextNormalizer(standardize_numbers=True)
+    profiled = EnglishTextNormalizer(standardize_numbers=True, profile=True)
+    for s in PARITY_UTTERANCES * 2:
+        assert profiled(s) == std(s)
+    stats = profiled.stats
+    assert stats.calls == 2 * len(PARITY_UTTERANCES)
+    assert [name for name, _ in profiled.stages()] == list(stats.stage_seconds)
+    assert all(pattern in std.replacers for pattern in stats.replacer_matches)
+    assert stats.replacer_matches[r"\bwon't\b"] == 2
+    stats.reset()
+    profiled("I'm sure they're, they're not ok")
+    assert stats.replacer_matches == {r"'m\b": 1, r"'re\b": 2}
+
+    stats.dump(str(tmp_path / "stats.json"))
+    with open(tmp_path / "stats.json") as f:
+        assert json.load(f)["calls"] == stats.calls
+    stats.reset()
+    assert stats.calls == 0 and len(stats.replacer_matches) == 0
+
+    basic = BasicTextNormalizer(profile=True)
+    assert basic("Hello [noise] World!") == BasicTextNormalizer()(
+        "Hello [noise] World!"
+    )
+    assert basic.stats.calls == 1
+    assert "symbol stripping" in basic.stats.as_dict()["stage_seconds"]
+
+
+def test_disk_cached_normalizer(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache" / "txt_norm.db")
+    utts = ["Hello, Mr. Smith!", "Colour", "Hello, Mr. Smith!", "[noise]"]
+    std = get_txt_norm("chime8")
+    normalizer = get_txt_norm("chime8", cache_path=path)
+    assert [normalizer(s) for s in utts] == [std(s) for s in utts]
+    info = normalizer.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 3, 3)
+    normalizer.close()
+
+    # a new process would read everything from the database
+    normalizer = pickle.loads(pickle.dumps(DiskCachedNormalizer(std, path)))
+    assert [normalizer(s) for s in utts] == [std(s) for s in utts]
+    assert normalizer.cache_info().misses == 0
+    normalizer.close()
+
+    # other normalizers and configurations have their own entries
+    with DiskCachedNormalizer(EnglishTextNormalizer(True), path) as numbers:
+        assert numbers.identity != normalizer.identity
+        numbers("twenty two")
+        assert numbers.cache_info().misses == 1
+    with DiskCachedNormalizer(get_txt_norm("chime6"), path) as chime6:
+        assert chime6("Hello, Mr. Smith!") == "hello mr smith"
+        assert chime6.cache_info().misses == 1
+
+    # any change to the normalizer sources invalidates its entries
+    version = disk_cache.normalizer_version
+    monkeypatch.setattr(disk_cache, "normalizer_version", lambda x: "changed")
+    with DiskCachedNormalizer(std, path) as normalizer:
+        assert normalizer.cache_info().currsize == 0
+        normalizer("Colour")
+        assert normalizer.cache_info().misses == 1
+
+    # without removing those of the other versions, unless vacuumed
+    monkeypatch.setattr(disk_cache, "normalizer_version", version)
+    with DiskCachedNormalizer(std, path) as normalizer:
+        assert normalizer.cache_info().currsize == 3
+        assert normalizer.vacuum() == 1
+    with DiskCachedNormalizer(get_txt_norm("chime6"), path) as chime6:
+        assert chime6.cache_info().currsize == 1